@@ -4,108 +4,152 @@ from flask_cors import CORS, cross_origin
 
 from datetime import datetime, timedelta
 import glob
-import pickle
-import psycopg2
+import json
+import numpy as np
 
-import boto
-import boto.s3.connection
 import os
-from boto.s3.key import Key
+import sys
+import time
 
 app = Flask(__name__)
 CORS(app)
 
-get_filename = lambda trip_id: 'results/prediction-{}.pickle'.format(trip_id)
+get_filename = lambda trip_id: 'results/prediction-{}.json'.format(trip_id)
 
 """
-This section handles Bucketeer and reading of saved files.
+This section handles reading of saved files.
 """
-AWS_ACCESS_KEY_ID = os.environ.get("BUCKETEER_AWS_ACCESS_KEY_ID")
-AWS_SECRET_ACCESS_KEY = os.environ.get("BUCKETEER_AWS_SECRET_ACCESS_KEY")
-BUCKET_NAME = os.environ.get("BUCKETEER_BUCKET_NAME")
-
-def get_connection_and_bucket():
-    conn = boto.s3.connect_to_region(
-               'us-east-1',
-               aws_access_key_id=AWS_ACCESS_KEY_ID,
-               aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-               is_secure=True,
-               calling_format = boto.s3.connection.OrdinaryCallingFormat(),
-           )
-    bucket = conn.get_bucket(BUCKET_NAME)
-    return conn, bucket
-
-def split_filename(full_filename):
-    if '/' not in full_filename:
-        return full_filename
-    filename_parts = full_filename.split('/')
-    path, filename = '/'.join(filename_parts[:-1]), filename_parts[-1]
-    return path, filename
-
-def download_file(full_filename):
-    path, filename = split_filename(full_filename)
-    conn, bucket = get_connection_and_bucket()
-    full_key_name = os.path.join(path, filename)
-    print("Attempting to download from {}".format(full_key_name))
-    k = Key(bucket)
-    k.key = full_key_name
-    k.get_contents_to_filename(filename)
-
-def read_from_pickle(filename, from_bucketeer=False):
-    if from_bucketeer:
-        download_file(filename)
-        path, filename = split_filename(filename)
-
-    with open(filename, 'rb') as f:
-        return pickle.load(f)
+# The API shares the modules of the worker (in main/) that read the saved files
+# and the database (including its pool of connections, see main/db_logic.py, and
+# the windows of the operating trips, see main/trip_windows.py), so that both
+# sides read them the same way
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'main'))
+from db_logic import get_pool
+from storage import get_storage
+from trip_windows import trip_window_index
+
+# Read a JSON file, unless its ETag is still etag.
+# Returns (variable, etag), with variable None if it was not modified.
+def read_json(filename, etag=None):
+    data, etag = get_storage().read(filename, etag)
+    return (json.loads(data.decode('utf-8')) if data is not None else None), etag
 
 """
-Database logic
+Prediction cache
 """
-DATABASE_URL = os.environ.get("DATABASE_URL")
-
-# Helper function to do SQL SELECT query
-def query(sql, data=(), column_names=[]):
-    conn = psycopg2.connect(DATABASE_URL)
-    cursor = conn.cursor()
-    cursor.execute("SET TIME ZONE 'Singapore';")
-    cursor.execute(sql, data)
-    records = cursor.fetchall()
-    # This returns a list of results (where results is represented as a tuple)
-    return records
-
-def get_operating_trip_ids(date_time=datetime.now()):
-    sql = """
-          SELECT
-              "tripId"
-          FROM
-              "tripStops"
-          GROUP BY
-              "tripId"
-          HAVING
-              %(date_time)s >= MIN(time) - INTERVAL '15 minutes'
-              AND %(date_time)s <= MAX(time) + INTERVAL '15 minutes'
-          """
-    data = {'date_time': date_time}
-    records = query(sql, data=data, column_names=['tripId'])
-    return [record[0] for record in records]
+# Predictions (and snapshots) are kept in memory, and checked again (with a
+# conditional GET, which does not download them if they did not change, or a stat
+# of local files) once they are older than PREDICTION_CACHE_TTL_SECONDS. Files that
+# could not be read (e.g. the snapshot before the first cycle) are not read again
+# either until then. Files that are not requested for PREDICTION_CACHE_IDLE_SECONDS are dropped.
+PREDICTION_CACHE_TTL_SECONDS = float(os.environ.get('PREDICTION_CACHE_TTL_SECONDS', 10))
+PREDICTION_CACHE_IDLE_SECONDS = 600
+# Idle files are looked for at most every PREDICTION_CACHE_PRUNE_SECONDS
+PREDICTION_CACHE_PRUNE_SECONDS = 60
+
+# filename -> {'variable', 'etag', 'modified_time', 'validated_time', 'used_time'},
+# with variable None and the 'error' of the read if the file could not be read
+prediction_cache = {}
+prediction_cache_stats = {'hits': 0, 'not_modified': 0, 'downloads': 0, 'errors': 0}
+prediction_cache_pruned = {'time': time.time()}
+
+def read_cached_json(filename):
+    now = time.time()
+    if now - prediction_cache_pruned['time'] > PREDICTION_CACHE_PRUNE_SECONDS:
+        prediction_cache_pruned['time'] = now
+        remove_idle_predictions()
+    entry = prediction_cache.get(filename)
+    if entry and now - entry['validated_time'] < PREDICTION_CACHE_TTL_SECONDS:
+        prediction_cache_stats['hits'] += 1
+    else:
+        try:
+            variable, etag = read_json(filename, etag=entry['etag'] if entry else None)
+        except Exception as e:
+            # E.g. the predictions were deleted, or were not published yet
+            prediction_cache_stats['errors'] += 1
+            entry = prediction_cache[filename] = {'variable': None, 'etag': None, 'error': str(e),
+                                                  'modified_time': now, 'validated_time': now}
+        else:
+            if variable is None:
+                prediction_cache_stats['not_modified'] += 1
+                entry['validated_time'] = now
+            else:
+                prediction_cache_stats['downloads'] += 1
+                entry = prediction_cache[filename] = {'variable': variable, 'etag': etag,
+                                                      'modified_time': now, 'validated_time': now}
+    entry['used_time'] = now
+    if entry['variable'] is None:
+        raise IOError(entry['error'])
+    return entry['variable']
+
+read_predictions = lambda trip_id: check_version(read_cached_json(get_filename(trip_id)))
+
+# The worker also publishes the predictions of all the operating trips as one
+# snapshot every cycle (see main/snapshot.py). Snapshots older than
+# SNAPSHOT_MAX_AGE_SECONDS (e.g. if the worker stopped) are not used.
+SNAPSHOT_FILENAME = 'results/snapshot.json'
+SNAPSHOT_MAX_AGE_SECONDS = 300
+
+# Get the latest snapshot, or None if there is no recent one
+def read_snapshot():
+    # There is no snapshot before the first cycle of the day
+    try:
+        snapshot = check_version(read_cached_json(SNAPSHOT_FILENAME))
+    except Exception:
+        return None
+    if time.time() - snapshot['publishedTime'] > SNAPSHOT_MAX_AGE_SECONDS:
+        return None
+    return snapshot
+
+# Get the predictions of a trip from the snapshot, or from its own file if it is not in it
+def read_trip_predictions(trip_id):
+    snapshot = read_snapshot()
+    if snapshot is not None and str(trip_id) in snapshot['predictions']:
+        return snapshot['predictions'][str(trip_id)]
+    return read_predictions(trip_id)
+
+def remove_idle_predictions():
+    now = time.time()
+    for filename, entry in list(prediction_cache.items()):
+        if now - entry.get('used_time', 0) > PREDICTION_CACHE_IDLE_SECONDS:
+            prediction_cache.pop(filename, None)
+
+def get_prediction_cache_stats():
+    now = time.time()
+    requests = prediction_cache_stats['hits'] + prediction_cache_stats['not_modified'] + \
+        prediction_cache_stats['downloads'] + prediction_cache_stats['errors']
+    entries = list(prediction_cache.values())
+    validated_ages = [now - entry['validated_time'] for entry in entries]
+    modified_ages = [now - entry['modified_time'] for entry in entries]
+    return dict(prediction_cache_stats,
+                hit_rate=prediction_cache_stats['hits'] / requests if requests else 0.0,
+                entries=len(entries),
+                ttl_seconds=PREDICTION_CACHE_TTL_SECONDS,
+                mean_validated_age_seconds=sum(validated_ages) / len(entries) if entries else 0.0,
+                max_validated_age_seconds=max(validated_ages) if entries else 0.0,
+                mean_modified_age_seconds=sum(modified_ages) / len(entries) if entries else 0.0)
 
 """
 Helper methods
 """
-def stringify_predictions(predictions):
-    result = {}
-    for stop_id, date_time in predictions.items():
-        result[str(stop_id)] = {}
-        if type(date_time) == datetime:
-            result[str(stop_id)]['valid'] = True
-            result[str(stop_id)]['eta'] = date_time.strftime('%Y-%m-%dT%H:%M:%S+0800')
-            result[str(stop_id)]['timeToArrival'] = (date_time.replace(tzinfo=None)
-                - (datetime.now() - timedelta(minutes=int(os.environ.get('PLAYBACK_OFFSET'))))) \
-                .total_seconds()
-        else:
-            result[str(stop_id)]['valid'] = False
-            result[str(stop_id)]['reason'] = date_time
+# Predictions are saved by the worker (see main/prediction_format.py) as
+# {"version": 1, "stops": {stop_id: response}, "etaStopIds": [...], "etaEpochs": [...]},
+# with the response of each stop rendered, except its time to arrival.
+PREDICTION_FORMAT_VERSION = 1
+PLAYBACK_OFFSET_SECONDS = int(os.environ.get('PLAYBACK_OFFSET', 0)) * 60
+
+def check_version(saved):
+    if not isinstance(saved, dict) or saved.get('version') != PREDICTION_FORMAT_VERSION:
+        raise ValueError('Predictions are not saved with version {}'.format(PREDICTION_FORMAT_VERSION))
+    return saved
+
+# Get the response of each stop, with its time to arrival from now (in seconds)
+def get_stop_predictions(predictions):
+    times_to_arrival = np.array(predictions['etaEpochs'], dtype=np.float64) - (time.time() - PLAYBACK_OFFSET_SECONDS)
+    # The saved predictions are cached, so the responses with a time to arrival are copies
+    result = dict(predictions['stops'])
+    for stop_id, time_to_arrival in zip(predictions['etaStopIds'], times_to_arrival.tolist()):
+        result[stop_id] = dict(result[stop_id], timeToArrival=time_to_arrival)
     return result
 
 """
@@ -113,14 +157,18 @@ API
 """
 @app.route('/api/v1.0/', methods=['GET'])
 def get_all_predictions():
+    # All the predictions are in the snapshot, if the worker published a recent one
+    snapshot = read_snapshot()
+    if snapshot is not None:
+        return jsonify({trip_id: get_stop_predictions(predictions)
+                        for trip_id, predictions in snapshot['predictions'].items()})
+
     try:
-        trip_ids = get_operating_trip_ids(datetime.now() - timedelta(minutes=int(os.environ.get('PLAYBACK_OFFSET'))))
+        trip_ids = trip_window_index.get_operating_trip_ids(datetime.now() - timedelta(seconds=PLAYBACK_OFFSET_SECONDS))
         predictions_per_trip = {}
         for trip_id in trip_ids:
             try:
-                predictions = read_from_pickle(get_filename(trip_id), from_bucketeer=True)
-                predictions = stringify_predictions(predictions)
-                predictions_per_trip[str(trip_id)] = predictions
+                predictions_per_trip[str(trip_id)] = get_stop_predictions(read_predictions(trip_id))
             except Exception as e:
                 print(e)
     except Exception as e:
@@ -129,31 +177,34 @@ def get_all_predictions():
 
     return jsonify(predictions_per_trip)
 
+@app.route('/api/v1.0/stats', methods=['GET'])
+def get_stats():
+    return jsonify({'prediction_cache': get_prediction_cache_stats(),
+                    'database': get_pool().get_stats()})
+
 @app.route('/api/v1.0/<int:trip_id>', methods=['GET'])
 def get_predictions(trip_id):
     try:
-        predictions = read_from_pickle(get_filename(trip_id), from_bucketeer=True)
+        predictions = read_trip_predictions(trip_id)
     except Exception as e:
         print(e)
         abort(404)
     
-    predictions = stringify_predictions(predictions)
-    return jsonify(predictions)
+    return jsonify(get_stop_predictions(predictions))
     
 
 @app.route('/api/v1.0/<int:trip_id>/<int:stop_id>', methods=['GET'])
 def get_prediction(trip_id, stop_id):
     try:
-        predictions = read_from_pickle(get_filename(trip_id), from_bucketeer=True)
+        predictions = read_trip_predictions(trip_id)
     except Exception as e:
         print(e)
         abort(404)
     
-    if not stop_id in predictions:
+    if not str(stop_id) in predictions['stops']:
         abort(404)
     
-    predictions = stringify_predictions(predictions)
-    return jsonify(predictions[str(stop_id)])
+    return jsonify(get_stop_predictions(predictions)[str(stop_id)])
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,142 @@
+import app
+import json
+import numpy as np
+import time
+import unittest
+from datetime import datetime, timedelta
+from trip_windows import TripWindowIndex
+
+# In-process stand-in for the published files, read like read_json:
+# filename -> (variable, etag)
+class FakeFiles:
+    def __init__(self):
+        self.files = {}
+        self.reads = 0
+        self.etags = []
+
+    def read_json(self, filename, etag=None):
+        self.reads += 1
+        self.etags.append(etag)
+        if filename not in self.files:
+            raise IOError('No such file: {}'.format(filename))
+        variable, file_etag = self.files[filename]
+        return (None, etag) if file_etag == etag else (variable, file_etag)
+
+# Saved predictions (see main/prediction_format.py) of one stop, arriving in seconds_to_arrival
+make_predictions = lambda stop_id, seconds_to_arrival: \
+    {'version': app.PREDICTION_FORMAT_VERSION, 'stops': {str(stop_id): {'valid': True}},
+     'etaStopIds': [str(stop_id)], 'etaEpochs': [time.time() + seconds_to_arrival]}
+
+class APITestCase(unittest.TestCase):
+    def setUp(self):
+        self.files = FakeFiles()
+        self.read_json, app.read_json = app.read_json, self.files.read_json
+        app.prediction_cache.clear()
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        app.read_json = self.read_json
+        app.prediction_cache.clear()
+
+class TestPredictionCache(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.stats = dict(app.prediction_cache_stats)
+        for name in app.prediction_cache_stats:
+            app.prediction_cache_stats[name] = 0
+        self.files.files['prediction'] = ({'a': 1}, 'etag 1')
+
+    def tearDown(self):
+        app.prediction_cache_stats.update(self.stats)
+        super().tearDown()
+
+    # Pretend that the cached file was validated seconds earlier
+    def age(self, filename, seconds):
+        app.prediction_cache[filename]['validated_time'] -= seconds
+
+    def test_serves_cached_file_within_ttl(self):
+        self.assertEqual(app.read_cached_json('prediction'), {'a': 1})
+        self.files.files['prediction'] = ({'a': 2}, 'etag 2')
+        self.assertEqual(app.read_cached_json('prediction'), {'a': 1})
+        self.assertEqual(self.files.reads, 1)
+
+    def test_validates_file_with_etag_after_ttl(self):
+        app.read_cached_json('prediction')
+        modified_time = app.prediction_cache['prediction']['modified_time']
+        self.age('prediction', app.PREDICTION_CACHE_TTL_SECONDS)
+        # Not modified (e.g. a 304 response from S3), so the cached file is kept
+        self.assertEqual(app.read_cached_json('prediction'), {'a': 1})
+        self.assertEqual(self.files.etags, [None, 'etag 1'])
+        self.assertEqual(app.prediction_cache['prediction']['modified_time'], modified_time)
+
+        self.files.files['prediction'] = ({'a': 2}, 'etag 2')
+        self.age('prediction', app.PREDICTION_CACHE_TTL_SECONDS)
+        self.assertEqual(app.read_cached_json('prediction'), {'a': 2})
+        self.assertEqual(app.prediction_cache['prediction']['etag'], 'etag 2')
+
+    def test_removes_idle_files(self):
+        app.read_cached_json('prediction')
+        self.files.files['other prediction'] = ({'b': 1}, 'etag')
+        app.prediction_cache['prediction']['used_time'] -= app.PREDICTION_CACHE_IDLE_SECONDS + 1
+        # Idle files are only looked for every PREDICTION_CACHE_PRUNE_SECONDS
+        app.read_cached_json('other prediction')
+        self.assertIn('prediction', app.prediction_cache)
+        app.prediction_cache_pruned['time'] -= app.PREDICTION_CACHE_PRUNE_SECONDS + 1
+        app.read_cached_json('other prediction')
+        self.assertEqual(list(app.prediction_cache), ['other prediction'])
+
+    def test_stats(self):
+        app.read_cached_json('prediction')
+        app.read_cached_json('prediction')
+        self.age('prediction', app.PREDICTION_CACHE_TTL_SECONDS)
+        app.read_cached_json('prediction')
+        self.assertRaises(IOError, app.read_cached_json, 'missing prediction')
+        stats = app.get_prediction_cache_stats()
+        self.assertEqual((stats['hits'], stats['not_modified'], stats['downloads'], stats['errors']),
+                         (1, 1, 1, 1))
+        self.assertEqual(stats['hit_rate'], 0.25)
+        self.assertEqual(stats['entries'], 2)
+
+class TestOperatingTrips(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.trip_window_index = app.trip_window_index
+
+    def tearDown(self):
+        app.trip_window_index = self.trip_window_index
+        super().tearDown()
+
+    # Without a snapshot, the predictions of the operating trips (see main/trip_windows.py) are read one by one
+    def test_serves_predictions_of_operating_trips(self):
+        now = datetime.now()
+        windows = [(1, now - timedelta(minutes=10), now + timedelta(minutes=10)),
+                   (2, now - timedelta(hours=2), now - timedelta(hours=1))]
+        get_trip_windows = lambda after_date, before_date, after_trip_id=0: \
+            [window for window in windows if window[0] > after_trip_id]
+        app.trip_window_index = TripWindowIndex(get_trip_windows)
+        self.files.files[app.get_filename(1)] = (make_predictions(7, 60), 'etag')
+        self.files.files[app.get_filename(2)] = (make_predictions(7, 60), 'etag')
+
+        predictions_per_trip = json.loads(self.client.get('/api/v1.0/').data.decode('utf-8'))
+        self.assertEqual(list(predictions_per_trip), ['1'])
+        self.assertTrue(np.isclose(predictions_per_trip['1']['7']['timeToArrival'], 60, atol=5))
+
+class TestSnapshot(APITestCase):
+    # Before the first cycle there is no snapshot, and it is not looked for on every request
+    def test_missing_snapshot_is_read_once_per_ttl(self):
+        self.files.files[app.get_filename(1)] = (make_predictions(7, 60), 'etag')
+        for i in range(3):
+            response = self.client.get('/api/v1.0/1/7')
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.files.reads, 2)
+
+        # Once the snapshot is validated again, it is found
+        self.files.files[app.SNAPSHOT_FILENAME] = \
+            ({'version': app.PREDICTION_FORMAT_VERSION, 'publishedTime': time.time(),
+              'predictions': {'1': make_predictions(8, 60)}}, 'etag')
+        app.prediction_cache[app.SNAPSHOT_FILENAME]['validated_time'] -= app.PREDICTION_CACHE_TTL_SECONDS
+        self.assertEqual(self.client.get('/api/v1.0/1/7').status_code, 404)
+        self.assertEqual(self.client.get('/api/v1.0/1/8').status_code, 200)
+
+if __name__ == '__main__':
+    unittest.main()
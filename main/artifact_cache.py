@@ -0,0 +1,114 @@
+import os
+import threading
+from collections import OrderedDict
+
+# Preprocessed artifacts (KD-trees, nearest-ping tables) are reused by many live
+# trips of the same route, so each process keeps the most recently used ones in
+# memory, within a budget. Artifacts are measured by the size of their file.
+MEMORY_BUDGET = int(os.environ.get('ARTIFACT_CACHE_MEMORY_MB', 64)) * 2**20
+# The files of the artifacts of trips in preprocessed/ are capped too. When they take
+# more than the budget, the least recently used ones (by modification time, which is
+# refreshed on every read) are deleted until they take less than DISK_EVICTION_TARGET of it.
+# The files of routes (route indices, stop sequence indices, candidate timelines) are
+# kept in memory for as long as a process runs, so they are never evicted.
+DISK_BUDGET = int(os.environ.get('ARTIFACT_CACHE_DISK_MB', 2048)) * 2**20
+DISK_EVICTION_TARGET = 0.9
+EVICTABLE_PREFIXES = ('kdtree-pings-', 'nearest-pings-')
+
+class ArtifactCache:
+    def __init__(self, path='preprocessed', memory_budget=MEMORY_BUDGET, disk_budget=DISK_BUDGET,
+                 evictable_prefixes=EVICTABLE_PREFIXES):
+        self.path = path
+        self.evictable_prefixes = evictable_prefixes
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        # (filename, version) -> (artifact, size). The version of the artifact's format
+        # is part of the key, so entries of an older format are never served.
+        self.entries = OrderedDict()
+        self.memory_size = 0
+        self.disk_size = None # Measured on first store
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'disk_evictions': 0}
+        # Artifacts may be loaded by several threads at once (see trip_predictor)
+        self.lock = threading.RLock()
+
+    # Get the artifact saved in filename with the given format version, reading it
+    # with read_function(filename) if it is not in memory. Errors of read_function
+    # (e.g. IOError for a missing file) are raised and nothing is cached.
+    def load(self, filename, version, read_function):
+        key = (filename, version)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return self.entries[key][0]
+            self.stats['misses'] += 1
+        artifact = read_function(filename)
+        try:
+            os.utime(filename) # Mark it as recently used on disk
+            self.add(key, artifact, os.path.getsize(filename))
+        except OSError: # Evicted by another process meanwhile
+            pass
+        return artifact
+
+    # Keep an artifact that was just saved in filename
+    def store(self, filename, version, artifact):
+        size = os.path.getsize(filename)
+        self.add((filename, version), artifact, size)
+        with self.lock:
+            if self.disk_size is None:
+                self.disk_size = self.measure_disk()
+            else:
+                self.disk_size += size
+            if self.disk_size > self.disk_budget:
+                self.evict_disk()
+
+    def add(self, key, artifact, size):
+        with self.lock:
+            if key in self.entries:
+                self.memory_size -= self.entries.pop(key)[1]
+            self.entries[key] = (artifact, size)
+            self.memory_size += size
+            while self.memory_size > self.memory_budget and len(self.entries) > 1:
+                self.memory_size -= self.entries.popitem(last=False)[1][1]
+                self.stats['evictions'] += 1
+
+    # Sizes and modification times of the files of trip artifacts in the store
+    # (except temporary files that are still being written)
+    def list_files(self):
+        files = []
+        for filename in os.listdir(self.path):
+            full_filename = os.path.join(self.path, filename)
+            if not filename.startswith(self.evictable_prefixes) or not os.path.isfile(full_filename):
+                continue
+            try:
+                stat = os.stat(full_filename)
+            except OSError: # Deleted by another process meanwhile
+                continue
+            files.append((stat.st_mtime, stat.st_size, full_filename))
+        return files
+
+    def measure_disk(self):
+        return sum(size for mtime, size, filename in self.list_files())
+
+    # Delete the least recently used files until they fit DISK_EVICTION_TARGET of the budget
+    def evict_disk(self):
+        files = sorted(self.list_files())
+        self.disk_size = sum(size for mtime, size, filename in files)
+        for mtime, size, filename in files:
+            if self.disk_size <= self.disk_budget * DISK_EVICTION_TARGET:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            self.disk_size -= size
+            self.stats['disk_evictions'] += 1
+
+    def get_stats(self):
+        return dict(self.stats,
+                    entries=len(self.entries),
+                    memory_size=self.memory_size,
+                    memory_budget=self.memory_budget)
+
+# The cache of this process
+artifact_cache = ArtifactCache()
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import time
+from clean_data import IncrementalCleaner, clean_rep, clean_rep_rows
+from constants import COLUMN_NAMES_PINGS
+from datetime import datetime
+from projection import p, project
+
+# Make the pings of a synthetic trip, with the kinds of noise clean_rep removes:
+# GPS jitter (sharp zigzags), jumps (impossible speeds) and gaps in time.
+# Without gaps, there is a ping every 10s, no jumps, and the steps and jitter
+# are small enough that the trip is not split at all.
+def make_trip_pings(number_of_pings, seed=0, trip_id=1, start_time=datetime(2017, 7, 6, 9, 0, 0), gaps=True):
+    random = np.random.RandomState(seed)
+    intervals = random.choice([5, 10, 10, 10, 15, 20], size=number_of_pings) \
+        + 30 * (random.rand(number_of_pings) < 0.02) if gaps else np.full(number_of_pings, 10)
+    noise = 1 if gaps else 0.25
+    steps = random.normal(0, 0.0004 * noise, size=(number_of_pings, 2)) + [0.0003, 0.0002]
+    jitter = random.normal(0, 0.0003 * noise, size=(number_of_pings, 2)) \
+        * (random.rand(number_of_pings, 1) < 0.2)
+    jumps = random.normal(0, 0.02, size=(number_of_pings, 2)) \
+        * (random.rand(number_of_pings, 1) < (0.02 if gaps else 0))
+    lat_lng = [1.3, 103.8] + np.cumsum(steps, axis=0) + jitter + jumps
+    times = pd.date_range(start_time, periods=1, tz='Asia/Singapore')[0] \
+        + pd.to_timedelta(np.cumsum(intervals), unit='s')
+    trip_pings = pd.DataFrame({'id': np.arange(1, number_of_pings + 1),
+                               'lng': lat_lng[:, 1],
+                               'lat': lat_lng[:, 0],
+                               'time': times,
+                               'tripId': trip_id},
+                              columns=COLUMN_NAMES_PINGS)
+    return trip_pings.set_index('id')
+
+# Returns the average number of seconds each call of function takes
+def time_function(function, repeat=3):
+    start_time = time.time()
+    for i in range(repeat):
+        function()
+    return (time.time() - start_time) / repeat
+
+def benchmark_clean_rep(numbers_of_pings=[500, 2000, 8000]):
+    for number_of_pings in numbers_of_pings:
+        trip_pings = make_trip_pings(number_of_pings)
+        rows_seconds = time_function(lambda: clean_rep_rows(trip_pings))
+        arrays_seconds = time_function(lambda: clean_rep(trip_pings))
+        print('clean_rep with {} pings: {:.4f}s row-by-row, {:.4f}s array-based ({:.1f}x)'
+              .format(number_of_pings, rows_seconds, arrays_seconds, rows_seconds / arrays_seconds))
+
+# Clean a live trip every cycle, as new pings arrive (6 per cycle ~= 1 per 10s),
+# with and without gaps (without them, the trip is one part from start to end)
+def benchmark_incremental_cleaner(number_of_pings=3000, pings_per_cycle=6):
+    for gaps in [True, False]:
+        trip_pings = make_trip_pings(number_of_pings, gaps=gaps)
+        prefixes = [trip_pings.iloc[:n] for n in range(pings_per_cycle, number_of_pings + 1, pings_per_cycle)]
+        full_seconds = time_function(lambda: [clean_rep(prefix) for prefix in prefixes], repeat=1)
+        cleaner = IncrementalCleaner()
+        incremental_seconds = time_function(lambda: [cleaner.update(prefix) for prefix in prefixes], repeat=1)
+        print('{} cycles of a {} ping trip ({}): {:.2f}s with clean_rep, {:.2f}s incrementally ({:.1f}x)'
+              .format(len(prefixes), number_of_pings, 'with gaps' if gaps else 'without gaps',
+                      full_seconds, incremental_seconds, full_seconds / incremental_seconds))
+
+# Project the pings of a trip one by one (as the KD-trees used to) and in one call
+def benchmark_projection(numbers_of_pings=[500, 2000, 8000]):
+    for number_of_pings in numbers_of_pings:
+        trip_pings = make_trip_pings(number_of_pings)
+        cleaned_trip_pings = list(trip_pings.itertuples())
+        per_point_seconds = time_function(lambda: [p(ping.lng, ping.lat) for ping in cleaned_trip_pings])
+        batch_seconds = time_function(lambda: project(trip_pings.lat.values, trip_pings.lng.values))
+        print('Projecting {} pings: {:.4f}s per point, {:.4f}s in one call ({:.1f}x)'
+              .format(number_of_pings, per_point_seconds, batch_seconds, per_point_seconds / batch_seconds))
+
+if __name__ == '__main__':
+    benchmark_clean_rep()
+    benchmark_incremental_cleaner()
+    benchmark_projection()
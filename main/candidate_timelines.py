@@ -0,0 +1,86 @@
+from db_logic import get_tripstops_of_trips
+from ping_locator import list_of_nearest_pings_to_tripstops
+from route_index import is_completed_trip
+from save_and_load_variables import load_or_update_route_index, read_versioned_pickle, write_versioned_pickle
+from trip_context import TripContext, get_shared_context
+from utility import is_sorted
+
+CANDIDATE_TIMELINES_VERSION = 1
+
+get_candidate_timelines_filename = lambda route_id: \
+    'preprocessed/candidate-timelines-{}.pickle'.format(route_id)
+
+# Get the times of the nearest pings to the tripstops of a trip (its arrival timeline),
+# or None if the trip cannot be a candidate for predictions: it has no cleaned pings,
+# a tripstop without a nearest ping, or nearest pings out of order.
+def get_trip_timeline(trip_id, date_time, number_of_tripstops, context=None):
+    context = context or TripContext(trip_id, date_time)
+    if len(context.cleaned_pings) == 0:
+        return None
+    sorted_tripstop_to_nearest_ping = \
+        list_of_nearest_pings_to_tripstops(trip_id, date_time=date_time, context=context)
+    # Check that there is a nearest ping at every tripstop
+    if len(sorted_tripstop_to_nearest_ping) != number_of_tripstops:
+        return None
+    nearest_ping_timing_per_tripstop = \
+        [ping_time for tripstop_id, ping_id, ping_time, ping_lat, ping_lng in sorted_tripstop_to_nearest_ping]
+    # Check that the timings of the nearest pings is sorted
+    if not is_sorted(nearest_ping_timing_per_tripstop):
+        return None
+    return nearest_ping_timing_per_tripstop
+
+# The timelines of the completed past trips of a route, validated once when the trip
+# is added, so that the trips that can never be candidates are not checked again by
+# every prediction. Invalid trips have a timeline of None.
+class CandidateTimelines:
+    def __init__(self, route_id, timelines=None):
+        self.route_id = route_id
+        # trip_id -> arrival timeline, or None
+        self.timelines = timelines or {}
+
+    # Keep only the given completed trips, and validate those that are not added yet
+    # (with their context from contexts, see get_shared_context).
+    # Returns True if the timelines changed.
+    def update(self, trip_ids, date_time, contexts=None):
+        contexts = {} if contexts is None else contexts
+        trip_ids = set(trip_ids)
+        added_trip_ids = sorted(trip_ids - set(self.timelines))
+        removed_trip_ids = set(self.timelines) - trip_ids
+        if added_trip_ids:
+            tripstops = get_tripstops_of_trips(added_trip_ids)
+            number_of_tripstops_per_trip = tripstops.groupby('tripId').size() if len(tripstops) > 0 else {}
+            for trip_id in added_trip_ids:
+                self.timelines[trip_id] = get_trip_timeline(trip_id, date_time,
+                                                            int(number_of_tripstops_per_trip.get(trip_id, 0)),
+                                                            get_shared_context(contexts, trip_id, date_time))
+        for trip_id in removed_trip_ids:
+            del self.timelines[trip_id]
+        return bool(added_trip_ids or removed_trip_ids)
+
+    # Whether trip_id was validated (completed trips only)
+    is_validated = lambda self, trip_id: trip_id in self.timelines
+
+    get_timeline = lambda self, trip_id: self.timelines.get(trip_id)
+
+    def save(self):
+        write_versioned_pickle(get_candidate_timelines_filename(self.route_id), self.timelines,
+                               CANDIDATE_TIMELINES_VERSION)
+
+    @classmethod
+    def load(cls, route_id):
+        return cls(route_id, read_versioned_pickle(get_candidate_timelines_filename(route_id),
+                                                   CANDIDATE_TIMELINES_VERSION))
+
+# Candidate timelines loaded by this process
+candidate_timelines_per_route = {}
+
+# Get the timelines of the completed trips among past_trips (a dataframe from
+# get_past_trips_of_route), updating and saving them if trips were added or dropped.
+# contexts are the TripContexts shared with the other indices of the route (see get_shared_context).
+def get_candidate_timelines(route_id, past_trips, date_time, contexts=None):
+    completed_trip_ids = [int(trip_id) for trip_id, trip_date in zip(past_trips.index, past_trips.date)
+                          if is_completed_trip(trip_date, date_time)]
+    return load_or_update_route_index(
+        candidate_timelines_per_route, route_id, CandidateTimelines, get_candidate_timelines_filename(route_id),
+        lambda candidate_timelines: set(completed_trip_ids) == set(candidate_timelines.timelines),
+        lambda candidate_timelines: candidate_timelines.update(completed_trip_ids, date_time, contexts))
@@ -1,8 +1,13 @@
+import collections
+import copy
+import numpy as np
 import pandas
-from datetime import datetime, timedelta
-from db_logic import get_pings
-from trip_helper import get_bearings, get_distances, get_speeds, get_intervals
-from utility import flatten
+from datetime import timedelta
+from trip_helper import (
+    get_bearings, get_distances, get_speeds, get_intervals,
+    get_bearings_array, get_intervals_array, get_ping_arrays, get_speeds_array
+)
+from utility import flatten, latlng_bearing, latlng_distance
 
 # From trip_pings, return Trip pings with dirty pings removed
 get_cleaned_trip_pings = lambda trip_pings: flatten(clean_rep(trip_pings))
@@ -87,7 +92,8 @@ def smoothen_trip(trip_pings_parts):
     return trip_pings_parts
 
 # Take trip pings and remove anomalous pings.
-def clean_rep(trip_pings):
+# This is the row-by-row implementation; clean_rep gives the same result faster.
+def clean_rep_rows(trip_pings):
     if len(trip_pings) == 0:
         return []
     
@@ -103,10 +109,361 @@ def clean_rep(trip_pings):
 
     return trip_pings_parts
 
-# Check if the pings by a trip violates any condition for prediction.
-def check_rep(trip_id, date_time=datetime.now()):
-    trip_pings = get_pings(trip_id=trip_id, newest_datetime=date_time)
-    trip_pings_parts = clean_rep(trip_pings)
+########################
+# Array-based cleaning #
+########################
+# The pings are held as contiguous lat, lng and time arrays (see get_ping_arrays),
+# and each trip part is an array of positions into them, so splits are slices.
+# NumPy's trigonometric functions may differ from the math module in the last bit,
+# so any value within ROUNDING_TOLERANCE of a threshold is recomputed with the
+# scalar functions used by clean_rep_rows. This keeps every decision identical.
+ROUNDING_TOLERANCE = 1e-9
+
+# For each consecutive pair of bearings along the part, check if it is a sharp turn
+def get_sharp_turns(lat, lng, part):
+    bearings = get_bearings_array(lat[part], lng[part])
+    deltas = bearings[1:] - bearings[:-1]
+    deltas = np.where(deltas > 180, deltas - 360, np.where(deltas < -180, deltas + 360, deltas))
+    sharp_turns = np.abs(deltas) > 120
+    for k in np.flatnonzero(np.abs(np.abs(deltas) - 120) <= ROUNDING_TOLERANCE * 120):
+        a, b, c = part[k], part[k+1], part[k+2]
+        sharp_turns[k] = is_sharp_turn(latlng_bearing((lat[a], lng[a]), (lat[b], lng[b])),
+                                       latlng_bearing((lat[b], lng[b]), (lat[c], lng[c])))
+    return sharp_turns
+
+# Get the speeds along the part, with speeds close to MAX_SPEED computed exactly
+def get_speeds_of_part(lat, lng, time, part):
+    speeds = get_speeds_array(lat[part], lng[part], time[part])
+    for k in np.flatnonzero(np.abs(speeds - MAX_SPEED) <= ROUNDING_TOLERANCE * MAX_SPEED):
+        a, b = part[k], part[k+1]
+        interval = (time[b] - time[a]) / 1e6
+        distance = latlng_distance((lat[a], lng[a]), (lat[b], lng[b]))
+        speeds[k] = distance / interval if interval > 0 else 0
+    return speeds
+
+# Concatenate the parts into one array of positions, and mark which consecutive
+# pairs of positions belong to the same part. This lets each pass compute its
+# criteria for all parts with one vectorised call.
+def join_parts(trip_pings_parts):
+    positions = np.concatenate(trip_pings_parts)
+    same_part = np.ones(max(len(positions) - 1, 0), dtype=bool)
+    part_ends = np.cumsum([len(part) for part in trip_pings_parts])[:-1]
+    same_part[part_ends - 1] = False
+    return positions, same_part
+
+# Same as one iteration of the loop in smoothen_trip: at index i of trip_pings_part
+# (a list of positions), remove the 2nd and/or 3rd of the pings i-3, i-2, i-1, i.
+def remove_sharp_turn(lat, lng, trip_pings_part, i):
+    bearing = lambda a, b: latlng_bearing((lat[a], lng[a]), (lat[b], lng[b]))
+    first, second, third, fourth = trip_pings_part[i-3:i+1]
+    abs_delta_angle_removed_second = abs(delta_angle(bearing(first, third), bearing(third, fourth)))
+    abs_delta_angle_removed_third = abs(delta_angle(bearing(first, second), bearing(second, fourth)))
+    if abs_delta_angle_removed_third < min(abs_delta_angle_removed_second, 90):
+        del trip_pings_part[i-1]
+    elif abs_delta_angle_removed_second < min(abs_delta_angle_removed_third, 90):
+        del trip_pings_part[i-2]
+    else:
+        del trip_pings_part[i-2:i]
+
+# Same as smoothen_trip for one part, given the indices i (in increasing order)
+# where the bearings at i-3, i-2, i-1 make two consecutive sharp turns.
+# As in smoothen_trip, the bearings are those from before any ping is removed.
+def smoothen_part(lat, lng, part, sharp_turn_indices):
+    trip_pings_part = part.tolist()
+    for i in sharp_turn_indices:
+        if i >= len(trip_pings_part):
+            break
+        remove_sharp_turn(lat, lng, trip_pings_part, i)
+    return np.array(trip_pings_part, dtype=np.int64)
+
+# Same as smoothen_trip; only the parts with consecutive sharp turns are visited
+def smoothen_parts(lat, lng, trip_pings_parts):
+    if len(trip_pings_parts) == 0:
+        return []
+    positions, same_part = join_parts(trip_pings_parts)
+    sharp_turns = get_sharp_turns(lat, lng, positions) & same_part[:-1] & same_part[1:]
+    sharp_turn_positions = np.flatnonzero(sharp_turns[:-1] & sharp_turns[1:])
+    part_starts = np.cumsum([0] + [len(part) for part in trip_pings_parts])
+    part_indices = np.searchsorted(part_starts, sharp_turn_positions, side='right') - 1
+    trip_pings_parts = list(trip_pings_parts)
+    for j in np.unique(part_indices).tolist():
+        sharp_turn_indices = sharp_turn_positions[part_indices == j] - part_starts[j] + 3
+        trip_pings_parts[j] = smoothen_part(lat, lng, trip_pings_parts[j], sharp_turn_indices.tolist())
+    return trip_pings_parts
+
+# Same as split_trip_by_criteria, where criteria_function takes an array of
+# positions and returns the criteria between each consecutive pair of them.
+def split_parts(trip_pings_parts, criteria_function, threshold_value):
+    if len(trip_pings_parts) == 0:
+        return []
+    positions, same_part = join_parts(trip_pings_parts)
+    split_positions = \
+        np.flatnonzero((criteria_function(positions) >= threshold_value) | ~same_part) + 1
+    starts = [0] + split_positions.tolist()
+    ends = split_positions.tolist() + [len(positions)]
+    return [positions[start:end] for start, end in zip(starts, ends) if end - start > 2]
+
+# Take the ping arrays and return the parts (as arrays of positions) left after cleaning
+def clean_rep_indices(lat, lng, time):
+    trip_pings_parts = [np.arange(len(lat))] if len(lat) > 0 else []
+    get_speeds_of_positions = lambda positions: get_speeds_of_part(lat, lng, time, positions)
+    get_intervals_of_positions = lambda positions: get_intervals_array(time[positions])
+    for i in range(5):
+        trip_pings_parts = smoothen_parts(lat, lng, trip_pings_parts)
+        trip_pings_parts = split_parts(trip_pings_parts, get_speeds_of_positions, MAX_SPEED)
+        trip_pings_parts = split_parts(trip_pings_parts, get_intervals_of_positions, MAX_TIME)
+    return trip_pings_parts
+
+# Take trip pings and remove anomalous pings.
+# Returns the same parts of pings (as named tuples) as clean_rep_rows.
+def clean_rep(trip_pings):
+    if len(trip_pings) == 0:
+        return []
+
+    trip_pings_rows = list(trip_pings.itertuples())
+    lat, lng, time = get_ping_arrays(trip_pings)
+    return [[trip_pings_rows[i] for i in part.tolist()]
+            for part in clean_rep_indices(lat, lng, time)]
+
+######################################
+# Incremental cleaning of a live trip #
+######################################
+# Keeps the cleaning state of a live trip between cycles, so each update only
+# examines the pings that arrived since the last one, and gives the same parts
+# as clean_rep on all the pings so far.
+#
+# Each of the 15 steps of clean_rep (the smoothing, the split by speed and the
+# split by time of its 5 passes) goes through its parts from start to end, and
+# what it does at a ping only depends on the pings before it and the next one.
+# So the steps are chained as streams of positions, where END_OF_PART ends a part.
+# Each step keeps its state between updates, is fed what the step before it can
+# no longer change, and passes on what it can no longer change itself. The few
+# pings that are not final yet (at most a couple per step) go through copies of
+# the states on every update, as if the trip ended there.
+END_OF_PART = -1
+
+# Split a stream of positions into (positions, whether END_OF_PART follows them)
+def split_stream(stream):
+    positions = []
+    for position in stream:
+        if position == END_OF_PART:
+            yield positions, True
+            positions = []
+        else:
+            positions.append(position)
+    if positions:
+        yield positions, False
+
+# The loop of smoothen_trip as a step: the bearings are those of the part as it
+# is fed, and the iteration at index i can only remove the pings at i-1 and i-2.
+class SmoothingStep:
+    def __init__(self):
+        self.start_part()
+
+    def start_part(self):
+        # The last 2 positions fed in the part, to find the sharp turns of the next ones
+        self.last_positions = []
+        # Whether the bearings at k and k+1 make a sharp turn, and the position at k
+        # of the part left by the smoothing so far, from k = offset (i-3) on
+        self.offset = 0
+        self.sharp_turns = []
+        self.smoothed = []
+        self.i = 3
+        # Number of positions of the part that were passed on
+        self.number_passed = 0
+
+    def copy(self):
+        step = copy.copy(self)
+        step.last_positions = list(self.last_positions)
+        step.sharp_turns = list(self.sharp_turns)
+        step.smoothed = list(self.smoothed)
+        return step
+
+    def feed(self, lat, lng, time, stream):
+        output = []
+        for positions, ends_part in split_stream(stream):
+            if positions:
+                self.smoothen(lat, lng, positions, output)
+            if ends_part:
+                output += self.smoothed[self.number_passed - self.offset:]
+                if self.last_positions:
+                    output.append(END_OF_PART)
+                self.start_part()
+        return output
+
+    def smoothen(self, lat, lng, positions, output):
+        fed_positions = np.array(self.last_positions + positions, dtype=np.int64)
+        self.sharp_turns += get_sharp_turns(lat, lng, fed_positions).tolist()
+        self.last_positions = fed_positions[-2:].tolist()
+        self.smoothed += positions
+
+        i, offset = self.i, self.offset
+        while i < offset + len(self.smoothed):
+            if self.sharp_turns[i-3-offset] and self.sharp_turns[i-2-offset]:
+                remove_sharp_turn(lat, lng, self.smoothed, i - offset)
+            i += 1
+        self.i = i
+
+        number_final = min(i - 2, offset + len(self.smoothed))
+        output += self.smoothed[self.number_passed - offset:number_final - offset]
+        self.number_passed = number_final
+        # Only the positions from i-3 on are used by the next iterations
+        if i - 3 > offset:
+            del self.sharp_turns[:i-3-offset]
+            del self.smoothed[:i-3-offset]
+            self.offset = i - 3
+
+    # Pass on the rest, as if the stream ended after stream
+    def finish(self, lat, lng, time, stream):
+        return self.copy().feed(lat, lng, time, stream + [END_OF_PART])
+
+# The split of split_trip_by_criteria as a step, where criteria_function takes
+# the ping arrays and an array of positions, and returns the criteria between
+# each consecutive pair of them.
+class SplittingStep:
+    def __init__(self, criteria_function, threshold_value):
+        self.criteria_function = criteria_function
+        self.threshold_value = threshold_value
+        self.start_part()
+
+    def start_part(self):
+        self.last_position = None
+        # The first positions of the current part, held back until there are 3
+        # of them (shorter parts are dropped), after which they are passed on
+        self.held_positions = []
+        self.is_passing = False
+
+    def copy(self):
+        step = copy.copy(self)
+        step.held_positions = list(self.held_positions)
+        return step
+
+    def end_part(self, output):
+        if self.is_passing:
+            output.append(END_OF_PART)
+        self.start_part()
+
+    def feed(self, lat, lng, time, stream):
+        output = []
+        positions = ([] if self.last_position is None else [self.last_position]) \
+            + [position for position in stream if position != END_OF_PART]
+        criteria = self.criteria_function(lat, lng, time, np.array(positions, dtype=np.int64)).tolist() \
+            if len(positions) > 1 else []
+        # criteria[k] is between the position at k and the next one in positions
+        k = -1 if self.last_position is None else 0
+        for position in stream:
+            if position == END_OF_PART:
+                self.end_part(output)
+                continue
+            if self.last_position is not None and criteria[k] >= self.threshold_value:
+                self.end_part(output)
+            if self.is_passing:
+                output.append(position)
+            else:
+                self.held_positions.append(position)
+                if len(self.held_positions) == 3:
+                    output += self.held_positions
+                    self.held_positions = []
+                    self.is_passing = True
+            self.last_position = position
+            k += 1
+        return output
+
+    # Pass on the rest, as if the stream ended after stream
+    def finish(self, lat, lng, time, stream):
+        return self.copy().feed(lat, lng, time, stream + [END_OF_PART])
+
+get_intervals_of_part = lambda lat, lng, time, positions: get_intervals_array(time[positions])
+
+get_cleaning_steps = lambda: [step for i in range(5) for step in [
+    SmoothingStep(),
+    SplittingStep(get_speeds_of_part, MAX_SPEED),
+    SplittingStep(get_intervals_of_part, MAX_TIME),
+]]
+
+class IncrementalCleaner:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.ping_ids = []
+        self.rows = []
+        self.lat = np.zeros(0)
+        self.lng = np.zeros(0)
+        self.time = np.zeros(0, dtype=np.int64)
+        self.steps = get_cleaning_steps()
+        # Parts that the steps passed on: those that ended, and the start of the next one
+        self.final_rows_parts = []
+        self.final_rows_part = []
+        # The rest of the parts, as if the trip ended at its latest ping
+        self.trailing_rows_parts = []
+
+    # Same as clean_rep on all the pings given to update so far
+    @property
+    def cleaned_pings_parts(self):
+        return self.final_rows_parts + self.trailing_rows_parts
+
+    # Take all the trip pings so far (sorted by time, as from get_pings) and
+    # clean the ones that are new. If older pings changed, start over.
+    def update(self, trip_pings):
+        ping_ids = trip_pings.index.tolist()
+        if ping_ids[:len(self.ping_ids)] != self.ping_ids:
+            self.reset()
+        new_pings = trip_pings.iloc[len(self.ping_ids):]
+        if len(new_pings) > 0:
+            self.append(new_pings)
+        return self
+
+    def append(self, new_pings):
+        number_of_known_pings = len(self.ping_ids)
+        self.ping_ids += new_pings.index.tolist()
+        self.rows += list(new_pings.itertuples())
+        lat, lng, time = get_ping_arrays(new_pings)
+        self.lat = np.concatenate([self.lat, lat])
+        self.lng = np.concatenate([self.lng, lng])
+        self.time = np.concatenate([self.time, time])
+
+        final_stream = list(range(number_of_known_pings, len(self.lat)))
+        trailing_stream = []
+        for step in self.steps:
+            final_stream = step.feed(self.lat, self.lng, self.time, final_stream)
+            trailing_stream = step.finish(self.lat, self.lng, self.time, trailing_stream)
+
+        for position in final_stream:
+            if position == END_OF_PART:
+                self.final_rows_parts.append(self.final_rows_part)
+                self.final_rows_part = []
+            else:
+                self.final_rows_part.append(self.rows[position])
+        trailing_rows_parts = [list(self.final_rows_part)]
+        for position in trailing_stream:
+            if position == END_OF_PART:
+                trailing_rows_parts.append([])
+            else:
+                trailing_rows_parts[-1].append(self.rows[position])
+        self.trailing_rows_parts = [part for part in trailing_rows_parts if part]
+
+# Cleaners of the live trips in this process, least recently used first
+MAX_INCREMENTAL_CLEANERS = 500
+incremental_cleaners = collections.OrderedDict()
+
+def get_incremental_cleaner(trip_id):
+    cleaner = incremental_cleaners.pop(trip_id, None) or IncrementalCleaner()
+    incremental_cleaners[trip_id] = cleaner
+    while len(incremental_cleaners) > MAX_INCREMENTAL_CLEANERS:
+        incremental_cleaners.popitem(last=False)
+    return cleaner
+
+# Predictions are not made from pings older than this
+MAX_LATEST_PING_AGE = timedelta(minutes=5)
+
+is_latest_ping_too_old = lambda ping_time, date_time: \
+    date_time - ping_time.replace(tzinfo=None) >= MAX_LATEST_PING_AGE
+
+# Check if the pings by a trip (given its TripContext) violates any condition for prediction.
+def check_rep(context):
+    date_time = context.date_time
+    trip_pings_parts = context.cleaned_pings_parts
 
     if len(trip_pings_parts) == 0:
         return 'No prediction: No trip pings at all'
@@ -114,7 +471,7 @@ def check_rep(trip_id, date_time=datetime.now()):
     if len(trip_pings_parts[-1]) < 3:
         return 'No prediction: Insufficient latest trip pings for prediction'
 
-    if date_time - trip_pings_parts[-1][-1].time.replace(tzinfo=None) >= timedelta(minutes=5):
+    if is_latest_ping_too_old(trip_pings_parts[-1][-1].time, date_time):
         return 'No prediction: The latest ping is more than 5 minutes from now; prediction will be inaccurate'
 
     return 'Can predict'
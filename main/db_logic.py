@@ -3,20 +3,139 @@ import os
 import pandas as pd
 import pickle
 import psycopg2
+import psycopg2.pool
 import pytz
+import threading
+import time
 from constants import (
     COLUMN_NAMES_PINGS, COLUMN_NAMES_ROUTES, COLUMN_NAMES_STOPS,
     COLUMN_NAMES_TRIPS, COLUMN_NAMES_TRIPSTOPS
 )
 from datetime import datetime, timedelta
 from os.path import join, dirname
+from projection import add_projected_coordinates
 from utility import flatten
 
 DATABASE_URL = os.environ.get('DATABASE_URL')
 
-def reset_connection():
+# Connections are pooled per process. A pool inherited through fork()
+# (e.g. by multiprocessing workers) is discarded and rebuilt in the child,
+# since a libpq connection must never be shared between processes.
+POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 4))
+POOL_TIMEOUT = 30 # Seconds to wait for a free connection before giving up
+
+# Open a new connection with the session time zone already set
+def connect():
     conn = psycopg2.connect(DATABASE_URL)
-    cursor = conn.cursor()
+    with conn.cursor() as cursor:
+        cursor.execute("SET TIME ZONE 'Singapore';")
+    conn.commit()
+    return conn
+
+class ConnectionPool:
+    def __init__(self, connect_function=connect, max_size=POOL_SIZE):
+        self.connect_function = connect_function
+        self.max_size = max_size
+        self.pid = os.getpid()
+        self.idle = []
+        self.size = 0
+        self.condition = threading.Condition()
+        self.stats = {'connections_opened': 0, 'connections_closed': 0,
+                      'checkouts': 0, 'queries': 0,
+                      'total_wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+
+    def getconn(self, timeout=POOL_TIMEOUT):
+        start_time = time.time()
+        with self.condition:
+            while not self.idle and self.size >= self.max_size:
+                remaining = timeout - (time.time() - start_time)
+                if remaining <= 0:
+                    raise psycopg2.pool.PoolError('Timed out waiting for a database connection.')
+                self.condition.wait(remaining)
+            conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                self.size += 1
+        if conn is None:
+            try:
+                conn = self.connect_function()
+            except:
+                with self.condition:
+                    self.size -= 1
+                    self.condition.notify()
+                raise
+            with self.condition:
+                self.stats['connections_opened'] += 1
+        wait_seconds = time.time() - start_time
+        with self.condition:
+            self.stats['checkouts'] += 1
+            self.stats['total_wait_seconds'] += wait_seconds
+            self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], wait_seconds)
+        return conn
+
+    def putconn(self, conn, close=False, queries=0):
+        # End the read transaction so the connection is not left idle in transaction
+        if not close and not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                close = True
+        with self.condition:
+            self.stats['queries'] += queries
+            if close or conn.closed:
+                self.size -= 1
+                self.stats['connections_closed'] += 1
+            else:
+                self.idle.append(conn)
+            self.condition.notify()
+        if close and not conn.closed:
+            conn.close()
+
+    def closeall(self):
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.size -= len(idle)
+            self.stats['connections_closed'] += len(idle)
+        for conn in idle:
+            conn.close()
+
+    def get_stats(self):
+        with self.condition:
+            stats = dict(self.stats, size=self.size, idle=len(self.idle), max_size=self.max_size)
+        stats['average_wait_seconds'] = \
+            stats['total_wait_seconds'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
+
+_pool = None
+# Connections inherited from the parent process. They are kept referenced so
+# that garbage collection never closes them (closing would also terminate the
+# parent's session, which shares the same socket).
+_inherited_connections = []
+
+def get_pool():
+    global _pool
+    if _pool is not None and _pool.pid != os.getpid():
+        _inherited_connections.extend(_pool.idle)
+        _pool = None
+    if _pool is None:
+        _pool = ConnectionPool()
+    return _pool
+
+# Replace the process' pool, e.g. with one using a stand-in connect function
+def set_pool(pool):
+    global _pool
+    _pool = pool
+
+def get_pool_stats():
+    return get_pool().get_stats()
+
+# Number of queries issued by each thread, so that the queries of some work can be
+# counted while other threads issue theirs (see TripContext.memoize_query)
+thread_queries = threading.local()
+
+get_thread_query_count = lambda: getattr(thread_queries, 'count', 0)
+
+def reset_connection():
+    get_pool().closeall()
 
 # Helper function to convert results from SQL SELECT query to pandas dataframe
 def to_pandas(column_names, records):
@@ -26,11 +145,18 @@ def to_pandas(column_names, records):
 
 # Helper function to do SQL SELECT query
 def query(sql, data=(), column_names=[], pandas_format=True):
-    conn = psycopg2.connect(DATABASE_URL)
-    cursor = conn.cursor()
-    cursor.execute("SET TIME ZONE 'Singapore';")
-    cursor.execute(sql, data)
-    records = cursor.fetchall()
+    thread_queries.count = get_thread_query_count() + 1
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, data)
+            records = cursor.fetchall()
+    except psycopg2.Error:
+        # The connection may be broken, so do not hand it out again
+        pool.putconn(conn, close=True, queries=1)
+        raise
+    pool.putconn(conn, queries=1)
     # This returns a list of results (where results is represented as a tuple)
     if not pandas_format:
         return records
@@ -76,7 +202,7 @@ def get_stops(stop_id=None):
           .format('' if stop_id == None else 'WHERE id = %(stop_id)s')
     data = {'stop_id': 0 if stop_id == None else int(stop_id)}
     records = query(sql, data=data, column_names=COLUMN_NAMES_STOPS)
-    return records
+    return add_projected_coordinates(records)
 
 def get_tripstops(tripstop_id=None, trip_id=None):
     sql = """
@@ -99,8 +225,29 @@ def get_tripstops(tripstop_id=None, trip_id=None):
     records = query(sql,
                     data=data,
                     column_names=COLUMN_NAMES_TRIPSTOPS)
-    return records
+    return add_projected_coordinates(records)
 
+# Get the tripstops of many trips with one query
+def get_tripstops_of_trips(trip_ids):
+    sql = """
+          SELECT
+              ts.id, "tripId", "stopId", "canBoard", "canAlight", time,
+              ST_X(s.coordinates), ST_Y(s.coordinates)
+          FROM
+              stops AS s
+              INNER JOIN "tripStops" AS ts ON s.id = "stopId"
+          WHERE
+              "canBoard" = %(can_board)s
+              AND "tripId" = ANY(%(trip_ids)s)
+          ORDER BY
+              time
+          """
+    data = {'trip_ids': [int(trip_id) for trip_id in trip_ids],
+            'can_board': True}
+    records = query(sql,
+                    data=data,
+                    column_names=COLUMN_NAMES_TRIPSTOPS)
+    return add_projected_coordinates(records)
 
 def get_pings(ping_id=None, trip_id=None, newest_datetime=datetime.now()):
     sql = """
@@ -121,7 +268,53 @@ def get_pings(ping_id=None, trip_id=None, newest_datetime=datetime.now()):
     records = query(sql,
                     data=data,
                     column_names=COLUMN_NAMES_PINGS)
-    return records
+    return add_projected_coordinates(records)
+
+# Get the pings of many trips with one query per batch of trips,
+# partitioned by trip id. Every trip in trip_ids gets an entry,
+# which has the same format as get_pings(trip_id=trip_id).
+def get_pings_of_trips(trip_ids, newest_datetime=datetime.now(), batch_size=500):
+    trip_ids = [int(trip_id) for trip_id in trip_ids]
+    sql = """
+          SELECT
+              id, ST_X(coordinates), ST_Y(coordinates), time, "tripId"
+          FROM
+              pings
+          WHERE
+              time <= %(newest_datetime)s
+              AND "tripId" = ANY(%(trip_ids)s)
+          ORDER BY
+              time
+          """
+    batches = [query(sql,
+                     data={'trip_ids': trip_ids[i:i+batch_size],
+                           'newest_datetime': newest_datetime},
+                     column_names=COLUMN_NAMES_PINGS)
+               for i in range(0, len(trip_ids), batch_size)]
+    batches = [batch for batch in batches if len(batch) > 0]
+    pings = add_projected_coordinates(pd.concat(batches)) if batches else None
+    pings_per_trip = dict(list(pings.groupby('tripId'))) if batches else {}
+    empty_pings = add_projected_coordinates(pd.DataFrame(columns=COLUMN_NAMES_PINGS).set_index('id'))
+    return {trip_id: pings_per_trip.get(trip_id, empty_pings) for trip_id in trip_ids}
+
+# Get the id of the latest ping of each of the trips (that has pings),
+# to find the trips with new pings cheaply. Output format: {trip_id: ping_id}
+def get_latest_ping_ids(trip_ids, newest_datetime=datetime.now()):
+    sql = """
+          SELECT
+              "tripId", MAX(id)
+          FROM
+              pings
+          WHERE
+              time <= %(newest_datetime)s
+              AND "tripId" = ANY(%(trip_ids)s)
+          GROUP BY
+              "tripId"
+          """
+    data = {'trip_ids': [int(trip_id) for trip_id in trip_ids],
+            'newest_datetime': newest_datetime}
+    records = query(sql, data=data, pandas_format=False)
+    return dict(records)
 
 def get_past_trips_of_route(route_id, before_date=datetime.now()):
     after_date = before_date - timedelta(days=30)
@@ -143,6 +336,36 @@ def get_past_trips_of_route(route_id, before_date=datetime.now()):
     records = query(sql, data=data, column_names=COLUMN_NAMES_TRIPS)
     return records
 
+def get_trips_between(after_date, before_date):
+    sql = """
+          SELECT
+              id, date, "routeId"
+          FROM
+              trips
+          WHERE
+              date > %(after_date)s
+              AND date < %(before_date)s
+          ORDER BY
+              date DESC
+          """
+    data = {'after_date': after_date,
+            'before_date': before_date}
+    records = query(sql, data=data, column_names=COLUMN_NAMES_TRIPS)
+    return records
+
+def get_trips_of_ids(trip_ids):
+    sql = """
+          SELECT
+              id, date, "routeId"
+          FROM
+              trips
+          WHERE
+              id = ANY(%(trip_ids)s)
+          """
+    data = {'trip_ids': [int(trip_id) for trip_id in trip_ids]}
+    records = query(sql, data=data, column_names=COLUMN_NAMES_TRIPS)
+    return records
+
 def get_operating_trip_ids(date_time=datetime.now()):
     sql = """
           SELECT
@@ -159,6 +382,27 @@ def get_operating_trip_ids(date_time=datetime.now()):
     records = query(sql, data=data, column_names=['tripId'], pandas_format=False)
     return flatten(records)
 
+# Get the (tripId, first tripstop time, last tripstop time) of the trips with
+# tripstops between after_date and before_date, and an id above after_trip_id
+def get_trip_windows(after_date, before_date, after_trip_id=0):
+    sql = """
+          SELECT
+              "tripId", MIN(time), MAX(time)
+          FROM
+              "tripStops"
+          WHERE
+              "tripId" > %(trip_id)s
+          GROUP BY
+              "tripId"
+          HAVING
+              MAX(time) >= %(after_date)s
+              AND MIN(time) < %(before_date)s
+          """
+    data = {'trip_id': int(after_trip_id),
+            'after_date': after_date,
+            'before_date': before_date}
+    return query(sql, data=data, column_names=['tripId', 'start', 'end'], pandas_format=False)
+
 def get_offset(minutes=20):
     sql = """
           SELECT
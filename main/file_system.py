@@ -1,23 +1,58 @@
 import boto
 import boto.s3.connection
 import os
+import threading
+import time
 from boto.s3.key import Key
+from concurrent.futures import ThreadPoolExecutor, wait
 
 AWS_ACCESS_KEY_ID = os.environ.get("BUCKETEER_AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.environ.get("BUCKETEER_AWS_SECRET_ACCESS_KEY")
 BUCKET_NAME = os.environ.get("BUCKETEER_BUCKET_NAME")
+# Host (and port) of an S3-compatible stand-in to use instead of S3, e.g. localhost:9000
+ENDPOINT = os.environ.get("BUCKETEER_ENDPOINT")
+
+# Uploads run on UPLOAD_THREADS threads per process. Each is tried up to
+# UPLOAD_ATTEMPTS times, waiting UPLOAD_BACKOFF_SECONDS, then twice as long, etc.
+UPLOAD_THREADS = int(os.environ.get('UPLOAD_THREADS', 4))
+UPLOAD_ATTEMPTS = 3
+UPLOAD_BACKOFF_SECONDS = 0.5
 
 def get_connection_and_bucket():
-    conn = boto.s3.connect_to_region(
-               'us-east-1',
-               aws_access_key_id=AWS_ACCESS_KEY_ID,
-               aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-               is_secure=True,
-               calling_format = boto.s3.connection.OrdinaryCallingFormat(),
-           )
+    if ENDPOINT:
+        host, _, port = ENDPOINT.partition(':')
+        conn = boto.connect_s3(
+                   aws_access_key_id=AWS_ACCESS_KEY_ID,
+                   aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                   host=host, port=int(port) if port else None,
+                   is_secure=False,
+                   calling_format = boto.s3.connection.OrdinaryCallingFormat(),
+               )
+    else:
+        conn = boto.s3.connect_to_region(
+                   'us-east-1',
+                   aws_access_key_id=AWS_ACCESS_KEY_ID,
+                   aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                   is_secure=True,
+                   calling_format = boto.s3.connection.OrdinaryCallingFormat(),
+               )
     bucket = conn.get_bucket(BUCKET_NAME)
     return conn, bucket
 
+# The bucket is connected to once per thread (boto connections are not shared
+# between threads), and again in processes forked from this one.
+_connections = threading.local()
+
+def get_bucket():
+    if getattr(_connections, 'pid', None) != os.getpid():
+        _connections.pid = os.getpid()
+        _connections.bucket = get_connection_and_bucket()[1]
+    return _connections.bucket
+
+# Connect again on the next use, e.g. after a failed request
+def reset_bucket():
+    _connections.pid = None
+
 def split_filename(full_filename):
     if '/' not in full_filename:
         return full_filename
@@ -27,26 +62,111 @@ def split_filename(full_filename):
 
 def upload_file(full_filename):
     path, filename = split_filename(full_filename)
-    conn, bucket = get_connection_and_bucket()
     full_key_name = os.path.join(path, filename)
     print('Attempting to upload to {}'.format(full_key_name))
-    key = bucket.new_key(full_key_name)
-    key.set_contents_from_filename(full_key_name)
+    try:
+        key = get_bucket().new_key(full_key_name)
+        key.set_contents_from_filename(full_key_name)
+    except Exception:
+        reset_bucket()
+        raise
 
 def download_file(full_filename):
     path, filename = split_filename(full_filename)
-    conn, bucket = get_connection_and_bucket()
     full_key_name = os.path.join(path, filename)
     print('Attempting to download from {}'.format(full_key_name))
-    k = Key(bucket)
-    k.key = full_key_name
-    k.get_contents_to_filename(filename)
+    try:
+        k = Key(get_bucket())
+        k.key = full_key_name
+        k.get_contents_to_filename(filename)
+    except Exception:
+        reset_bucket()
+        raise
 
+# Delete all the files, 1000 per request
 def destroy_predictions():
-    conn, bucket = get_connection_and_bucket()
-    for key in bucket:
-        key.delete()
+    bucket = get_bucket()
+    bucket.delete_keys([key.name for key in bucket])
 
 def list_files(path):
-    conn, bucket = get_connection_and_bucket()
-    return [key.name for key in bucket]
+    return [key.name for key in get_bucket()]
+
+# Uploads files in the background on a bounded pool of threads, retrying with
+# backoff, so that predicting goes on while the files of earlier trips are uploaded.
+# A file that is submitted again before its upload started is uploaded once,
+# with its latest contents. flush() waits for the uploads and returns what they took.
+class Uploader:
+    def __init__(self, upload_function=upload_file, max_threads=UPLOAD_THREADS,
+                 max_attempts=UPLOAD_ATTEMPTS, backoff_seconds=UPLOAD_BACKOFF_SECONDS):
+        self.upload_function = upload_function
+        self.max_threads = max_threads
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.pid = os.getpid()
+        self.executor = ThreadPoolExecutor(max_workers=max_threads)
+        self.lock = threading.Lock()
+        # (filename, future of its upload) since the last flush, and the
+        # filenames whose upload has not started yet
+        self.futures = []
+        self.pending = set()
+
+    def submit(self, filename):
+        with self.lock:
+            if filename in self.pending:
+                return
+            self.pending.add(filename)
+            self.futures.append((filename, self.executor.submit(self.upload, filename)))
+
+    # Returns {'bytes', 'seconds', 'attempts', 'failed', 'finished_time'} of the upload of filename
+    def upload(self, filename):
+        with self.lock:
+            self.pending.discard(filename)
+        start_time = time.time()
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                size = os.path.getsize(filename)
+                self.upload_function(filename)
+                return {'bytes': size, 'seconds': time.time() - start_time, 'attempts': attempt, 'failed': False,
+                        'finished_time': time.time()}
+            except Exception as e:
+                print('Upload of {} failed (attempt {}): {}'.format(filename, attempt, e))
+                if attempt < self.max_attempts:
+                    time.sleep(self.backoff_seconds * 2 ** (attempt - 1))
+        return {'bytes': 0, 'seconds': time.time() - start_time, 'attempts': self.max_attempts, 'failed': True,
+                'finished_time': time.time()}
+
+    # Wait for the submitted uploads. Returns filename -> stats of its upload.
+    def flush(self):
+        with self.lock:
+            futures, self.futures = self.futures, []
+        wait([future for filename, future in futures])
+        # The stats of the last upload of each file
+        return {filename: future.result() for filename, future in futures}
+
+_uploader = None
+
+def get_uploader():
+    global _uploader
+    if _uploader is None:
+        _uploader = Uploader()
+    # The threads of an uploader inherited through fork() do not run in the child
+    elif _uploader.pid != os.getpid():
+        _uploader = Uploader(_uploader.upload_function, _uploader.max_threads,
+                             _uploader.max_attempts, _uploader.backoff_seconds)
+    return _uploader
+
+# Replace the process' uploader, e.g. with one using a stand-in upload function
+def set_uploader(uploader):
+    global _uploader
+    _uploader = uploader
+
+# Summarise the stats of uploads (from Uploader.flush)
+def get_upload_metrics(upload_stats):
+    stats = list(upload_stats)
+    seconds = [upload['seconds'] for upload in stats if not upload['failed']]
+    return {'uploads': len(stats),
+            'uploaded_bytes': sum(upload['bytes'] for upload in stats),
+            'failed_uploads': sum(upload['failed'] for upload in stats),
+            'retried_uploads': sum(upload['attempts'] > 1 for upload in stats),
+            'mean_upload_seconds': sum(seconds) / len(seconds) if seconds else 0.0,
+            'max_upload_seconds': max(seconds) if seconds else 0.0}
@@ -0,0 +1,79 @@
+import glob
+import numpy as np
+import os
+import re
+import sys
+from datetime import datetime
+from route_index import to_microseconds
+from save_and_load_variables import write_atomically
+from trip_context import TripContext
+
+# File format of the cleaned pings of a trip that its KD-tree is built from:
+# a 16-byte header (magic, format version, number of pings n), then the x, y of
+# the pings as one contiguous (n, 2) float64 block, then their times (int64
+# microseconds since epoch) and their ping ids (int64). The file is opened with a
+# read-only memory map, so processes reading the same file share its pages, and
+# the KD-tree is built straight on the mapped x, y, without copying them.
+KD_TREE_FILE_MAGIC = b'BKDT'
+KD_TREE_FILE_VERSION = 2
+HEADER_DTYPE = np.dtype([('magic', 'S4'), ('version', '<u4'), ('count', '<u8')])
+# Bytes per ping: x, y, time and ping id
+PING_SIZE = 32
+
+# Get the arrays of cleaned pings (rows with x, y, time and Index): (x_y, times, ping_ids)
+def get_ping_arrays(cleaned_trip_pings):
+    x_y = np.array([(ping.x, ping.y) for ping in cleaned_trip_pings], dtype='<f8').reshape(-1, 2)
+    times = to_microseconds([ping.time for ping in cleaned_trip_pings]) \
+        if len(cleaned_trip_pings) > 0 else np.zeros(0, dtype='<i8')
+    ping_ids = np.array([ping.Index for ping in cleaned_trip_pings], dtype='<i8')
+    return x_y, times, ping_ids
+
+def write_kd_tree_file(filename, ping_arrays):
+    x_y, times, ping_ids = ping_arrays
+    header = np.array([(KD_TREE_FILE_MAGIC, KD_TREE_FILE_VERSION, len(x_y))], dtype=HEADER_DTYPE)
+    write_atomically(filename, lambda f: f.write(header.tobytes() +
+                                                 np.ascontiguousarray(x_y, dtype='<f8').tobytes() +
+                                                 np.ascontiguousarray(times, dtype='<i8').tobytes() +
+                                                 np.ascontiguousarray(ping_ids, dtype='<i8').tobytes()))
+
+# Returns (x_y, times, ping_ids), mapped from the file.
+# Raises IOError if the file is missing, or ValueError if it is not
+# a KD-tree file of the current version.
+def read_kd_tree_file(filename):
+    with open(filename, 'rb') as f:
+        header = np.frombuffer(f.read(HEADER_DTYPE.itemsize), dtype=HEADER_DTYPE)
+    if len(header) == 0 or header[0]['magic'] != KD_TREE_FILE_MAGIC:
+        raise ValueError('{} is not a KD-tree file'.format(filename))
+    if header[0]['version'] != KD_TREE_FILE_VERSION:
+        raise ValueError('{} is not saved with version {}'.format(filename, KD_TREE_FILE_VERSION))
+    count = int(header[0]['count'])
+    if count == 0:
+        return np.zeros((0, 2), dtype='<f8'), np.zeros(0, dtype='<i8'), np.zeros(0, dtype='<i8')
+    if os.path.getsize(filename) < HEADER_DTYPE.itemsize + count * PING_SIZE:
+        raise ValueError('{} is truncated'.format(filename))
+    # One map of the whole file; the arrays are views of it
+    mapped = np.memmap(filename, dtype='<f8', mode='r', offset=HEADER_DTYPE.itemsize, shape=(4 * count,))
+    return (mapped[:2 * count].reshape(count, 2),
+            mapped[2 * count:3 * count].view('<i8'),
+            mapped[3 * count:].view('<i8'))
+
+# Convert the KD-trees pickled by earlier versions (kdtree-pings-<trip id>.pickle)
+# to KD-tree files built from the trip's cleaned pings, and delete the pickles.
+# Pickles that cannot be converted are kept (and their trip's file is built when needed).
+def convert_kd_tree_pickles(path='preprocessed', date_time=None):
+    date_time = date_time or datetime.now()
+    converted = failed = 0
+    for pickle_filename in sorted(glob.glob(os.path.join(path, 'kdtree-pings-*.pickle'))):
+        trip_id = int(re.search(r'kdtree-pings-(\d+)\.pickle$', pickle_filename).group(1))
+        try:
+            write_kd_tree_file(re.sub(r'\.pickle$', '.bin', pickle_filename),
+                               get_ping_arrays(TripContext(trip_id, date_time).cleaned_pings))
+            os.remove(pickle_filename)
+            converted += 1
+        except Exception as e:
+            print('Could not convert {}: {}'.format(pickle_filename, e))
+            failed += 1
+    print('Converted {} pickled KD-trees ({} failed)'.format(converted, failed))
+
+if __name__ == '__main__':
+    convert_kd_tree_pickles(*sys.argv[1:])
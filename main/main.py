@@ -2,24 +2,72 @@ import os
 import time
 from constants import DATETIME_FORMAT
 from datetime import datetime, timedelta
-from db_logic import get_offset
-from file_system import destroy_predictions
+from db_logic import get_latest_ping_ids, get_offset
 from run import run
+from scheduler import CYCLE_SECONDS, DEADLINE_MARGIN_SECONDS
+from snapshot import prediction_snapshot
+from storage import get_storage
+from trip_windows import trip_window_index
+from worker_pool import WorkerPool
+
+# In low-latency mode, the latest ping of each operating trip is polled every
+# POLL_SECONDS between cycles, and the trips with new pings are predicted right away.
+POLL_SECONDS = float(os.environ.get('LOW_LATENCY_POLL_SECONDS', 0))
 
 # Execute the function 'run' every 60 seconds.
-# If 'run' takes more than 60 seconds to finish,
-# it will wait until the next available start of cycle to execute 'run' again.
-def run_forever(seconds=60, offset=timedelta()):
+# Each cycle has a deadline shortly before the next one starts; trips that are not
+# predicted by then are skipped (see scheduler). If 'run' still takes more than 60
+# seconds, the overrun is reported and the next cycle starts right away, instead
+# of silently skipping to the next minute.
+# The worker processes are started once and kept warm across cycles.
+def run_forever(seconds=CYCLE_SECONDS, offset=timedelta(), poll_seconds=POLL_SECONDS):
+    worker_pool = WorkerPool()
+    previous_date_time = None
+    start_time = time.time() + seconds - (time.time() % seconds)
     while True:
-        time.sleep(seconds - (time.time() % seconds))
+        time.sleep(max(0.0, start_time - time.time()))
         date_time = datetime.now() - offset
         print(date_time)
 
         # Update routes, tripstops, trips every midnight
-        if date_time.hour == 0 and date_time.minute <= 2:
-            destroy_predictions()
+        is_midnight = date_time.hour == 0 and date_time.minute <= 2
+        if is_midnight:
+            get_storage().clear()
+            trip_window_index.load(date_time.date())
+
+        operating_trip_ids = trip_window_index.get_operating_trip_ids(date_time)
+        prediction_snapshot.keep_only(operating_trip_ids)
+        deadline = start_time + seconds - DEADLINE_MARGIN_SECONDS
+        run(date_time, worker_pool=worker_pool, deadline=deadline, previous_date_time=previous_date_time,
+            trip_ids=operating_trip_ids, recompute_all=is_midnight)
+        previous_date_time = date_time
+
+        overrun_seconds = time.time() - (start_time + seconds)
+        if overrun_seconds > 0:
+            print('Cycle overran by {:.1f}s, starting the next cycle now'.format(overrun_seconds))
+            start_time = time.time()
+            continue
+        start_time += seconds
+        if poll_seconds:
+            poll_for_new_pings(worker_pool, operating_trip_ids, date_time, start_time, poll_seconds, offset)
 
-        run(date_time)
+# Until until_time, poll the latest ping of the operating trips every poll_seconds,
+# and predict the trips with pings newer than the previous poll (or cycle at date_time).
+# Each poll's trips have a deadline of their own, which is at most until_time
+# (when the next cycle starts), and are not predicted from fewer historical trips.
+def poll_for_new_pings(worker_pool, operating_trip_ids, date_time, until_time, poll_seconds, offset):
+    latest_ping_ids = get_latest_ping_ids(operating_trip_ids, newest_datetime=date_time)
+    while time.time() + poll_seconds < until_time:
+        time.sleep(poll_seconds)
+        previous_date_time, date_time = date_time, datetime.now() - offset
+        new_latest_ping_ids = get_latest_ping_ids(operating_trip_ids, newest_datetime=date_time)
+        trip_ids = [trip_id for trip_id in operating_trip_ids
+                    if new_latest_ping_ids.get(trip_id) != latest_ping_ids.get(trip_id)]
+        latest_ping_ids = new_latest_ping_ids
+        if trip_ids:
+            deadline = min(time.time() + CYCLE_SECONDS - DEADLINE_MARGIN_SECONDS, until_time)
+            run(date_time, worker_pool=worker_pool, deadline=deadline,
+                previous_date_time=previous_date_time, trip_ids=trip_ids, degrade=False)
 
 def replay_date(minutes=10):
     offset = get_offset(minutes=minutes)
@@ -1,110 +1,164 @@
 import pandas
-from clean_data import clean_rep
+from artifact_cache import artifact_cache
 from datetime import datetime
-from db_logic import get_pings, get_stops, get_tripstops
-from pyproj import Proj
-from save_and_load_variables import read_from_pickle, write_to_pickle
+from db_logic import get_stops
+from kd_tree_file import KD_TREE_FILE_VERSION, get_ping_arrays, read_kd_tree_file, write_kd_tree_file
+from save_and_load_variables import READ_ERRORS, file_lock, read_versioned_pickle, write_versioned_pickle
 from scipy.spatial import cKDTree
+from trip_context import TripContext
 from trip_helper import get_trip_cycle
-from utility import latlng_distance, flatten
+from utility import latlng_distance
 
-p = Proj(init='epsg:3414')
+get_kd_tree_filename = lambda trip_id: \
+    'preprocessed/kdtree-pings-{}.bin'.format(trip_id)
+get_nearest_pings_to_tripstops_filename = lambda trip_id: \
+    'preprocessed/nearest-pings-to-tripstops-{}.pickle'.format(trip_id)
+get_nearest_pings_to_stops_filename = lambda trip_id: \
+    'preprocessed/nearest-pings-to-stops-{}.pickle'.format(trip_id)
 
-def get_kd_tree(trip_id, date_time=datetime.now()):
-    kd_tree_filename = 'preprocessed/kdtree-pings-{}.pickle'.format(trip_id)
-    kd_tree = None
+# All stops with their projected coordinates, loaded once per process
+# (and again if a stop was added since)
+all_stops = None
+def get_stop(stop_id):
+    global all_stops
+    if all_stops is None or stop_id not in all_stops.index:
+        all_stops = get_stops()
+    return all_stops.loc[stop_id]
+
+# The tree keeps the given (n, 2) float64 x, y as its data, so a tree read from a
+# KD-tree file is built on (and queries) the mapped pages that processes share
+get_kd_tree_of_arrays = lambda ping_arrays: \
+    cKDTree(ping_arrays[0]) if len(ping_arrays[0]) > 0 else None
+
+read_kd_tree = lambda filename: get_kd_tree_of_arrays(read_kd_tree_file(filename))
+
+# Get a preprocessed artifact from the cache or its file, or else build it with
+# build_function(). Processes that need the same artifact at the same time build
+# it only once: the others wait for it, then read the file it was saved in.
+def load_or_build(filename, version, read_function, build_function):
     try:
-        kd_tree = read_from_pickle(kd_tree_filename)
-    except:
-        trip_pings = get_pings(trip_id=trip_id, newest_datetime=date_time)
-        cleaned_trip_pings = flatten(clean_rep(trip_pings))
-        if len(cleaned_trip_pings) == 0:
-            return None
-        trip_pings_x_y = [p(ping.lng, ping.lat) for ping in cleaned_trip_pings]
-        kd_tree = cKDTree(trip_pings_x_y)
-
-        # Cache data if it is more than 1 day old
-        latest_ping_time = trip_pings.iloc[-1].time.replace(tzinfo=None)
-        if latest_ping_time < date_time and latest_ping_time.day != date_time.day:
-            write_to_pickle(kd_tree_filename, kd_tree)
+        return artifact_cache.load(filename, version, read_function)
+    except READ_ERRORS:
+        pass
+    with file_lock(filename):
+        try:
+            return artifact_cache.load(filename, version, read_function)
+        except READ_ERRORS:
+            return build_function()
+
+# The TripContext of trip_id at date_time can be given to reuse its pings and cleaned pings.
+def get_kd_tree(trip_id, date_time=datetime.now(), context=None):
+    return load_or_build(get_kd_tree_filename(trip_id), KD_TREE_FILE_VERSION, read_kd_tree,
+                         lambda: build_kd_tree(trip_id, date_time, context))
+
+def build_kd_tree(trip_id, date_time, context=None):
+    kd_tree_filename = get_kd_tree_filename(trip_id)
+    context = context or TripContext(trip_id, date_time)
+    trip_pings = context.pings
+    cleaned_trip_pings = context.cleaned_pings
+    if len(cleaned_trip_pings) == 0:
+        return None
+    ping_arrays = get_ping_arrays(cleaned_trip_pings)
+    kd_tree = get_kd_tree_of_arrays(ping_arrays)
+
+    # Cache data if it is more than 1 day old
+    latest_ping_time = trip_pings.iloc[-1].time.replace(tzinfo=None)
+    if latest_ping_time < date_time and latest_ping_time.day != date_time.day:
+        write_kd_tree_file(kd_tree_filename, ping_arrays)
+        artifact_cache.store(kd_tree_filename, KD_TREE_FILE_VERSION, kd_tree)
     return kd_tree
 
+# Version of the saved nearest-ping tables. Tables saved with another version
+# (including the unversioned ones that only had ping ids) are rebuilt.
+NEAREST_PINGS_VERSION = 2
+
+read_nearest_pings = lambda filename: read_versioned_pickle(filename, NEAREST_PINGS_VERSION)
+
 # For each tripstop, find the pings within 50m from it.
-# Output format: [tripstop_id: nearest_ping_id]
-def list_of_nearest_pings_to_tripstops(trip_id, date_time=datetime.now()):
-    filename = 'preprocessed/nearest-pings-to-tripstops-{}.pickle'.format(trip_id)
-    try:
-        return read_from_pickle(filename)
-    except:
-        threshold_distance = 50 # If the ping is more than 50m away, it's not 'near' the bus stop
-    
-        trip_pings = get_pings(trip_id=trip_id, newest_datetime=date_time)
-        cleaned_trip_pings = flatten(clean_rep(trip_pings))
-        trip_pings_lat_lng = [(ping.lat, ping.lng) for ping in cleaned_trip_pings]
-        
-        trip_tripstops = get_tripstops(trip_id=trip_id)
-        trip_tripstops_lat_lng = [(tripstop.lat, tripstop.lng) for tripstop in trip_tripstops.itertuples()]
-        trip_tripstops_x_y = [p(lng, lat) for lat, lng in trip_tripstops_lat_lng]
+# Output format: [(tripstop_id, nearest_ping_id, ping_time, ping_lat, ping_lng)]
+def list_of_nearest_pings_to_tripstops(trip_id, date_time=datetime.now(), context=None):
+    return load_or_build(get_nearest_pings_to_tripstops_filename(trip_id), NEAREST_PINGS_VERSION, read_nearest_pings,
+                         lambda: build_nearest_pings_to_tripstops(trip_id, date_time, context))
 
-        kd_tree = get_kd_tree(trip_id, date_time=date_time)
-        
-        ping_indices_per_tripstop = [kd_tree.query_ball_point(tripstop_x_y, r=threshold_distance) 
-                                     for tripstop_x_y in trip_tripstops_x_y]
+def build_nearest_pings_to_tripstops(trip_id, date_time, context=None):
+    filename = get_nearest_pings_to_tripstops_filename(trip_id)
+    threshold_distance = 50 # If the ping is more than 50m away, it's not 'near' the bus stop
 
-        sorted_tripstop_to_nearest_ping = []
-        for tripstop_index, ping_indices in enumerate(ping_indices_per_tripstop):
-            if len(ping_indices) == 0:
-                continue
+    context = context or TripContext(trip_id, date_time)
+    trip_pings = context.pings
+    cleaned_trip_pings = context.cleaned_pings
+    trip_pings_lat_lng = [(ping.lat, ping.lng) for ping in cleaned_trip_pings]
     
-            distances = [latlng_distance(trip_tripstops_lat_lng[tripstop_index], trip_pings_lat_lng[ping_index]) 
-                         for ping_index in ping_indices]
-            nearest_pings_timings = [cleaned_trip_pings[ping_index].time for ping_index in ping_indices]
-            
-            # Get best ping based on least distance. If tie, get the earlier ping.
-            # TODO: Improve heuristics in choosing the best ping (affinity by time, heading)
-            nearest_ping_index = sorted(list(zip(distances, nearest_pings_timings, ping_indices)))[0][2]
-            nearest_ping_id = cleaned_trip_pings[nearest_ping_index].Index
-            tripstop_id = trip_tripstops.iloc[tripstop_index].name
-            sorted_tripstop_to_nearest_ping.append((tripstop_id, nearest_ping_id))
+    trip_tripstops = context.tripstops
+    trip_tripstops_lat_lng = [(tripstop.lat, tripstop.lng) for tripstop in trip_tripstops.itertuples()]
+    trip_tripstops_x_y = trip_tripstops[['x', 'y']].values
+
+    kd_tree = get_kd_tree(trip_id, date_time=date_time, context=context)
+    
+    ping_indices_per_tripstop = [kd_tree.query_ball_point(tripstop_x_y, r=threshold_distance) 
+                                 for tripstop_x_y in trip_tripstops_x_y]
+
+    sorted_tripstop_to_nearest_ping = []
+    for tripstop_index, ping_indices in enumerate(ping_indices_per_tripstop):
+        if len(ping_indices) == 0:
+            continue
+
+        distances = [latlng_distance(trip_tripstops_lat_lng[tripstop_index], trip_pings_lat_lng[ping_index]) 
+                     for ping_index in ping_indices]
+        nearest_pings_timings = [cleaned_trip_pings[ping_index].time for ping_index in ping_indices]
         
-        # Cache data if it is more than 1 day old
-        latest_ping_time = trip_pings.iloc[-1].time.replace(tzinfo=None)
-        if latest_ping_time < date_time and latest_ping_time.day != date_time.day:
-            write_to_pickle(filename, sorted_tripstop_to_nearest_ping)
-        return sorted_tripstop_to_nearest_ping
+        # Get best ping based on least distance. If tie, get the earlier ping.
+        # TODO: Improve heuristics in choosing the best ping (affinity by time, heading)
+        nearest_ping_index = sorted(list(zip(distances, nearest_pings_timings, ping_indices)))[0][2]
+        nearest_ping = cleaned_trip_pings[nearest_ping_index]
+        tripstop_id = trip_tripstops.iloc[tripstop_index].name
+        sorted_tripstop_to_nearest_ping.append(
+            (tripstop_id, nearest_ping.Index, nearest_ping.time, nearest_ping.lat, nearest_ping.lng))
+    
+    # Cache data if it is more than 1 day old
+    latest_ping_time = trip_pings.iloc[-1].time.replace(tzinfo=None)
+    if latest_ping_time < date_time and latest_ping_time.day != date_time.day:
+        write_versioned_pickle(filename, sorted_tripstop_to_nearest_ping, NEAREST_PINGS_VERSION)
+        artifact_cache.store(filename, NEAREST_PINGS_VERSION, sorted_tripstop_to_nearest_ping)
+    return sorted_tripstop_to_nearest_ping
 
 # This implementation is for circular routes where the stops cycles
-# Output format: [stop_id: [nearby_ping_ids]]
-def list_of_nearest_pings_to_stops(trip_id, date_time=datetime.now()):
-    filename = 'preprocessed/nearest-pings-to-stops-{}.pickle'.format(trip_id)
-    try:
-        return read_from_pickle(filename)
-    except:
-        threshold_distance = 50 # If the ping is more than 50m away, it's not 'near' the bus stop
+# Output format: [(stop_id, [(nearby_ping_id, ping_time, ping_lat, ping_lng)])]
+def list_of_nearest_pings_to_stops(trip_id, date_time=datetime.now(), context=None):
+    return load_or_build(get_nearest_pings_to_stops_filename(trip_id), NEAREST_PINGS_VERSION, read_nearest_pings,
+                         lambda: build_nearest_pings_to_stops(trip_id, date_time, context))
 
-        trip_pings = get_pings(trip_id=trip_id, newest_datetime=date_time)
-        cleaned_trip_pings = flatten(clean_rep(trip_pings))
-        trip_pings_lat_lng = [(ping.lat, ping.lng) for ping in cleaned_trip_pings]
-        
-        trip_tripstops = get_tripstops(trip_id=trip_id)
-        stop_ids_cycle = get_trip_cycle(trip_tripstops.stopId.tolist())
-        stops = [get_stops(stop_id=stop_id) for stop_id in stop_ids_cycle]
-        stops_lat_lng = [(stop.iloc[0].lat, stop.iloc[0].lng) for stop in stops]
-        stops_x_y = [p(lng, lat) for lat, lng in stops_lat_lng]
-
-        kd_tree = get_kd_tree(trip_id, date_time=date_time)
-
-        ping_indices_per_stop = [kd_tree.query_ball_point(stop_x_y, r=threshold_distance)
-                                     for stop_x_y in stops_x_y]
-
-        sorted_stop_to_nearest_pings = [(stops[i].iloc[0].name,
-                                         [cleaned_trip_pings[ping_index].Index
-                                          for ping_index in ping_indices
-                                          if ping_index < len(cleaned_trip_pings)])
-                                         for i, ping_indices in enumerate(ping_indices_per_stop)]
-
-        # Cache data if it is more than 1 day old
-        latest_ping_time = trip_pings.iloc[-1].time.replace(tzinfo=None)
-        if latest_ping_time < date_time and latest_ping_time.day != date_time.day:
-            write_to_pickle(filename, sorted_stop_to_nearest_pings)
-        return sorted_stop_to_nearest_pings
+def build_nearest_pings_to_stops(trip_id, date_time, context=None):
+    filename = get_nearest_pings_to_stops_filename(trip_id)
+    threshold_distance = 50 # If the ping is more than 50m away, it's not 'near' the bus stop
+
+    context = context or TripContext(trip_id, date_time)
+    trip_pings = context.pings
+    cleaned_trip_pings = context.cleaned_pings
+    trip_pings_lat_lng = [(ping.lat, ping.lng) for ping in cleaned_trip_pings]
+    
+    trip_tripstops = context.tripstops
+    stop_ids_cycle = get_trip_cycle(trip_tripstops.stopId.tolist())
+    stops = [get_stop(stop_id) for stop_id in stop_ids_cycle]
+    stops_x_y = [(stop.x, stop.y) for stop in stops]
+
+    kd_tree = get_kd_tree(trip_id, date_time=date_time, context=context)
+
+    ping_indices_per_stop = [kd_tree.query_ball_point(stop_x_y, r=threshold_distance)
+                                 for stop_x_y in stops_x_y]
+
+    sorted_stop_to_nearest_pings = [(stops[i].name,
+                                     [(cleaned_trip_pings[ping_index].Index,
+                                       cleaned_trip_pings[ping_index].time,
+                                       cleaned_trip_pings[ping_index].lat,
+                                       cleaned_trip_pings[ping_index].lng)
+                                      for ping_index in ping_indices
+                                      if ping_index < len(cleaned_trip_pings)])
+                                     for i, ping_indices in enumerate(ping_indices_per_stop)]
+
+    # Cache data if it is more than 1 day old
+    latest_ping_time = trip_pings.iloc[-1].time.replace(tzinfo=None)
+    if latest_ping_time < date_time and latest_ping_time.day != date_time.day:
+        write_versioned_pickle(filename, sorted_stop_to_nearest_pings, NEAREST_PINGS_VERSION)
+        artifact_cache.store(filename, NEAREST_PINGS_VERSION, sorted_stop_to_nearest_pings)
+    return sorted_stop_to_nearest_pings
@@ -0,0 +1,28 @@
+# Predictions are saved as JSON for the API, with each stop's response already
+# rendered except its time to arrival, which depends on the time of the request:
+# {"version": 1,
+#  "stops": {"<stop id>": {"valid": true, "eta": "<ISO 8601 time>"} or {"valid": false, "reason": "<message>"}},
+#  "etaStopIds": ["<stop id>", ...], "etaEpochs": [<ETA in seconds since epoch>, ...]}
+# The ETAs are kept apart, so that the API computes every time to arrival at once.
+from datetime import datetime
+
+PREDICTION_FORMAT_VERSION = 1
+ETA_FORMAT = '%Y-%m-%dT%H:%M:%S+0800'
+
+get_prediction_filename = lambda trip_id: 'results/prediction-{}.json'.format(trip_id)
+
+# Convert the predictions of a trip ({stop_id: datetime or message}) to the saved format
+def format_predictions(predictions):
+    stops = {}
+    eta_stop_ids, eta_epochs = [], []
+    for stop_id, date_time in predictions.items():
+        if isinstance(date_time, datetime):
+            stops[str(stop_id)] = {'valid': True, 'eta': date_time.strftime(ETA_FORMAT)}
+            eta_stop_ids.append(str(stop_id))
+            eta_epochs.append(date_time.timestamp())
+        else:
+            stops[str(stop_id)] = {'valid': False, 'reason': date_time}
+    return {'version': PREDICTION_FORMAT_VERSION,
+            'stops': stops,
+            'etaStopIds': eta_stop_ids,
+            'etaEpochs': eta_epochs}
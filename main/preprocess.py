@@ -0,0 +1,90 @@
+import multiprocessing
+import sys
+import time
+from candidate_timelines import get_candidate_timelines
+from datetime import datetime, timedelta
+from db_logic import get_past_trips_of_route, get_trips_between
+from ping_locator import (
+    NEAREST_PINGS_VERSION, get_kd_tree, get_nearest_pings_to_tripstops_filename,
+    list_of_nearest_pings_to_stops, list_of_nearest_pings_to_tripstops
+)
+from route_index import get_route_index
+from save_and_load_variables import READ_ERRORS, read_versioned_pickle, remove_old_lock_files
+from stop_sequence_index import get_stop_sequence_index
+from trip_context import TripContext
+
+# The nearest-pings-to-tripstops table is written last,
+# so a trip that has it was fully preprocessed by an earlier run.
+def is_preprocessed(trip_id):
+    try:
+        read_versioned_pickle(get_nearest_pings_to_tripstops_filename(trip_id), NEAREST_PINGS_VERSION)
+        return True
+    except READ_ERRORS:
+        return False
+
+# Build and save the KD-tree and nearest-ping tables of a completed trip.
+# Returns the outcome and the number of seconds it took.
+def preprocess_trip(trip_id, date_time):
+    start_time = time.time()
+    if is_preprocessed(trip_id):
+        return 'skipped', 0.0
+    try:
+        context = TripContext(trip_id, date_time)
+        if len(context.cleaned_pings) == 0:
+            return 'no pings', time.time() - start_time
+        get_kd_tree(trip_id, date_time=date_time, context=context)
+        if context.is_circular:
+            list_of_nearest_pings_to_stops(trip_id, date_time=date_time, context=context)
+        list_of_nearest_pings_to_tripstops(trip_id, date_time=date_time, context=context)
+    except Exception as e:
+        print('Failed to preprocess trip {}: {}'.format(trip_id, e))
+        return 'failed', time.time() - start_time
+    return 'built', time.time() - start_time
+
+def preprocess_trip_star(args):
+    return preprocess_trip(*args)
+
+# Preprocess every trip completed in the last number_of_days days (before today),
+# so that the live cycles find their artifacts already built.
+# Trips that were already preprocessed are skipped, so the job can be stopped and rerun.
+def preprocess_completed_trips(date_time=None, number_of_days=30, processes=5):
+    date_time = date_time or datetime.now()
+    today = datetime(date_time.year, date_time.month, date_time.day)
+    trips = get_trips_between(today - timedelta(days=number_of_days), today)
+    trip_ids = trips.index.tolist()
+    print('Preprocessing {} trips completed in the last {} days'.format(len(trip_ids), number_of_days))
+
+    start_time = time.time()
+    outcomes = {}
+    build_seconds = 0.0
+    with multiprocessing.Pool(processes) as pool:
+        tasks = [(trip_id, date_time) for trip_id in trip_ids]
+        for i, (outcome, seconds) in enumerate(pool.imap_unordered(preprocess_trip_star, tasks)):
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            build_seconds += seconds
+            if (i + 1) % 100 == 0:
+                print('Preprocessed {}/{} trips'.format(i + 1, len(trip_ids)))
+
+    elapsed_seconds = time.time() - start_time
+    print('Preprocessed {} trips in {:.1f}s ({:.2f} trips/s, {:.1f}s of build time): {}'.format(
+        len(trip_ids), elapsed_seconds, len(trip_ids) / elapsed_seconds if elapsed_seconds else 0.0,
+        build_seconds, outcomes))
+
+    # Then add the trips to the spatial and stop sequence indices of their route,
+    # and validate them as candidates for predictions
+    start_time = time.time()
+    route_ids = sorted(set(trips.routeId.tolist()))
+    for route_id in route_ids:
+        past_trips = get_past_trips_of_route(route_id, before_date=date_time)
+        contexts = {}
+        get_route_index(route_id, past_trips, date_time=date_time, contexts=contexts)
+        get_stop_sequence_index(route_id, past_trips)
+        get_candidate_timelines(route_id, past_trips, date_time, contexts)
+    print('Updated the indices of {} routes in {:.1f}s'.format(len(route_ids), time.time() - start_time))
+
+    remove_old_lock_files('preprocessed')
+    return outcomes
+
+if __name__ == '__main__':
+    number_of_days = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    preprocess_completed_trips(number_of_days=number_of_days)
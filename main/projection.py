@@ -0,0 +1,19 @@
+import numpy as np
+from pyproj import Proj
+
+# SVY21 (Singapore) projection, which gives x, y in metres for the KD-trees
+p = Proj(init='epsg:3414')
+
+# Project arrays of lat, lng in one call. Returns arrays of x, y.
+def project(lat, lng):
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    if len(lat) == 0:
+        return np.zeros(0), np.zeros(0)
+    return p(lng, lat)
+
+# Add x, y columns to a dataframe with lat, lng columns (pings, stops, tripstops),
+# so that each row is projected once, when it is loaded
+def add_projected_coordinates(records):
+    records['x'], records['y'] = project(records.lat.values, records.lng.values)
+    return records
@@ -0,0 +1,130 @@
+import numpy as np
+import pandas
+from datetime import datetime
+from save_and_load_variables import load_or_update_route_index, write_atomically
+from scipy.spatial import cKDTree
+from trip_context import get_shared_context
+
+ROUTE_INDEX_VERSION = 1
+ROUTE_INDEX_FIELDS = ['trip_id', 'position', 'ping_id', 'time', 'x', 'y']
+
+get_route_index_filename = lambda route_id: \
+    'preprocessed/route-index-{}.npz'.format(route_id)
+
+# Only trips from before the day of date_time are indexed, since their pings are complete
+is_completed_trip = lambda trip_date, date_time: \
+    pandas.Timestamp(trip_date).date() < date_time.date()
+
+# One spatial index over the cleaned pings of all the past trips of a route.
+# For each ping, it keeps its trip id, position in the trip's cleaned pings,
+# ping id, time (in microseconds since epoch) and projected x, y.
+class RouteIndex:
+    def __init__(self, route_id, arrays=None, indexed_trip_ids=()):
+        self.route_id = route_id
+        self.arrays = arrays or {field: np.zeros(0, dtype=np.float64 if field in ['x', 'y'] else np.int64)
+                                 for field in ROUTE_INDEX_FIELDS}
+        # Includes trips without any cleaned pings, so that they are not rebuilt
+        self.indexed_trip_ids = set(indexed_trip_ids)
+        self.kd_tree = None
+
+    def get_kd_tree(self):
+        if self.kd_tree is None and len(self.arrays['x']) > 0:
+            self.kd_tree = cKDTree(np.column_stack([self.arrays['x'], self.arrays['y']]))
+        return self.kd_tree
+
+    # Keep only the given trips, and add those that are not indexed yet
+    # (with their context from contexts, see get_shared_context).
+    # Returns True if the index changed.
+    def update(self, trip_ids, date_time, contexts=None):
+        contexts = {} if contexts is None else contexts
+        trip_ids = set(trip_ids)
+        removed_trip_ids = self.indexed_trip_ids - trip_ids
+        added_trip_ids = trip_ids - self.indexed_trip_ids
+        if not removed_trip_ids and not added_trip_ids:
+            return False
+
+        kept = ~np.isin(self.arrays['trip_id'], list(removed_trip_ids))
+        parts = [{field: values[kept] for field, values in self.arrays.items()}]
+        parts += [get_trip_arrays(get_shared_context(contexts, trip_id, date_time))
+                  for trip_id in sorted(added_trip_ids)]
+        self.arrays = {field: np.concatenate([part[field] for part in parts]) for field in ROUTE_INDEX_FIELDS}
+        self.indexed_trip_ids = trip_ids
+        self.kd_tree = None
+        return True
+
+    # For each indexed trip with cleaned pings within r metres of x_y, get the one
+    # closest in time to the given time (if tied, the earliest in the trip).
+    # Output format: {trip_id: (ping_id, ping_time)}
+    def query_nearest_pings(self, x_y, time, r):
+        return self.query_nearest_pings_of_points([x_y], [time], r)[0]
+
+    # query_nearest_pings for many points (e.g. the most recent pings of all the
+    # live trips of the route) with one query of the KD-tree
+    def query_nearest_pings_of_points(self, x_ys, times, r):
+        kd_tree = self.get_kd_tree()
+        if kd_tree is None or len(x_ys) == 0:
+            return [{} for x_y in x_ys]
+        indices_per_point = kd_tree.query_ball_point(np.array(x_ys, dtype=np.float64).reshape(-1, 2), r=r)
+        times = to_microseconds(times)
+        nearest_pings_per_point = []
+        for indices, time in zip(indices_per_point, times):
+            indices = np.array(indices, dtype=np.int64)
+            nearest_pings = {}
+            if len(indices) > 0:
+                trip_ids = self.arrays['trip_id'][indices]
+                time_differences = np.abs(self.arrays['time'][indices] - time)
+                order = np.lexsort((self.arrays['position'][indices], time_differences, trip_ids))
+                is_first_of_trip = np.r_[True, trip_ids[order][1:] != trip_ids[order][:-1]]
+                for index in indices[order[is_first_of_trip]].tolist():
+                    nearest_pings[int(self.arrays['trip_id'][index])] = \
+                        (int(self.arrays['ping_id'][index]), from_microseconds(self.arrays['time'][index]))
+            nearest_pings_per_point.append(nearest_pings)
+        return nearest_pings_per_point
+
+    def save(self):
+        write_atomically(get_route_index_filename(self.route_id),
+                         lambda f: np.savez(f,
+                                            version=ROUTE_INDEX_VERSION,
+                                            indexed_trip_ids=np.array(sorted(self.indexed_trip_ids), dtype=np.int64),
+                                            **self.arrays))
+
+    @classmethod
+    def load(cls, route_id):
+        with np.load(get_route_index_filename(route_id)) as saved:
+            if int(saved['version']) != ROUTE_INDEX_VERSION:
+                raise ValueError('Route index {} has another version'.format(route_id))
+            return cls(route_id,
+                       arrays={field: saved[field] for field in ROUTE_INDEX_FIELDS},
+                       indexed_trip_ids=saved['indexed_trip_ids'].tolist())
+
+to_microseconds = lambda times: \
+    pandas.to_datetime(pandas.Series(list(times)), utc=True).values \
+    .astype('datetime64[us]').astype(np.int64)
+
+from_microseconds = lambda microseconds: \
+    pandas.Timestamp(int(microseconds) * 1000, tz='UTC')
+
+# Get the route index fields of the cleaned pings of a completed trip (given its TripContext)
+def get_trip_arrays(context):
+    trip_id = context.trip_id
+    cleaned_trip_pings = context.cleaned_pings
+    x_y = np.array([(ping.x, ping.y) for ping in cleaned_trip_pings], dtype=np.float64).reshape(-1, 2)
+    return {'trip_id': np.full(len(cleaned_trip_pings), trip_id, dtype=np.int64),
+            'position': np.arange(len(cleaned_trip_pings), dtype=np.int64),
+            'ping_id': np.array([ping.Index for ping in cleaned_trip_pings], dtype=np.int64),
+            'time': to_microseconds([ping.time for ping in cleaned_trip_pings]),
+            'x': x_y[:, 0],
+            'y': x_y[:, 1]}
+
+# Route indices loaded by this process
+route_indices = {}
+
+# Get the index of the completed trips among past_trips (a dataframe from
+# get_past_trips_of_route), updating and saving it if trips were added or dropped.
+# contexts are the TripContexts shared with the other indices of the route (see get_shared_context).
+def get_route_index(route_id, past_trips, date_time=datetime.now(), contexts=None):
+    completed_trip_ids = [trip_id for trip_id, trip_date in zip(past_trips.index, past_trips.date)
+                          if is_completed_trip(trip_date, date_time)]
+    return load_or_update_route_index(route_indices, route_id, RouteIndex, get_route_index_filename(route_id),
+                                      lambda route_index: set(completed_trip_ids) == route_index.indexed_trip_ids,
+                                      lambda route_index: route_index.update(completed_trip_ids, date_time, contexts))
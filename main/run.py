@@ -1,15 +1,86 @@
-import multiprocessing
+import time
+from collections import OrderedDict
 from datetime import datetime
-from db_logic import get_operating_trip_ids
-from itertools import repeat
-from trip_predictor import update_timings_for_trip
+from db_logic import get_pings_of_trips, get_trips_of_ids, get_tripstops_of_trips
+from scheduler import (
+    CYCLE_SECONDS, DEADLINE_MARGIN_SECONDS, add_uploads, flush_published_files, get_cycle_metrics,
+    predict_route_before_deadline, prioritise_trips
+)
+from snapshot import prediction_snapshot
+from storage import get_storage
+from trip_windows import trip_window_index
+from worker_pool import WorkerPool
 
-def run(date_time):
-    operating_trip_ids = get_operating_trip_ids(date_time)
+# worker_pool is the long-lived pool of run_forever;
+# without it, a pool is started for this cycle only.
+# deadline is the time.time() by which the predictions should be published, and
+# previous_date_time the date_time of the previous cycle (to find trips with new pings).
+# trip_ids are the trips to predict, if not all the operating trips (then the
+# trips that are not operating anymore are not dropped from the snapshot). Trips whose
+# pings did not change since their last prediction are not predicted again,
+# unless recompute_all (e.g. after the predictions were deleted).
+# Trips are predicted from fewer historical trips close to the deadline, unless
+# degrade is False (e.g. for the few trips of a poll, which have a short deadline).
+# Returns the metrics of the cycle.
+def run(date_time, worker_pool=None, deadline=None, previous_date_time=None, trip_ids=None,
+        recompute_all=False, degrade=True):
+    start_time = time.time()
+    deadline = deadline or start_time + CYCLE_SECONDS - DEADLINE_MARGIN_SECONDS
+    operating_trip_ids = trip_window_index.get_operating_trip_ids(date_time) if trip_ids is None else trip_ids
     print('Operating trips: ' + str(operating_trip_ids))
 
-    with multiprocessing.Pool(5) as pool:
-        pool.starmap(
-            update_timings_for_trip,
-            zip(repeat(date_time), operating_trip_ids)
-        )
+    # Fetch the pings of all operating trips at once; each worker gets its trip's slice
+    pings_per_trip = get_pings_of_trips(operating_trip_ids, newest_datetime=date_time)
+    operating_trip_ids = prioritise_trips(operating_trip_ids, pings_per_trip,
+                                          get_tripstops_of_trips(operating_trip_ids),
+                                          date_time, previous_date_time)
+
+    # The trips of a route are predicted together by one task, which loads the
+    # historical trips of the route once for all of them. The tasks of a route go
+    # to the same worker, which has them cached (and each trip's incremental cleaner).
+    # Routes are ordered by the priority of their first trip.
+    operating_trips = get_trips_of_ids(operating_trip_ids)
+    trip_ids_per_route = OrderedDict()
+    for trip_id in operating_trip_ids:
+        trip_ids_per_route.setdefault(operating_trips.routeId.get(trip_id, trip_id), []).append(trip_id)
+    route_ids = list(trip_ids_per_route.keys())
+
+    pool = worker_pool or WorkerPool()
+    try:
+        results_per_route = pool.map(predict_route_before_deadline,
+                                     [(deadline, date_time, trip_ids_per_route[route_id],
+                                       [pings_per_trip[int(trip_id)] for trip_id in trip_ids_per_route[route_id]],
+                                       recompute_all, degrade)
+                                      for route_id in route_ids],
+                                     keys=route_ids)
+        # Each worker uploads the predictions of its routes while it predicts the next ones,
+        # then waits for the rest of its uploads (the task of key i runs on worker i)
+        upload_stats = {}
+        for worker_upload_stats in pool.map(flush_published_files, [()] * pool.size, keys=list(range(pool.size))):
+            upload_stats.update(worker_upload_stats or {})
+    finally:
+        if worker_pool is None:
+            pool.close()
+    # The trips of a route whose task failed have no result
+    results = [result for route_id, route_results in zip(route_ids, results_per_route)
+               for result in (route_results or [None] * len(trip_ids_per_route[route_id]))]
+    add_uploads(results, upload_stats)
+    for worker_index, stats in enumerate(pool.get_stats()):
+        print('Worker {}: {:.0%} busy, {} tasks ({} failed), {} restarts'.format(
+            worker_index, stats['utilisation'], stats['tasks'], stats['failed_tasks'], stats['restarts']))
+
+    # Publish the predictions of all the operating trips as one snapshot
+    if trip_ids is None:
+        prediction_snapshot.keep_only(operating_trip_ids)
+    prediction_snapshot.update(results)
+    prediction_snapshot.publish(date_time)
+    snapshot_uploads = get_storage().flush()
+
+    metrics = get_cycle_metrics(results, start_time, deadline, uploads=snapshot_uploads.values())
+    print('Cycle: {predicted} predicted, {degraded} degraded, {skipped} skipped, {failed} failed, '
+          '{unchanged} unchanged (not recomputed); '
+          'staleness {mean_staleness:.1f}s on average, {max_staleness:.1f}s at most; '
+          'overran deadline by {overrun:.1f}s'.format(**metrics))
+    print('Uploads: {uploads} files, {uploaded_bytes} bytes, {failed_uploads} failed, {retried_uploads} retried; '
+          '{mean_upload_seconds:.2f}s on average, {max_upload_seconds:.2f}s at most'.format(**metrics))
+    return metrics
@@ -1,17 +1,138 @@
-from file_system import download_file, upload_file
+import fcntl
+import json
+import os
 import pickle
+import tempfile
+import time
+from contextlib import contextmanager
+from storage import get_storage
 
+# Errors of reading a file that is missing, corrupt or saved in another format
+READ_ERRORS = (IOError, EOFError, ValueError, pickle.UnpicklingError)
+
+# Files are given the mode that open() would give them, rather than the 0600 of
+# tempfile.mkstemp, so that an API running as another user can read the published ones
+umask = os.umask(0)
+os.umask(umask)
+FILE_MODE = 0o666 & ~umask
+
+# Write a file with write_function(f) into a temporary file next to it, then
+# rename it into place, so that readers see either the old file or the whole new one.
+# (Temporary files start with '.', so that they are not mistaken for artifacts.)
+def write_atomically(filename, write_function):
+    path, name = os.path.split(filename)
+    fd, temp_filename = tempfile.mkstemp(prefix='.' + name, suffix='.tmp', dir=path or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write_function(f)
+            os.fchmod(f.fileno(), FILE_MODE)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+
+# Hold an exclusive lock on filename (across processes) while building it,
+# so that processes which need the same file build it only once.
+# The lock files are kept in a locks/ directory next to the file.
+@contextmanager
+def file_lock(filename):
+    path, name = os.path.split(filename)
+    lock_path = os.path.join(path, 'locks')
+    os.makedirs(lock_path, exist_ok=True)
+    lock_filename = os.path.join(lock_path, name + '.lock')
+    while True:
+        lock_file = open(lock_filename, 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # The lock file may have been deleted (see remove_old_lock_files) while this
+        # process waited for it; then the lock is taken again on the new file
+        try:
+            if os.path.samestat(os.fstat(lock_file.fileno()), os.stat(lock_filename)):
+                break
+        except OSError:
+            pass
+        lock_file.close()
+    try:
+        os.utime(lock_filename) # Mark it as recently used
+        yield
+    finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+# Delete the lock files in path/locks that were not used for max_age_seconds.
+# A lock file is only deleted while this process holds its lock, so that no
+# other process holds it or builds its file meanwhile.
+def remove_old_lock_files(path, max_age_seconds=86400):
+    lock_path = os.path.join(path, 'locks')
+    if not os.path.isdir(lock_path):
+        return
+    for name in os.listdir(lock_path):
+        lock_filename = os.path.join(lock_path, name)
+        try:
+            if time.time() - os.path.getmtime(lock_filename) <= max_age_seconds:
+                continue
+            with open(lock_filename, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if os.path.samestat(os.fstat(lock_file.fileno()), os.stat(lock_filename)):
+                    os.remove(lock_filename)
+        except OSError: # Held or removed by another process meanwhile
+            continue
+
+# Get the index of a route that is kept by this process in indices (route_id -> index)
+# and saved in filename (a route index, stop sequence index or candidate timelines).
+# It is loaded with index_class.load(route_id) if it is not kept yet (and is empty if
+# it cannot be read). If it is not is_up_to_date(index), it is updated with update(index),
+# which returns True if it changed, and saved. Only one process updates it at a time:
+# the others wait, then load its update.
+def load_or_update_route_index(indices, route_id, index_class, filename, is_up_to_date, update):
+    def load():
+        try:
+            return index_class.load(route_id)
+        except READ_ERRORS + (KeyError,): # e.g. an .npz without some arrays
+            return index_class(route_id)
+
+    index = indices.get(route_id) or load()
+    if not is_up_to_date(index):
+        with file_lock(filename):
+            index = load()
+            if update(index):
+                index.save()
+    indices[route_id] = index
+    return index
+
+# With to_bucketeer, the file is written to the storage of published files
+# (see storage), and is published once get_storage().flush() returns.
 def write_to_pickle(filename, variable, to_bucketeer=False):
-    with open(filename, 'wb') as f:
-        pickle.dump(variable, f)
+    write_published_file(filename, lambda f: pickle.dump(variable, f), to_bucketeer)
+
+# Write a variable as compact JSON (e.g. predictions, which are read by the API)
+def write_to_json(filename, variable, to_bucketeer=False):
+    write_published_file(filename, lambda f: f.write(json.dumps(variable, separators=(',', ':')).encode('utf-8')),
+                         to_bucketeer)
 
-    if to_bucketeer:
-        upload_file(filename)
+def write_published_file(filename, write_function, to_bucketeer):
+    if not to_bucketeer:
+        write_atomically(filename, write_function)
+        return
+    storage = get_storage()
+    write_atomically(storage.get_path(filename), write_function)
+    storage.publish(filename)
 
 def read_from_pickle(filename, from_bucketeer=False):
     if from_bucketeer:
-        download_file(filename)
-        path, filename = split_filename(filename)
+        data, etag = get_storage().read(filename)
+        return pickle.loads(data)
 
     with open(filename, 'rb') as f:
         return pickle.load(f)
+
+# Save a variable together with the version of its format
+def write_versioned_pickle(filename, variable, version, to_bucketeer=False):
+    write_to_pickle(filename, {'version': version, 'variable': variable}, to_bucketeer=to_bucketeer)
+
+# Read a variable saved by write_versioned_pickle.
+# Raises ValueError if it was saved with another version (or without any).
+def read_versioned_pickle(filename, version, from_bucketeer=False):
+    saved = read_from_pickle(filename, from_bucketeer=from_bucketeer)
+    if not isinstance(saved, dict) or saved.get('version') != version:
+        raise ValueError('{} is not saved with version {}'.format(filename, version))
+    return saved['variable']
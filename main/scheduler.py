@@ -0,0 +1,153 @@
+import numpy as np
+import pandas
+import time
+from clean_data import get_incremental_cleaner, is_latest_ping_too_old
+from file_system import get_upload_metrics
+from prediction_format import get_prediction_filename
+from storage import get_storage
+from trip_predictor import MAX_CANDIDATES, update_timings_for_trips
+
+# A cycle starts every CYCLE_SECONDS, and its predictions should be published
+# DEADLINE_MARGIN_SECONDS before the next cycle starts.
+CYCLE_SECONDS = 60
+DEADLINE_MARGIN_SECONDS = 5
+# Trips that start with less than DEGRADE_SECONDS left before the deadline are
+# predicted from fewer historical trips. Trips that start after it are skipped,
+# and keep the predictions of the previous cycle.
+DEGRADE_SECONDS = 15
+DEGRADED_MAX_CANDIDATES = 2
+
+to_local_timestamp = lambda date_time: pandas.Timestamp(date_time).tz_localize('Asia/Singapore')
+
+# Order trips so that the most useful predictions are published first: the trips
+# with pings newer than previous_date_time (the previous cycle), then the others,
+# each starting with the trips closest to their next stop.
+# tripstops has the tripstops of all the trips (from get_tripstops_of_trips).
+def prioritise_trips(trip_ids, pings_per_trip, tripstops, date_time, previous_date_time=None):
+    next_tripstops = tripstops[tripstops.time >= to_local_timestamp(date_time)] if len(tripstops) > 0 else tripstops
+    next_tripstop_per_trip = next_tripstops.groupby('tripId').first() if len(next_tripstops) > 0 else None
+
+    priorities = []
+    for trip_id in trip_ids:
+        trip_pings = pings_per_trip[int(trip_id)]
+        if len(trip_pings) == 0:
+            priorities.append((True, np.inf))
+            continue
+        latest_ping = trip_pings.iloc[-1]
+        has_new_pings = previous_date_time is None or \
+            latest_ping.time > to_local_timestamp(previous_date_time)
+        distance = np.inf
+        if next_tripstop_per_trip is not None and trip_id in next_tripstop_per_trip.index:
+            next_tripstop = next_tripstop_per_trip.loc[trip_id]
+            distance = np.hypot(next_tripstop.x - latest_ping.x, next_tripstop.y - latest_ping.y)
+        priorities.append((not has_new_pings, distance))
+    return [trip_id for priority, trip_id in sorted(zip(priorities, trip_ids), key=lambda item: item[0])]
+
+# Watermark of the pings of a trip: it changes whenever pings are added or removed
+get_ping_watermark = lambda trip_pings: \
+    (len(trip_pings), int(trip_pings.index.max()) if len(trip_pings) > 0 else None)
+
+# What the last prediction of each trip in this worker was made from:
+# trip_id -> (ping watermark, date, whether the latest cleaned ping was too old)
+last_predictions = {}
+
+# The last predictions of other days never match (see is_unchanged), so they are
+# dropped, and workers that live for days only keep the trips of one day
+def forget_last_predictions_before(date):
+    for trip_id in [trip_id for trip_id, last_prediction in last_predictions.items() if last_prediction[1] != date]:
+        del last_predictions[trip_id]
+
+# Get whether the latest cleaned ping of a trip (as of its last prediction)
+# is too old to predict from at date_time
+def is_too_old(trip_id, date_time):
+    cleaned_pings_parts = get_incremental_cleaner(trip_id).cleaned_pings_parts
+    if len(cleaned_pings_parts) == 0 or len(cleaned_pings_parts[-1]) == 0:
+        return True
+    return is_latest_ping_too_old(cleaned_pings_parts[-1][-1].time, date_time)
+
+# A trip's prediction only changes when it has new pings, when its latest ping
+# becomes too old to predict from, or on another day (with other historical trips).
+# Otherwise its published prediction stands as it is.
+def is_unchanged(trip_id, trip_pings, date_time):
+    if trip_id not in last_predictions:
+        return False
+    watermark, date, was_too_old = last_predictions[trip_id]
+    return watermark == get_ping_watermark(trip_pings) and date == date_time.date() \
+        and was_too_old == is_too_old(trip_id, date_time)
+
+# Runs in a worker: predict a trip unless its prediction would not change (and
+# recompute is False), or the deadline of its cycle (a time.time()) has passed.
+# Trips are predicted from fewer historical trips if the deadline is close
+# (unless degrade is False).
+def predict_before_deadline(deadline, date_time, trip_id, trip_pings, recompute=False, degrade=True):
+    return predict_route_before_deadline(deadline, date_time, [trip_id], [trip_pings], recompute, degrade)[0]
+
+# predict_before_deadline for the trips of one route, which are predicted together
+# (see trip_predictor.update_timings_for_trips). Returns a result per trip.
+def predict_route_before_deadline(deadline, date_time, trip_ids, pings_of_trips, recompute=False, degrade=True):
+    start_time = time.time()
+    forget_last_predictions_before(date_time.date())
+    statuses = {}
+    for trip_id, trip_pings in zip(trip_ids, pings_of_trips):
+        if not recompute and trip_pings is not None and is_unchanged(trip_id, trip_pings, date_time):
+            statuses[trip_id] = 'unchanged'
+        elif start_time > deadline:
+            statuses[trip_id] = 'skipped'
+
+    is_degraded = degrade and deadline - start_time < DEGRADE_SECONDS
+    trips = [(trip_id, trip_pings) for trip_id, trip_pings in zip(trip_ids, pings_of_trips)
+             if trip_id not in statuses]
+    published_predictions = {}
+    if trips:
+        update_timings_for_trips(date_time, [trip_id for trip_id, trip_pings in trips], True,
+                                 [trip_pings for trip_id, trip_pings in trips],
+                                 max_candidates=DEGRADED_MAX_CANDIDATES if is_degraded else MAX_CANDIDATES,
+                                 published_predictions=published_predictions)
+    for trip_id, trip_pings in trips:
+        statuses[trip_id] = 'degraded' if is_degraded else 'predicted'
+        # Degraded predictions are made again in full as soon as there is time
+        if trip_pings is not None and not is_degraded:
+            last_predictions[trip_id] = (get_ping_watermark(trip_pings), date_time.date(),
+                                         is_too_old(trip_id, date_time))
+    finished_time = time.time()
+    # The predictions of the trips that were predicted are sent back for the cycle's snapshot.
+    # Their uploads (if any) go on while the worker predicts its next routes; see add_uploads.
+    return [{'trip_id': trip_id, 'status': statuses[trip_id], 'finished_time': finished_time,
+             'predictions': published_predictions.get(trip_id), 'upload': None}
+            for trip_id in trip_ids]
+
+# Runs in a worker once it predicted all its routes of a cycle: wait for the
+# uploads of their predictions. Returns filename -> stats of its upload.
+def flush_published_files():
+    return get_storage().flush()
+
+# Add the stats of the uploads (from flush_published_files) to the results of
+# predict_route_before_deadline. The predictions of a trip are published when
+# their upload finished.
+def add_uploads(results, upload_stats):
+    for result in results:
+        upload = result and upload_stats.get(get_prediction_filename(result['trip_id']))
+        if upload:
+            result['upload'] = upload
+            result['finished_time'] = max(result['finished_time'], upload['finished_time'])
+
+# Summarise the results of predict_before_deadline for the trips of a cycle that
+# started at start_time. The staleness of a trip is how long after the start of
+# its cycle its prediction was published.
+# uploads are the stats of the other uploads of the cycle (e.g. its snapshot).
+def get_cycle_metrics(results, start_time, deadline, uploads=()):
+    statuses = [result['status'] if result else 'failed' for result in results]
+    staleness = [result['finished_time'] - start_time for result in results
+                 if result and result['status'] in ['predicted', 'degraded']]
+    metrics = {'trips': len(results),
+               'predicted': statuses.count('predicted'),
+               'degraded': statuses.count('degraded'),
+               'skipped': statuses.count('skipped'),
+               'unchanged': statuses.count('unchanged'),
+               'failed': statuses.count('failed'),
+               'mean_staleness': np.mean(staleness) if staleness else 0.0,
+               'max_staleness': max(staleness) if staleness else 0.0,
+               'overrun': max(0.0, time.time() - deadline)}
+    metrics.update(get_upload_metrics([result['upload'] for result in results if result and result['upload']]
+                                      + list(uploads)))
+    return metrics
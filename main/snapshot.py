@@ -0,0 +1,40 @@
+import time
+from prediction_format import PREDICTION_FORMAT_VERSION
+from save_and_load_variables import write_to_json
+
+SNAPSHOT_FILENAME = 'results/snapshot.json'
+
+# The predictions of all the operating trips, published as one object every cycle
+# (besides the file of each trip), so that the API gets all of them with one download.
+class PredictionSnapshot:
+    def __init__(self):
+        # trip_id -> what was saved for it (its predictions or error messages, see prediction_format)
+        self.predictions_per_trip = {}
+        self.cycle = 0
+
+    # Add the predictions of the results of scheduler.predict_route_before_deadline.
+    # Trips that were not predicted (unchanged, skipped or failed) keep their previous predictions.
+    def update(self, results):
+        for result in results:
+            if result and result.get('predictions') is not None:
+                self.predictions_per_trip[int(result['trip_id'])] = result['predictions']
+
+    # Drop the trips that are not operating anymore
+    def keep_only(self, trip_ids):
+        trip_ids = set(int(trip_id) for trip_id in trip_ids)
+        self.predictions_per_trip = {trip_id: predictions for trip_id, predictions in self.predictions_per_trip.items()
+                                     if trip_id in trip_ids}
+
+    def publish(self, date_time, to_bucketeer=True):
+        self.cycle += 1
+        write_to_json(SNAPSHOT_FILENAME,
+                      {'version': PREDICTION_FORMAT_VERSION,
+                       'cycle': self.cycle,
+                       'dateTime': date_time.isoformat(),
+                       'publishedTime': time.time(),
+                       'predictions': {str(trip_id): predictions
+                                       for trip_id, predictions in self.predictions_per_trip.items()}},
+                      to_bucketeer=to_bucketeer)
+
+# The snapshot of the process that runs the cycles
+prediction_snapshot = PredictionSnapshot()
@@ -0,0 +1,82 @@
+import hashlib
+from db_logic import get_tripstops_of_trips
+from save_and_load_variables import load_or_update_route_index, read_versioned_pickle, write_versioned_pickle
+from trip_helper import get_trip_cycle
+
+STOP_SEQUENCE_INDEX_VERSION = 1
+
+get_stop_sequence_index_filename = lambda route_id: \
+    'preprocessed/stop-sequence-index-{}.pickle'.format(route_id)
+
+# Signature of a sequence of stop ids
+get_signature = lambda stop_ids: \
+    hashlib.sha1(','.join(str(int(stop_id)) for stop_id in stop_ids).encode()).hexdigest()
+
+get_cycle_signature = lambda stop_ids: \
+    get_signature(get_trip_cycle(stop_ids) if len(stop_ids) > 0 else [])
+
+# The signatures of the stop sequence and trip cycle of each past trip of a route,
+# so that the past trips that stop at the same stops as a live trip are found with
+# one lookup, instead of fetching the tripstops of every past trip.
+class StopSequenceIndex:
+    def __init__(self, route_id, signatures=None):
+        self.route_id = route_id
+        # trip_id -> (signature of its stop ids, signature of its trip cycle)
+        self.signatures = signatures or {}
+        # ('stops' or 'cycle', signature) -> trip ids, in the order of the past trips
+        self.trip_ids_per_signature = {}
+
+    # Keep only the trips of past_trips (a dataframe from get_past_trips_of_route),
+    # and add the signatures of those that are not indexed yet with one query.
+    # Returns True if the signatures changed.
+    def update(self, past_trips):
+        trip_ids = [int(trip_id) for trip_id in past_trips.index]
+        added_trip_ids = [trip_id for trip_id in trip_ids if trip_id not in self.signatures]
+        removed_trip_ids = set(self.signatures) - set(trip_ids)
+        if added_trip_ids:
+            tripstops = get_tripstops_of_trips(added_trip_ids)
+            stop_ids_per_trip = {int(trip_id): trip_tripstops.stopId.tolist()
+                                 for trip_id, trip_tripstops in tripstops.groupby('tripId')}
+            for trip_id in added_trip_ids:
+                stop_ids = stop_ids_per_trip.get(trip_id, [])
+                self.signatures[trip_id] = (get_signature(stop_ids), get_cycle_signature(stop_ids))
+        for trip_id in removed_trip_ids:
+            del self.signatures[trip_id]
+
+        self.trip_ids_per_signature = {}
+        for trip_id in trip_ids:
+            stops_signature, cycle_signature = self.signatures[trip_id]
+            self.trip_ids_per_signature.setdefault(('stops', stops_signature), []).append(trip_id)
+            self.trip_ids_per_signature.setdefault(('cycle', cycle_signature), []).append(trip_id)
+        return bool(added_trip_ids or removed_trip_ids)
+
+    # Get the past trips with the same stop ids, most recent first
+    get_trip_ids = lambda self, stop_ids: \
+        self.trip_ids_per_signature.get(('stops', get_signature(stop_ids)), [])
+
+    # Get the past trips with the same trip cycle (for circular trips), most recent first
+    get_trip_ids_of_cycle = lambda self, stop_ids: \
+        self.trip_ids_per_signature.get(('cycle', get_cycle_signature(stop_ids)), [])
+
+    def save(self):
+        write_versioned_pickle(get_stop_sequence_index_filename(self.route_id), self.signatures,
+                               STOP_SEQUENCE_INDEX_VERSION)
+
+    @classmethod
+    def load(cls, route_id):
+        return cls(route_id, read_versioned_pickle(get_stop_sequence_index_filename(route_id),
+                                                   STOP_SEQUENCE_INDEX_VERSION))
+
+# Stop sequence indices loaded by this process
+stop_sequence_indices = {}
+
+# Get the index of the past trips of a route, updating and saving it if trips were added or dropped
+def get_stop_sequence_index(route_id, past_trips):
+    trip_ids = set(int(trip_id) for trip_id in past_trips.index)
+    stop_sequence_index = load_or_update_route_index(
+        stop_sequence_indices, route_id, StopSequenceIndex, get_stop_sequence_index_filename(route_id),
+        lambda stop_sequence_index: trip_ids == set(stop_sequence_index.signatures),
+        lambda stop_sequence_index: stop_sequence_index.update(past_trips))
+    # Only orders the trips by past_trips (if it was not just updated), without any query
+    stop_sequence_index.update(past_trips)
+    return stop_sequence_index
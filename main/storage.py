@@ -0,0 +1,96 @@
+import os
+import shutil
+from boto.exception import S3ResponseError
+from boto.s3.key import Key
+from file_system import destroy_predictions, get_bucket, get_uploader, reset_bucket
+
+# Where the published files (predictions and snapshots, read by the API) are kept:
+# 's3' (Bucketeer, the default), 'directory' (STORAGE_DIRECTORY, e.g. when the
+# worker and the API run on the same host) or 'shm' (a directory in shared memory).
+# The API must be configured with the same storage.
+STORAGE = os.environ.get('STORAGE', 's3')
+STORAGE_DIRECTORY = os.environ.get('STORAGE_DIRECTORY')
+SHARED_MEMORY_DIRECTORY = '/dev/shm/beeline-eta'
+
+# A storage writes each file at get_path(filename), then publish(filename)
+# makes it available to readers. read(filename, etag) returns
+# (contents, etag), or (None, etag) if the file still has that etag.
+
+# Files are written locally, then uploaded to Bucketeer in the background
+# (flush() waits for the uploads and returns their stats)
+class S3Storage:
+    get_path = lambda self, filename: filename
+
+    publish = lambda self, filename: get_uploader().submit(filename)
+
+    flush = lambda self: get_uploader().flush()
+
+    def read(self, filename, etag=None):
+        k = Key(get_bucket())
+        k.key = filename
+        try:
+            data = k.get_contents_as_string(headers={'If-None-Match': etag} if etag else None)
+        except S3ResponseError as e:
+            if e.status == 304:
+                return None, etag
+            reset_bucket()
+            raise
+        return data, k.etag
+
+    clear = lambda self: destroy_predictions()
+
+# Files are written straight into a directory that readers share, so they are
+# published without any copy or upload. (Files are replaced atomically, so their
+# inode changes with every write.)
+class DirectoryStorage:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_path(self, filename):
+        path = os.path.join(self.directory, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    publish = lambda self, filename: None
+
+    flush = lambda self: {}
+
+    def read(self, filename, etag=None):
+        with open(os.path.join(self.directory, filename), 'rb') as f:
+            stat = os.fstat(f.fileno())
+            new_etag = '{}-{}-{}'.format(stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if new_etag == etag:
+                return None, etag
+            return f.read(), new_etag
+
+    def clear(self):
+        for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+            path = os.path.join(self.directory, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+def get_storage_from_environment():
+    if STORAGE == 'directory':
+        if not STORAGE_DIRECTORY:
+            raise ValueError('STORAGE_DIRECTORY must be set to use STORAGE=directory')
+        return DirectoryStorage(STORAGE_DIRECTORY)
+    if STORAGE == 'shm':
+        return DirectoryStorage(SHARED_MEMORY_DIRECTORY)
+    if STORAGE == 's3':
+        return S3Storage()
+    raise ValueError('Unknown STORAGE {}'.format(STORAGE))
+
+_storage = None
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        _storage = get_storage_from_environment()
+    return _storage
+
+# Replace the process' storage, e.g. with a DirectoryStorage to run offline
+def set_storage(storage):
+    global _storage
+    _storage = storage
@@ -1,11 +1,47 @@
+import numpy as np
+import pandas
+import json
+import os
+import psycopg2
+import shutil
+import storage
+import tempfile
+import threading
+import time
 import unittest
-from clean_data import get_cleaned_trip_pings, is_sharp_turn
+from artifact_cache import ArtifactCache
+from benchmark import make_trip_pings
+from boto.exception import S3ResponseError
+from candidate_timelines import CandidateTimelines
+from clean_data import (
+    IncrementalCleaner, clean_rep, clean_rep_rows, get_cleaned_trip_pings, get_incremental_cleaner,
+    incremental_cleaners, is_sharp_turn
+)
 from datetime import datetime, timedelta
-from db_logic import get_offset, get_pings, get_stops, get_tripstops
-from run import update_timings_for_trip
-from ping_locator import list_of_nearest_pings_to_stops, list_of_nearest_pings_to_tripstops
+from db_logic import (
+    ConnectionPool, get_offset, get_pings, get_pool, get_stops, get_thread_query_count, get_tripstops, query,
+    set_pool
+)
+from file_system import Uploader, get_upload_metrics, get_uploader, set_uploader
+from kd_tree_file import read_kd_tree_file, write_kd_tree_file
+from ping_locator import get_kd_tree_of_arrays, list_of_nearest_pings_to_stops, list_of_nearest_pings_to_tripstops
+from prediction_format import format_predictions, get_prediction_filename
+from projection import p, project
+from route_index import RouteIndex, to_microseconds
+from save_and_load_variables import file_lock, load_or_update_route_index, remove_old_lock_files, write_atomically
+from scheduler import (
+    flush_published_files, get_ping_watermark, is_too_old, last_predictions, predict_before_deadline,
+    predict_route_before_deadline, prioritise_trips
+)
+from snapshot import PredictionSnapshot
+from stop_sequence_index import StopSequenceIndex, get_cycle_signature, get_signature
+from storage import DirectoryStorage, S3Storage, get_storage, set_storage
+from trip_context import TripContext
 from trip_helper import get_bearings, is_circular_trip
-from utility import is_nan
+from trip_predictor import get_predicted_arrival_times, update_timings_for_trip
+from trip_windows import TripWindowIndex
+from utility import first_n_in_order, is_nan
+from worker_pool import WorkerPool
 
 def get_predicted_arrival_timing(trip_id, stop_id, date_time):
     stop_ids_to_predicted_arrival_timings = update_timings_for_trip(date_time, trip_id, to_bucketeer=False)
@@ -16,7 +52,7 @@ def get_predicted_arrival_timing(trip_id, stop_id, date_time):
 
 def get_actual_arrival_timing(trip_id, stop_id, date_time):
     # Use default current datetime, so all pings are considered for actual arrival timings
-    if is_circular_trip(trip_id):
+    if is_circular_trip(TripContext(trip_id, datetime.now())):
         nearest_pings_id_per_stop_id = list_of_nearest_pings_to_stops(trip_id)
         if not nearest_pings_id_per_stop_id:
             return None
@@ -30,14 +66,14 @@ def get_actual_arrival_timing(trip_id, stop_id, date_time):
         stop = get_stops(stop_id=stop_id).iloc[0]
         stop_heading = stop.heading
 
-        nearest_ping_ids = [ping_ids
-                            for each_stop_id, ping_ids in nearest_pings_id_per_stop_id
-                            if each_stop_id == stop_id][0]
-        nearest_ping_ids = [ping_id
-                            for i, ping_id in enumerate(nearest_ping_ids)
-                            if not is_sharp_turn(trip_bearings[i], trip_bearings[i] if is_nan(stop_heading) else stop_heading)]
-        next_stop_actual_arrival_timings = [get_pings(ping_id=ping_id).iloc[0].time
-                                            for ping_id in nearest_ping_ids]
+        nearest_pings = [nearest_pings
+                         for each_stop_id, nearest_pings in nearest_pings_id_per_stop_id
+                         if each_stop_id == stop_id][0]
+        nearest_pings = [nearest_ping
+                         for i, nearest_ping in enumerate(nearest_pings)
+                         if not is_sharp_turn(trip_bearings[i], trip_bearings[i] if is_nan(stop_heading) else stop_heading)]
+        next_stop_actual_arrival_timings = [ping_time
+                                            for ping_id, ping_time, ping_lat, ping_lng in nearest_pings]
         arrival_timings_after_date_time = [timing
                                            for timing in next_stop_actual_arrival_timings
                                            if timing.replace(tzinfo=None) > date_time]
@@ -48,10 +84,10 @@ def get_actual_arrival_timing(trip_id, stop_id, date_time):
         nearest_ping_id_per_tripstop_id = list_of_nearest_pings_to_tripstops(trip_id)
         if not nearest_ping_id_per_tripstop_id:
             return None
-        nearest_ping_id = [ping_id
-                           for tripstop_id, ping_id in nearest_ping_id_per_tripstop_id
-                           if get_tripstops(tripstop_id=tripstop_id).iloc[0].stopId == stop_id][0]
-        next_stop_actual_arrival_timing = get_pings(ping_id=nearest_ping_id).iloc[0].time
+        next_stop_actual_arrival_timing = [ping_time
+                                           for tripstop_id, ping_id, ping_time, ping_lat, ping_lng
+                                           in nearest_ping_id_per_tripstop_id
+                                           if get_tripstops(tripstop_id=tripstop_id).iloc[0].stopId == stop_id][0]
         return next_stop_actual_arrival_timing
 
 def get_residual_time(trip_id, stop_id, date_time):
@@ -97,5 +133,557 @@ class TestPredictions(unittest.TestCase):
         # Assert no predicted arrival timing
         self.assertIsNone(predicted_arrival_timing)
 
+# In-process stand-ins for a psycopg2 connection and its cursors. Every query
+# returns rows, except 'BROKEN', which fails like a broken connection.
+class FakeConnection:
+    def __init__(self, rows=()):
+        self.closed = 0
+        self.rollbacks = 0
+        self.rows = list(rows)
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, sql, data=()):
+        if sql == 'BROKEN':
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+
+    def fetchall(self):
+        return self.connection.rows
+
+class TestConnectionPool(unittest.TestCase):
+
+    def test_connections_are_reused(self):
+        pool = ConnectionPool(connect_function=FakeConnection, max_size=2)
+        conn = pool.getconn()
+        pool.putconn(conn, queries=1)
+        self.assertIs(pool.getconn(), conn)
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertEqual(pool.get_stats()['connections_opened'], 1)
+
+    def test_broken_connections_are_replaced(self):
+        pool = ConnectionPool(connect_function=FakeConnection, max_size=1)
+        conn = pool.getconn()
+        pool.putconn(conn, close=True)
+        self.assertTrue(conn.closed)
+        self.assertIsNot(pool.getconn(), conn)
+        self.assertEqual(pool.get_stats()['size'], 1)
+
+    def test_waits_for_free_connection(self):
+        pool = ConnectionPool(connect_function=FakeConnection, max_size=1)
+        conn = pool.getconn()
+        threading.Timer(0.1, pool.putconn, args=(conn,)).start()
+        self.assertIs(pool.getconn(timeout=5), conn)
+        self.assertGreater(pool.get_stats()['max_wait_seconds'], 0)
+
+    def test_queries_through_process_pool(self):
+        process_pool = get_pool()
+        pool = ConnectionPool(connect_function=lambda: FakeConnection([(1, 'a')]), max_size=1)
+        set_pool(pool)
+        try:
+            thread_query_count = get_thread_query_count()
+            self.assertEqual(query('SELECT', pandas_format=False), [(1, 'a')])
+            self.assertRaises(psycopg2.Error, query, 'BROKEN')
+            self.assertEqual(get_thread_query_count() - thread_query_count, 2)
+            stats = pool.get_stats()
+            self.assertEqual((stats['queries'], stats['connections_closed'], stats['size']), (2, 1, 0))
+        finally:
+            set_pool(process_pool)
+
+    def test_times_out_when_exhausted(self):
+        pool = ConnectionPool(connect_function=FakeConnection, max_size=1)
+        pool.getconn()
+        with self.assertRaises(Exception):
+            pool.getconn(timeout=0.05)
+
+class TestCleanRep(unittest.TestCase):
+
+    def test_same_as_row_by_row_implementation(self):
+        for seed in range(10):
+            for number_of_pings in [0, 1, 3, 4, 10, 100, 1000]:
+                trip_pings = make_trip_pings(number_of_pings, seed=seed)
+                self.assertEqual(clean_rep(trip_pings), clean_rep_rows(trip_pings))
+
+    def test_same_as_row_by_row_implementation_on_long_trip(self):
+        trip_pings = make_trip_pings(10000, seed=42)
+        self.assertEqual(clean_rep(trip_pings), clean_rep_rows(trip_pings))
+
+class TestIncrementalCleaner(unittest.TestCase):
+
+    def test_same_as_clean_rep_on_each_prefix(self):
+        for seed in range(10):
+            trip_pings = make_trip_pings(500, seed=seed)
+            cleaner = IncrementalCleaner()
+            for number_of_pings in list(range(0, 20)) + list(range(20, 501, 7)):
+                prefix = trip_pings.iloc[:number_of_pings]
+                self.assertEqual(cleaner.update(prefix).cleaned_pings_parts, clean_rep(prefix))
+
+    # Without gaps the trip is never split, and only its last few pings are cleaned again
+    def test_only_cleans_end_of_trip_without_gaps_again(self):
+        trip_pings = make_trip_pings(1000, gaps=False)
+        cleaner = IncrementalCleaner()
+        for number_of_pings in range(6, 1001, 6):
+            prefix = trip_pings.iloc[:number_of_pings]
+            self.assertEqual(cleaner.update(prefix).cleaned_pings_parts, clean_rep(prefix))
+            self.assertEqual(len(cleaner.final_rows_parts), 0)
+            self.assertLess(len(cleaner.trailing_rows_parts[0]) - len(cleaner.final_rows_part), 20)
+
+    def test_starts_over_when_older_pings_change(self):
+        trip_pings = make_trip_pings(300, seed=1)
+        cleaner = IncrementalCleaner().update(trip_pings.iloc[:200])
+        changed_trip_pings = trip_pings.drop(trip_pings.index[50])
+        self.assertEqual(cleaner.update(changed_trip_pings).cleaned_pings_parts,
+                         clean_rep(changed_trip_pings))
+
+class TestProjection(unittest.TestCase):
+
+    def test_same_as_projecting_each_point(self):
+        trip_pings = make_trip_pings(100)
+        x, y = project(trip_pings.lat.values, trip_pings.lng.values)
+        self.assertEqual(list(zip(x, y)), [p(ping.lng, ping.lat) for ping in trip_pings.itertuples()])
+        self.assertEqual(len(project([], [])[0]), 0)
+
+class TestArtifactCache(unittest.TestCase):
+
+    def write_file(self, path, name, size):
+        filename = os.path.join(path, name)
+        with open(filename, 'wb') as f:
+            f.write(b'x' * size)
+        return filename
+
+    def test_keeps_most_recently_used_within_memory_budget(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = ArtifactCache(path, memory_budget=250, disk_budget=10000)
+            filenames = [self.write_file(path, str(i), 100) for i in range(3)]
+            read_function = lambda filename: filename
+            cache.load(filenames[0], 1, read_function)
+            cache.load(filenames[1], 1, read_function)
+            cache.load(filenames[0], 1, read_function)
+            cache.load(filenames[2], 1, read_function)
+            self.assertEqual([key[0] for key in cache.entries], [filenames[0], filenames[2]])
+            self.assertEqual(cache.get_stats()['hits'], 1)
+            self.assertEqual(cache.get_stats()['evictions'], 1)
+
+    def test_does_not_serve_other_versions(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = ArtifactCache(path)
+            filename = self.write_file(path, 'artifact', 10)
+            cache.store(filename, 1, 'version 1')
+            self.assertEqual(cache.load(filename, 1, lambda filename: 'read'), 'version 1')
+            self.assertEqual(cache.load(filename, 2, lambda filename: 'read'), 'read')
+
+    def test_deletes_least_recently_used_files_over_disk_budget(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = ArtifactCache(path, disk_budget=250)
+            # Files of routes are not evicted, even if they were not used for the longest time
+            os.utime(self.write_file(path, 'route-index-1.npz', 100), (0, 0))
+            for i in range(4):
+                filename = self.write_file(path, 'kdtree-pings-{}.bin'.format(i), 100)
+                os.utime(filename, (i + 1, i + 1))
+                cache.store(filename, 1, i)
+            self.assertEqual(sorted(os.listdir(path)), ['kdtree-pings-2.bin', 'kdtree-pings-3.bin', 'route-index-1.npz'])
+            self.assertEqual(cache.get_stats()['disk_evictions'], 2)
+
+class TestKdTreeFile(unittest.TestCase):
+
+    def test_read_what_was_written(self):
+        ping_arrays = (np.array([[1.5, 2.5], [3.5, 4.5]]), np.array([1499216282000000, 1499216293000000]),
+                       np.array([7, 8]))
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'kdtree-pings-1.bin')
+            write_kd_tree_file(filename, ping_arrays)
+            x_y, times, ping_ids = read_kd_tree_file(filename)
+            self.assertEqual((x_y.tolist(), times.tolist(), ping_ids.tolist()),
+                             tuple(array.tolist() for array in ping_arrays))
+            # The KD-tree is built on the mapped x, y, without copying them
+            self.assertTrue(np.shares_memory(get_kd_tree_of_arrays((x_y, times, ping_ids)).data, x_y))
+
+    def test_rejects_other_formats(self):
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'kdtree-pings-1.bin')
+            with open(filename, 'wb') as f:
+                f.write(b'not a KD-tree file')
+            self.assertRaises(ValueError, read_kd_tree_file, filename)
+
+class TestWriteAtomically(unittest.TestCase):
+
+    def test_keeps_old_file_if_writing_fails(self):
+        def write_partially(f):
+            f.write(b'partial')
+            raise IOError('Disk full')
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'artifact')
+            write_atomically(filename, lambda f: f.write(b'old'))
+            self.assertRaises(IOError, write_atomically, filename, write_partially)
+            with open(filename, 'rb') as f:
+                self.assertEqual(f.read(), b'old')
+            self.assertEqual(os.listdir(path), ['artifact'])
+
+    def test_gives_files_the_mode_of_open(self):
+        with tempfile.TemporaryDirectory() as path:
+            with open(os.path.join(path, 'opened'), 'wb') as f:
+                f.write(b'opened')
+            write_atomically(os.path.join(path, 'written'), lambda f: f.write(b'written'))
+            self.assertEqual(os.stat(os.path.join(path, 'written')).st_mode,
+                             os.stat(os.path.join(path, 'opened')).st_mode)
+
+# Returns the pid of the worker that ran it, or exits the worker
+def get_worker_pid(should_exit=False):
+    if should_exit:
+        os._exit(1)
+    return os.getpid()
+
+class TestUploader(unittest.TestCase):
+    def test_uploads_to_directory_with_retries(self):
+        with tempfile.TemporaryDirectory() as path:
+            os.makedirs(os.path.join(path, 'bucket'))
+            filenames = [os.path.join(path, 'prediction-{}.json'.format(i)) for i in range(5)]
+            for filename in filenames:
+                with open(filename, 'w') as f:
+                    f.write('{}')
+            failures = {filenames[0]: 1, filenames[1]: 5}
+            def upload(filename):
+                if failures.get(filename, 0) > 0:
+                    failures[filename] -= 1
+                    raise IOError('Connection reset')
+                shutil.copy(filename, os.path.join(path, 'bucket'))
+
+            uploader = Uploader(upload, max_threads=2, max_attempts=3, backoff_seconds=0)
+            for filename in filenames:
+                uploader.submit(filename)
+            upload_stats = uploader.flush()
+            self.assertEqual(sorted(os.listdir(os.path.join(path, 'bucket'))),
+                             ['prediction-{}.json'.format(i) for i in [0, 2, 3, 4]])
+            self.assertEqual(upload_stats[filenames[0]]['attempts'], 2)
+            self.assertTrue(upload_stats[filenames[1]]['failed'])
+            metrics = get_upload_metrics(upload_stats.values())
+            self.assertEqual((metrics['uploads'], metrics['uploaded_bytes'], metrics['failed_uploads'],
+                              metrics['retried_uploads']), (5, 8, 1, 2))
+            self.assertEqual(uploader.flush(), {})
+
+class TestDirectoryStorage(unittest.TestCase):
+    def test_publishes_files_in_place(self):
+        with tempfile.TemporaryDirectory() as path:
+            storage = DirectoryStorage(path)
+            write_atomically(storage.get_path('results/a.json'), lambda f: f.write(b'{}'))
+            storage.publish('results/a.json')
+            data, etag = storage.read('results/a.json')
+            self.assertEqual(data, b'{}')
+            self.assertEqual(storage.read('results/a.json', etag), (None, etag))
+            write_atomically(storage.get_path('results/a.json'), lambda f: f.write(b'[]'))
+            self.assertEqual(storage.read('results/a.json', etag)[0], b'[]')
+            storage.clear()
+            self.assertEqual(os.listdir(path), [])
+
+# In-process stand-in for the boto Key of a file in S3, which answers conditional GETs like S3
+class FakeKey:
+    contents = b'{}'
+    etag = '"etag"'
+
+    def __init__(self, bucket):
+        self.key = None
+
+    def get_contents_as_string(self, headers=None):
+        if headers and headers.get('If-None-Match') == FakeKey.etag:
+            raise S3ResponseError(304, 'Not Modified')
+        return FakeKey.contents
+
+class TestS3Storage(unittest.TestCase):
+    def setUp(self):
+        self.Key, self.get_bucket = storage.Key, storage.get_bucket
+        storage.Key, storage.get_bucket = FakeKey, lambda: None
+
+    def tearDown(self):
+        storage.Key, storage.get_bucket = self.Key, self.get_bucket
+
+    def test_uploads_published_files(self):
+        process_uploader = get_uploader()
+        uploaded = []
+        set_uploader(Uploader(uploaded.append, max_threads=1))
+        try:
+            with tempfile.NamedTemporaryFile() as f:
+                S3Storage().publish(f.name)
+                self.assertEqual(list(S3Storage().flush()), [f.name])
+                self.assertEqual(uploaded, [f.name])
+        finally:
+            set_uploader(process_uploader)
+
+    def test_reads_file_unless_not_modified(self):
+        self.assertEqual(S3Storage().read('results/a.json'), (b'{}', '"etag"'))
+        self.assertEqual(S3Storage().read('results/a.json', '"etag"'), (None, '"etag"'))
+        self.assertEqual(S3Storage().read('results/a.json', '"other etag"'), (b'{}', '"etag"'))
+
+class TestFileLock(unittest.TestCase):
+    def test_does_not_remove_held_lock_files(self):
+        with tempfile.TemporaryDirectory() as path:
+            lock_filename = os.path.join(path, 'locks', 'route-index-1.npz.lock')
+            with file_lock(os.path.join(path, 'route-index-1.npz')):
+                os.utime(lock_filename, (0, 0))
+                remove_old_lock_files(path)
+                self.assertTrue(os.path.exists(lock_filename))
+            os.utime(lock_filename, (0, 0))
+            remove_old_lock_files(path)
+            self.assertFalse(os.path.exists(lock_filename))
+
+class FakeRouteIndex:
+    saved = {}
+
+    def __init__(self, route_id, trip_ids=()):
+        self.route_id = route_id
+        self.trip_ids = set(trip_ids)
+
+    def save(self):
+        FakeRouteIndex.saved[self.route_id] = set(self.trip_ids)
+
+    @classmethod
+    def load(cls, route_id):
+        if route_id not in cls.saved:
+            raise IOError('No such file')
+        return cls(route_id, cls.saved[route_id])
+
+class TestLoadOrUpdateRouteIndex(unittest.TestCase):
+    def test_updates_saved_index_once(self):
+        FakeRouteIndex.saved = {}
+        updates = []
+        def get_index(indices, trip_ids):
+            def update(index):
+                updates.append(trip_ids)
+                changed = index.trip_ids != set(trip_ids)
+                index.trip_ids = set(trip_ids)
+                return changed
+            with tempfile.TemporaryDirectory() as path:
+                return load_or_update_route_index(indices, 1, FakeRouteIndex, os.path.join(path, 'index-1'),
+                                                  lambda index: index.trip_ids == set(trip_ids), update)
+
+        self.assertEqual(get_index({}, [10, 11]).trip_ids, {10, 11})
+        self.assertEqual(FakeRouteIndex.saved, {1: {10, 11}})
+        # Another process loads the saved index instead of updating it
+        other_indices = {}
+        self.assertEqual(get_index(other_indices, [10, 11]).trip_ids, {10, 11})
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(get_index(other_indices, [11, 12]).trip_ids, {11, 12})
+        self.assertEqual(FakeRouteIndex.saved, {1: {11, 12}})
+
+class TestWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = WorkerPool(3)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_same_key_goes_to_same_worker(self):
+        for i in range(2):
+            pids = self.pool.map(get_worker_pid, [()] * 12, keys=[0, 1, 2, 3] * 3)
+            self.assertEqual(pids[:4] * 3, pids)
+            self.assertEqual(len(set(pids)), 3)
+            self.assertTrue(os.getpid() not in pids)
+
+    def test_restarts_workers_that_die(self):
+        pids = self.pool.map(get_worker_pid, [(False,), (True,), (False,)], keys=[0, 0, 0])
+        self.assertEqual(pids[1], None)
+        self.assertNotEqual(pids[0], pids[2])
+        self.assertEqual(self.pool.get_stats()[0]['restarts'], 1)
+        self.assertEqual(len(set(self.pool.map(get_worker_pid, [()] * 3, keys=[0, 1, 2]))), 3)
+
+class TestScheduler(unittest.TestCase):
+
+    def tearDown(self):
+        last_predictions.pop(-1, None)
+        incremental_cleaners.pop(-1, None)
+
+    def test_trips_with_new_pings_and_closest_to_next_stop_go_first(self):
+        date_time = datetime(2017, 7, 6, 9, 10, 0)
+        pings_per_trip = {1: make_trip_pings(10, trip_id=1, start_time=datetime(2017, 7, 6, 9, 0, 0)),
+                          2: make_trip_pings(10, trip_id=2, start_time=datetime(2017, 7, 6, 9, 8, 0)),
+                          3: make_trip_pings(10, trip_id=3, start_time=datetime(2017, 7, 6, 9, 8, 0)),
+                          4: make_trip_pings(0, trip_id=4)}
+        for trip_pings in pings_per_trip.values():
+            trip_pings['x'], trip_pings['y'] = 0.0, 0.0
+        tripstops = pandas.DataFrame({'tripId': [1, 2, 2, 3],
+                                      'time': pandas.to_datetime(['2017-07-06 09:20', '2017-07-06 09:00',
+                                                                  '2017-07-06 09:20', '2017-07-06 09:20'])
+                                                    .tz_localize('Asia/Singapore'),
+                                      'x': [0.0, 0.0, 500.0, 100.0],
+                                      'y': [0.0, 0.0, 0.0, 0.0]})
+        trip_ids = prioritise_trips([1, 2, 3, 4], pings_per_trip, tripstops, date_time,
+                                    previous_date_time=datetime(2017, 7, 6, 9, 9, 0))
+        self.assertEqual(trip_ids, [3, 2, 1, 4])
+
+    def test_skips_trips_after_deadline(self):
+        result = predict_before_deadline(0, datetime(2017, 7, 6, 9, 10, 0), 1, None)
+        self.assertEqual(result['status'], 'skipped')
+
+    def test_does_not_predict_trips_without_new_pings_again(self):
+        date_time = datetime(2017, 7, 6, 9, 10, 0)
+        trip_pings = make_trip_pings(50, trip_id=-1, start_time=datetime(2017, 7, 6, 9, 0, 0))
+        get_incremental_cleaner(-1).update(trip_pings)
+        last_predictions[-1] = (get_ping_watermark(trip_pings), date_time.date(), is_too_old(-1, date_time))
+        self.assertEqual(predict_before_deadline(0, date_time, -1, trip_pings)['status'], 'unchanged')
+        # New pings, or the latest ping getting too old, change the prediction
+        self.assertEqual(predict_before_deadline(0, date_time, -1, make_trip_pings(51, trip_id=-1))['status'],
+                         'skipped')
+        self.assertEqual(predict_before_deadline(0, date_time + timedelta(minutes=10), -1, trip_pings)['status'],
+                         'skipped')
+        self.assertEqual(predict_before_deadline(0, date_time, -1, trip_pings, recompute=True)['status'],
+                         'skipped')
+
+    # A cycle offline: the database and the storage are stand-ins in this process
+    def test_publishes_predictions_to_storage(self):
+        process_pool, process_storage = get_pool(), get_storage()
+        tz = pandas.Timestamp('2017-07-06 09:00:00+08:00').tzinfo
+        tripstops = [(1, -1, 101, True, False, datetime(2017, 7, 6, 10, 10, tzinfo=tz), 103.8, 1.3),
+                     (2, -1, 102, True, False, datetime(2017, 7, 6, 10, 20, tzinfo=tz), 103.81, 1.31)]
+        set_pool(ConnectionPool(connect_function=lambda: FakeConnection(tripstops)))
+        try:
+            with tempfile.TemporaryDirectory() as path:
+                set_storage(DirectoryStorage(path))
+                # The latest ping is too old to predict from
+                trip_pings = make_trip_pings(50, trip_id=-1, start_time=datetime(2017, 7, 6, 9, 0, 0))
+                result, = predict_route_before_deadline(time.time() + 60, datetime(2017, 7, 6, 10, 0, 0),
+                                                        [-1], [trip_pings])
+                self.assertEqual(result['status'], 'predicted')
+                self.assertEqual(flush_published_files(), {})
+                data, etag = get_storage().read(get_prediction_filename(-1))
+                self.assertEqual(json.loads(data.decode('utf-8')), result['predictions'])
+                self.assertEqual(sorted(result['predictions']['stops']), ['101', '102'])
+                self.assertFalse(result['predictions']['stops']['101']['valid'])
+        finally:
+            set_pool(process_pool)
+            set_storage(process_storage)
+
+    def test_forgets_last_predictions_of_other_days(self):
+        date_time = datetime(2017, 7, 6, 9, 10, 0)
+        last_predictions[-1] = ((0, None), date_time.date() - timedelta(days=1), True)
+        predict_before_deadline(0, date_time, -1, None)
+        self.assertNotIn(-1, last_predictions)
+
+class TestRouteIndex(unittest.TestCase):
+
+    def test_nearest_ping_of_each_trip(self):
+        times = to_microseconds(['2017-07-06 01:00:00', '2017-07-06 01:00:10', '2017-07-06 01:00:20',
+                                 '2017-07-05 01:00:00', '2017-07-05 01:00:30'])
+        route_index = RouteIndex(1, arrays={'trip_id': np.array([10, 10, 10, 11, 11]),
+                                            'position': np.array([0, 1, 2, 0, 1]),
+                                            'ping_id': np.array([100, 101, 102, 110, 111]),
+                                            'time': times,
+                                            'x': np.array([0.0, 5.0, 100.0, 0.0, 1.0]),
+                                            'y': np.zeros(5)},
+                                 indexed_trip_ids=[10, 11, 12])
+        nearest_pings = route_index.query_nearest_pings(
+            [0.0, 0.0], pandas.Timestamp('2017-07-06 09:00:25+08:00'), r=20)
+        self.assertEqual(sorted(nearest_pings), [10, 11])
+        self.assertEqual(nearest_pings[10][0], 101)
+        self.assertEqual(nearest_pings[11][0], 111)
+        self.assertEqual(nearest_pings[10][1], pandas.Timestamp('2017-07-06 01:00:10', tz='UTC'))
+
+class TestPredictedArrivalTimes(unittest.TestCase):
+    def test_takes_the_trimmed_mean_of_the_durations(self):
+        most_recent_ping = pandas.Series({'time': pandas.Timestamp('2017-07-06 09:00:00+08:00')})
+        tripstops = pandas.DataFrame({'time': [pandas.Timestamp('2017-07-06 09:05:00+08:00'),
+                                               pandas.Timestamp('2017-07-06 09:20:00+08:00')]})
+        durations = [np.array([60.0, 600.0]), np.array([120.0, 900.0]), np.array([0.0, 660.0])]
+        predicted_arrival_times = get_predicted_arrival_times(durations, most_recent_ping, tripstops)
+        # The first stop is not predicted before its planned time
+        self.assertEqual(predicted_arrival_times[0], datetime(2017, 7, 6, 9, 5, tzinfo=predicted_arrival_times[0].tzinfo))
+        self.assertEqual(predicted_arrival_times[1], datetime(2017, 7, 6, 9, 11, tzinfo=predicted_arrival_times[1].tzinfo))
+        self.assertEqual(get_predicted_arrival_times([], most_recent_ping, tripstops), [])
+
+class TestFirstNInOrder(unittest.TestCase):
+    def test_keeps_the_order_of_the_items(self):
+        function = lambda item: time.sleep(0.05 if item == 0 else 0) or (None if item % 2 else item * 10)
+        # The later items finish first
+        self.assertEqual(first_n_in_order(function, list(range(10)), 2, max_threads=4), [0, 20])
+        self.assertEqual(first_n_in_order(function, list(range(10)), 2), [0, 20])
+
+    def test_cancels_the_items_after_the_results(self):
+        evaluated = []
+        function = lambda item: time.sleep(0.02) or evaluated.append(item) or item
+        self.assertEqual(first_n_in_order(function, list(range(20)), 3, max_threads=2), [0, 1, 2])
+        self.assertLess(len(evaluated), 20)
+
+class TestCandidateTimelines(unittest.TestCase):
+    def test_keeps_only_the_given_trips(self):
+        timeline = [pandas.Timestamp('2017-07-05 09:00:00+08:00'), pandas.Timestamp('2017-07-05 09:10:00+08:00')]
+        candidate_timelines = CandidateTimelines(1, {1: timeline, 2: None, 3: timeline})
+        self.assertTrue(candidate_timelines.update([1, 2], datetime(2017, 7, 6, 9, 0)))
+        self.assertFalse(candidate_timelines.update([1, 2], datetime(2017, 7, 6, 9, 0)))
+        self.assertEqual(candidate_timelines.get_timeline(1), timeline)
+        self.assertTrue(candidate_timelines.is_validated(2))
+        self.assertIsNone(candidate_timelines.get_timeline(2))
+        self.assertFalse(candidate_timelines.is_validated(3))
+
+class TestStopSequenceIndex(unittest.TestCase):
+    def test_finds_trips_with_the_same_stops(self):
+        signatures = {trip_id: (get_signature(stop_ids), get_cycle_signature(stop_ids))
+                      for trip_id, stop_ids in [(1, [10, 11, 12]), (2, [10, 12]), (3, [10, 11, 12]),
+                                                (4, [10, 11, 10, 11])]}
+        index = StopSequenceIndex(1, signatures)
+        past_trips = pandas.DataFrame({'date': [datetime(2017, 7, 5)] * 3}, index=[3, 2, 1])
+        self.assertTrue(index.update(past_trips)) # Trip 4 is dropped
+        self.assertEqual(index.get_trip_ids([10, 11, 12]), [3, 1])
+        self.assertEqual(index.get_trip_ids([10, 11]), [])
+        self.assertEqual(index.get_trip_ids_of_cycle([10, 12, 10, 12]), [2])
+
+class TestPredictionSnapshot(unittest.TestCase):
+    def test_keeps_the_predictions_of_trips_that_were_not_predicted(self):
+        snapshot = PredictionSnapshot()
+        snapshot.update([{'trip_id': 1, 'status': 'predicted', 'predictions': {10: 'a'}},
+                         {'trip_id': 2, 'status': 'predicted', 'predictions': {10: 'b'}}])
+        snapshot.update([{'trip_id': 1, 'status': 'unchanged', 'predictions': None}, None,
+                         {'trip_id': 2, 'status': 'predicted', 'predictions': {10: 'c'}}])
+        self.assertEqual(snapshot.predictions_per_trip, {1: {10: 'a'}, 2: {10: 'c'}})
+        snapshot.keep_only([2, 3])
+        self.assertEqual(snapshot.predictions_per_trip, {2: {10: 'c'}})
+
+class TestPredictionFormat(unittest.TestCase):
+    def test_formats_predictions(self):
+        eta = pandas.Timestamp('2017-07-06 09:00:00+08:00')
+        predictions = format_predictions({10: eta, 11: 'No prediction: Insufficient historical data for prediction.'})
+        self.assertEqual(predictions['stops'], {'10': {'valid': True, 'eta': '2017-07-06T09:00:00+0800'},
+                                                '11': {'valid': False,
+                                                       'reason': 'No prediction: Insufficient historical data for prediction.'}})
+        self.assertEqual(predictions['etaStopIds'], ['10'])
+        self.assertEqual(predictions['etaEpochs'], [1499302800.0])
+
+class TestTripWindowIndex(unittest.TestCase):
+    def test_finds_operating_trips(self):
+        tz = pandas.Timestamp('2017-07-06 09:00:00+08:00').tzinfo
+        windows = [(1, datetime(2017, 7, 6, 9, 0, tzinfo=tz), datetime(2017, 7, 6, 10, 0, tzinfo=tz)),
+                   (2, datetime(2017, 7, 6, 9, 50, tzinfo=tz), datetime(2017, 7, 6, 10, 30, tzinfo=tz))]
+        get_trip_windows = lambda after_date, before_date, after_trip_id=0: \
+            [window for window in windows if window[0] > after_trip_id]
+        index = TripWindowIndex(get_trip_windows, refresh_seconds=0)
+        self.assertEqual(index.get_operating_trip_ids(datetime(2017, 7, 6, 8, 44)), [])
+        self.assertEqual(index.get_operating_trip_ids(datetime(2017, 7, 6, 8, 45)), [1])
+        self.assertEqual(index.get_operating_trip_ids(datetime(2017, 7, 6, 10, 10)), [1, 2])
+        self.assertEqual(index.get_operating_trip_ids(datetime(2017, 7, 6, 10, 40)), [2])
+
+        # Trips added during the day are found once the windows are refreshed
+        windows.append((3, datetime(2017, 7, 6, 8, 0, tzinfo=tz), datetime(2017, 7, 6, 11, 0, tzinfo=tz)))
+        self.assertEqual(index.get_operating_trip_ids(datetime(2017, 7, 6, 10, 40)), [2, 3])
+        self.assertEqual(index.max_trip_id, 3)
+
+        # The windows of another day replace them
+        del windows[:]
+        self.assertEqual(index.get_operating_trip_ids(datetime(2017, 7, 7, 10, 40)), [])
+        self.assertEqual(index.max_duration, np.timedelta64(0, 'us'))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,81 @@
+from clean_data import clean_rep, get_incremental_cleaner
+from db_logic import get_pings, get_thread_query_count, get_trips, get_tripstops
+from trip_helper import get_most_recent_pings, is_circular_trip
+from utility import flatten
+
+# Everything needed to predict one trip at one date_time.
+# Each lookup (trip, tripstops, pings, cleaned pings) is done at most once,
+# on first use, and shared by check_rep, trip_helper and trip_predictor.
+# Live trips are cleaned incrementally, reusing the work of previous cycles.
+class TripContext:
+    def __init__(self, trip_id, date_time, trip_pings=None, incremental=False):
+        self.trip_id = trip_id
+        self.date_time = date_time
+        self.incremental = incremental
+        self.cache = {}
+        # Pings that were already fetched up to date_time (e.g. by run.run)
+        if trip_pings is not None:
+            self.cache['pings'] = trip_pings
+        # Number of database queries issued by the lookups of this context
+        # (and of the candidate trips it loaded, see trip_predictor)
+        self.query_count = 0
+
+    def memoize(self, name, function):
+        if name not in self.cache:
+            self.cache[name] = function()
+        return self.cache[name]
+
+    # Memoize a lookup in the database, counting the queries it issued
+    def memoize_query(self, name, function):
+        def counted_function():
+            start_query_count = get_thread_query_count()
+            try:
+                return function()
+            finally:
+                self.query_count += get_thread_query_count() - start_query_count
+        return self.memoize(name, counted_function)
+
+    @property
+    def trip(self):
+        return self.memoize_query('trip', lambda: get_trips(trip_id=self.trip_id).iloc[0])
+
+    @property
+    def route_id(self):
+        return self.trip.routeId
+
+    @property
+    def tripstops(self):
+        return self.memoize_query('tripstops', lambda: get_tripstops(trip_id=self.trip_id))
+
+    @property
+    def pings(self):
+        return self.memoize_query('pings',
+            lambda: get_pings(trip_id=self.trip_id, newest_datetime=self.date_time))
+
+    # Pings sorted starting from the most recent ping
+    @property
+    def most_recent_pings(self):
+        return self.memoize('most_recent_pings', lambda: get_most_recent_pings(self))
+
+    @property
+    def cleaned_pings_parts(self):
+        if self.incremental:
+            return self.memoize('cleaned_pings_parts',
+                lambda: get_incremental_cleaner(self.trip_id).update(self.pings).cleaned_pings_parts)
+        return self.memoize('cleaned_pings_parts', lambda: clean_rep(self.pings))
+
+    @property
+    def cleaned_pings(self):
+        return self.memoize('cleaned_pings', lambda: flatten(self.cleaned_pings_parts))
+
+    @property
+    def is_circular(self):
+        return self.memoize('is_circular', lambda: is_circular_trip(self))
+
+# Get the context of trip_id at date_time from contexts (trip_id -> TripContext),
+# adding it if it is not there. The indices of a route that are updated together
+# share their contexts, so that each trip is fetched and cleaned once for all of them.
+def get_shared_context(contexts, trip_id, date_time):
+    if trip_id not in contexts:
+        contexts[trip_id] = TripContext(trip_id, date_time)
+    return contexts[trip_id]
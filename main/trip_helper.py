@@ -1,14 +1,14 @@
+import math
+import numpy as np
 import pandas
 from constants import DATE_FORMAT
 from datetime import datetime, timedelta
-from db_logic import get_tripstops, get_pings
 from utility import latlng_bearing, latlng_distance
 
-# Get pings from first trip ping time to current date_time,
+# Get pings (of a TripContext) from first trip ping time to its date_time,
 # sorted starting from the most recent ping.
-def get_most_recent_pings(trip_id, date_time):
-    return get_pings(trip_id=trip_id, newest_datetime=date_time) \
-           .sort_values('time', ascending=False)
+get_most_recent_pings = lambda context: \
+    context.pings.sort_values('time', ascending=False)
 
 # Get the list of distances between each consecutive ping pairs
 get_distances = lambda trip_pings: \
@@ -30,11 +30,49 @@ get_speeds = lambda trip_pings: \
     [distance/timing if timing > 0 else 0
      for distance, timing in list(zip(get_distances(trip_pings), get_intervals(trip_pings)))]
 
-# Determine if a trip's route is circular
+# Get the lat, lng and time (in microseconds since epoch) of trip pings as contiguous arrays.
+# Integer times keep the intervals exactly equal to timedelta.total_seconds().
+def get_ping_arrays(trip_pings):
+    lat = np.ascontiguousarray(trip_pings['lat'].values, dtype=np.float64)
+    lng = np.ascontiguousarray(trip_pings['lng'].values, dtype=np.float64)
+    time = pandas.to_datetime(trip_pings['time'], utc=True).values \
+        .astype('datetime64[us]').astype(np.int64)
+    return lat, lng, time
+
+# Vectorised latlng_distance from each point to its respective next point
+def get_distances_array(lat, lng):
+    lat_r = lat / 180 * math.pi
+    lng_r = lng / 180 * math.pi
+    dx = (lng_r[:-1] - lng_r[1:]) * np.cos(0.5 * (lat_r[:-1] + lat_r[1:]))
+    dy = lat_r[:-1] - lat_r[1:]
+    return np.sqrt(dx * dx + dy * dy) * 6371000
+
+# Vectorised latlng_bearing from each point to its respective next point
+def get_bearings_array(lat, lng):
+    lat_r = lat * (math.pi / 180.0)
+    diff_lng = (lng[1:] - lng[:-1]) * (math.pi / 180.0)
+    x = np.sin(diff_lng) * np.cos(lat_r[1:])
+    y = np.cos(lat_r[:-1]) * np.sin(lat_r[1:]) \
+        - (np.sin(lat_r[:-1]) * np.cos(lat_r[1:]) * np.cos(diff_lng))
+    return (np.arctan2(x, y) * (180.0 / math.pi) + 360) % 360
+
+# Vectorised get_intervals (in seconds), from an array of times in microseconds
+get_intervals_array = lambda time: np.diff(time) / 1e6
+
+# Vectorised get_speeds
+def get_speeds_array(lat, lng, time):
+    distances = get_distances_array(lat, lng)
+    intervals = get_intervals_array(time)
+    speeds = np.zeros(len(distances))
+    moving = intervals > 0
+    speeds[moving] = distances[moving] / intervals[moving]
+    return speeds
+
+# Determine if a trip's route (given its TripContext) is circular
 # The heuristics here is checking if any tripstop is repeated more than once.
-is_circular_trip = lambda trip_id: any([count > 1 
+is_circular_trip = lambda context: any([count > 1 
                                         for count in 
-                                        get_tripstops(trip_id=trip_id)
+                                        context.tripstops
                                         .groupby('stopId')
                                         .size()])
 
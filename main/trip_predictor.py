@@ -1,144 +1,246 @@
 import numpy as np
 import pandas
-from clean_data import check_rep, get_cleaned_trip_pings, is_sharp_turn
-from constants import DATETIME_FORMAT, DATE_FORMAT
-from datetime import datetime, timedelta
+from artifact_cache import artifact_cache
+from candidate_timelines import get_candidate_timelines, get_trip_timeline
+from clean_data import check_rep, is_sharp_turn
+from constants import DATE_FORMAT
+from datetime import timedelta
 from db_logic import (
-    get_pings, get_trips, get_tripstops, get_past_trips_of_route, reset_connection
+    POOL_SIZE, get_past_trips_of_route, reset_connection
 )
 from ping_locator import (
-    get_kd_tree, list_of_nearest_pings_to_tripstops, list_of_nearest_pings_to_stops, p
+    get_kd_tree, list_of_nearest_pings_to_stops
 )
-from save_and_load_variables import write_to_pickle
-from trip_helper import (
-    is_circular_trip, get_bearings,
-    get_most_recent_pings, get_trip_cycle
-)
-from utility import is_sorted, latlng_distance, transpose
-
-def update_timings_for_trip(date_time, trip_id, to_bucketeer=True):
-    trip_tripstops = get_tripstops(trip_id=trip_id)
-
-    stop_ids = trip_tripstops.stopId.tolist()
-    if is_circular_trip(trip_id):
-        stop_ids = get_trip_cycle(stop_ids)
-
-    tripstop_arrival_times = [datetime.strptime(str(date_time), DATETIME_FORMAT + '+08:00')
-                              for date_time in trip_tripstops.time.tolist()]
-
-    # If the pings for trip_id fails check_rep, we show them the error message
-    message = check_rep(trip_id, date_time=date_time)
-    if message.startswith('No prediction'):
-        update_prediction(trip_id, stop_ids, [message] * len(trip_tripstops), to_bucketeer=to_bucketeer)
-        return
-
-    predicted_arrival_times = []
-
-    if is_circular_trip(trip_id):
-        #predicted_arrival_times = predict_arrival_times_for_circular_trips(trip_id, date_time)
-        message = 'No prediction: Circular route prediction will be implemented in the future.'
-        update_prediction(trip_id, stop_ids, [message] * len(trip_tripstops), to_bucketeer=to_bucketeer)
-        return
-    else:
-        predicted_arrival_times = predict_arrival_times_for_normal_trips(trip_id, date_time)
+from prediction_format import format_predictions, get_prediction_filename
+from route_index import get_route_index
+from save_and_load_variables import write_to_json
+from stop_sequence_index import get_stop_sequence_index
+from trip_context import TripContext
+from trip_helper import get_bearings, get_trip_cycle
+from utility import first_n_in_order, latlng_distance, transpose
+
+# Number of historical trips that a normal trip's prediction is averaged over
+MAX_CANDIDATES = 5
+# Number of candidate trips that are loaded at once, one per database connection
+MAX_CANDIDATE_THREADS = POOL_SIZE
+
+# trip_pings are the pings of trip_id up to date_time, if they were already
+# fetched (e.g. by the cycle-level loader in run.run).
+def update_timings_for_trip(date_time, trip_id, to_bucketeer=True, trip_pings=None,
+                            max_candidates=MAX_CANDIDATES):
+    return update_timings_for_trips(date_time, [trip_id], to_bucketeer=to_bucketeer,
+                                    pings_of_trips=[trip_pings], max_candidates=max_candidates)[trip_id]
+
+# Predict several trips together (e.g. the operating trips of a route), so that the
+# historical trips of each route are loaded and queried once for all its trips.
+# pings_of_trips are the pings of each of trip_ids, if they were already fetched.
+# What is saved for each trip (its predictions or error messages) is added to
+# published_predictions, if it is given.
+# Output format: {trip_id: predictions (or None)}
+def update_timings_for_trips(date_time, trip_ids, to_bucketeer=True, pings_of_trips=None,
+                             max_candidates=MAX_CANDIDATES, published_predictions=None):
+    pings_of_trips = pings_of_trips or [None] * len(trip_ids)
+    contexts = [TripContext(trip_id, date_time, trip_pings=trip_pings, incremental=True)
+                for trip_id, trip_pings in zip(trip_ids, pings_of_trips)]
+    predictions_per_trip = predict_trips(contexts, to_bucketeer=to_bucketeer, max_candidates=max_candidates,
+                                         published_predictions=published_predictions)
+    for context in contexts:
+        print('Trip {} issued {} queries'.format(context.trip_id, context.query_count))
+    print('Artifact cache: {}'.format(artifact_cache.get_stats()))
+    return predictions_per_trip
+
+def get_stop_ids(context):
+    stop_ids = context.tripstops.stopId.tolist()
+    return get_trip_cycle(stop_ids) if context.is_circular else stop_ids
+
+def predict_trips(contexts, to_bucketeer=True, max_candidates=MAX_CANDIDATES, published_predictions=None):
+    predictions_per_trip = {}
+    published_predictions = {} if published_predictions is None else published_predictions
+    normal_contexts = []
+    for context in contexts:
+        trip_id, stop_ids = context.trip_id, get_stop_ids(context)
+        predictions_per_trip[trip_id] = None
+
+        # If the pings for trip_id fails check_rep, we show them the error message
+        message = check_rep(context)
+        if message.startswith('No prediction'):
+            published_predictions[trip_id] = \
+                update_prediction(trip_id, stop_ids, [message] * len(context.tripstops), to_bucketeer=to_bucketeer)
+            continue
 
-    if not predicted_arrival_times:
-        message = 'No prediction: Insufficient historical data for prediction.'
-        update_prediction(trip_id, stop_ids, [message] * len(trip_tripstops), to_bucketeer=to_bucketeer)
-        return
+        if context.is_circular:
+            #predicted_arrival_times = predict_arrival_times_for_circular_trips(context)
+            message = 'No prediction: Circular route prediction will be implemented in the future.'
+            published_predictions[trip_id] = \
+                update_prediction(trip_id, stop_ids, [message] * len(context.tripstops), to_bucketeer=to_bucketeer)
+            continue
+        normal_contexts.append(context)
+
+    predicted_arrival_times_per_trip = \
+        predict_arrival_times_for_normal_trips(normal_contexts, max_candidates=max_candidates)
+
+    for context in normal_contexts:
+        trip_id, stop_ids = context.trip_id, get_stop_ids(context)
+        predicted_arrival_times = predicted_arrival_times_per_trip.get(trip_id)
+        if not predicted_arrival_times:
+            message = 'No prediction: Insufficient historical data for prediction.'
+            published_predictions[trip_id] = \
+                update_prediction(trip_id, stop_ids, [message] * len(context.tripstops), to_bucketeer=to_bucketeer)
+            continue
 
-    # Save and overwrite prediction
-    update_prediction(trip_id, stop_ids, predicted_arrival_times, to_bucketeer=to_bucketeer)
+        # Save and overwrite prediction
+        published_predictions[trip_id] = \
+            update_prediction(trip_id, stop_ids, predicted_arrival_times, to_bucketeer=to_bucketeer)
+        predictions_per_trip[trip_id] = dict(zip(stop_ids, predicted_arrival_times))
 
-    return dict(zip(stop_ids, predicted_arrival_times))
+    return predictions_per_trip
 
 
+# Save the predictions of a trip (in the format of prediction_format), and return what was saved
 def update_prediction(trip_id, stop_ids, predicted_arrival_times, to_bucketeer=True):
-    filename = 'results/prediction-{}.pickle'.format(str(trip_id))
-    write_to_pickle(filename, dict(zip(stop_ids, predicted_arrival_times)), to_bucketeer=to_bucketeer)
-
-def predict_arrival_times_for_normal_trips(main_trip_id, date_time):
+    predictions = format_predictions(dict(zip(stop_ids, predicted_arrival_times)))
+    write_to_json(get_prediction_filename(trip_id), predictions, to_bucketeer=to_bucketeer)
+    return predictions
+
+to_microseconds_since_epoch = lambda time: pandas.Timestamp(time).value // 1000
+
+# Output format: {trip_id: predicted arrival times at its tripstops (or None)}
+def predict_arrival_times_for_normal_trips(contexts, max_candidates=MAX_CANDIDATES):
+    contexts_per_route = {}
+    for context in contexts:
+        contexts_per_route.setdefault(context.route_id, []).append(context)
+    predicted_arrival_times_per_trip = {}
+    for route_id, route_contexts in contexts_per_route.items():
+        predicted_arrival_times_per_trip.update(
+            predict_arrival_times_for_normal_trips_of_route(route_id, route_contexts, max_candidates))
+    return predicted_arrival_times_per_trip
+
+# The trips of a route share its historical trips: they are loaded once, and the
+# completed ones are searched with one query for the most recent pings of all the trips.
+def predict_arrival_times_for_normal_trips_of_route(route_id, contexts, max_candidates=MAX_CANDIDATES):
     threshold_distance = 20
-    
-    most_recent_pings = get_most_recent_pings(main_trip_id, date_time)
-    if len(most_recent_pings) == 0:
-        return
-    most_recent_ping = most_recent_pings.iloc[0]
-    most_recent_ping_lat_lng = (most_recent_ping.lat,
-                                most_recent_ping.lng)
-    # For KD-Tree purposes
-    most_recent_ping_x_y = p(most_recent_ping_lat_lng[1],
-                             most_recent_ping_lat_lng[0])
-    
-    # Get alternative past trip_ids for the same route as main_trip_id 
-    route_id = get_trips(trip_id=main_trip_id).iloc[0].routeId
-    trip_ids = get_past_trips_of_route(route_id, before_date=date_time).index
-    trip_ids = [trip_id for trip_id in trip_ids if trip_id != main_trip_id][:20] # Keep it within 20 trip_ids
-
-    main_trip_tripstops = get_tripstops(trip_id=main_trip_id)
-
-    list_of_trip_tripstop_durations = []
-    for trip_id in trip_ids:
-        if len(list_of_trip_tripstop_durations) >= 5:
-            break
-
-        trip_tripstops = get_tripstops(trip_id=trip_id)
-        if trip_tripstops.stopId.tolist() != main_trip_tripstops.stopId.tolist():
-            continue
-        
-        # Find the trip ping that is closest to most_recent_ping (<20m)
-        cleaned_trip_pings = get_cleaned_trip_pings(get_pings(trip_id=trip_id)) # Past trip, just use full trip pings
-        kd_tree = get_kd_tree(trip_id, date_time=date_time)
-        if not kd_tree:
-            continue
-        nearest_ping_indices = kd_tree.query_ball_point(most_recent_ping_x_y,
-                                                        r=threshold_distance)
-        time_differences = [abs(cleaned_trip_pings[i].time - most_recent_ping.time).total_seconds()
-                            for i in nearest_ping_indices]
-        # Only time difference is used as metric since all the distances are below 20m anyway.
-        indices_ordered = \
-            [index for time_difference, index in
-             sorted(list(zip(time_differences, nearest_ping_indices)))]
-        if len(indices_ordered) == 0:
-            continue
-        closest_ping = cleaned_trip_pings[indices_ordered[0]]
-
-        # For the trip ping, take difference in timing from trip ping to each future tripstops
-        sorted_tripstop_to_nearest_ping = list_of_nearest_pings_to_tripstops(trip_id, date_time=date_time)
-
-        # Check that there is a nearest ping at every tripstop
-        if len(sorted_tripstop_to_nearest_ping) != len(trip_tripstops):
-            continue
-        
-        nearest_ping_timing_per_tripstop = \
-            [get_pings(ping_id=ping_id).iloc[0].time
-             for tripstop_id, ping_id in sorted_tripstop_to_nearest_ping]
-        
-        # Check that the timings of the nearest pings is sorted
-        if not is_sorted(nearest_ping_timing_per_tripstop):
-            continue
-
-        duration_per_tripstop = \
-            [(ping_timing - closest_ping.time).total_seconds() 
-             for ping_timing in nearest_ping_timing_per_tripstop]
-        list_of_trip_tripstop_durations.append(duration_per_tripstop)
+    date_time = contexts[0].date_time
+
+    contexts = [context for context in contexts if len(context.most_recent_pings) > 0]
+    if len(contexts) == 0:
+        return {}
+    most_recent_pings = [context.most_recent_pings.iloc[0] for context in contexts]
+
+    # Get alternative past trip_ids for the same route
+    past_trips = get_past_trips_of_route(route_id, before_date=date_time)
+    stop_sequence_index = get_stop_sequence_index(route_id, past_trips)
+    # Trips that were completed since the indices were updated are fetched and cleaned once for both
+    contexts_of_completed_trips = {}
+    candidate_timelines = get_candidate_timelines(route_id, past_trips, date_time, contexts_of_completed_trips)
+
+    # For the completed trips, one query of the route index finds the trip ping
+    # that is closest to the most recent ping (<20m) of each trip in each of them.
+    route_index = get_route_index(route_id, past_trips, date_time=date_time, contexts=contexts_of_completed_trips)
+    closest_ping_per_trip_per_context = route_index.query_nearest_pings_of_points(
+        [(most_recent_ping.x, most_recent_ping.y) for most_recent_ping in most_recent_pings],
+        [most_recent_ping.time for most_recent_ping in most_recent_pings],
+        r=threshold_distance)
+
+    # Timelines (in microseconds) and same-day trips, loaded once for all the trips
+    timelines = {}
+    same_day_trips = {}
+
+    predicted_arrival_times_per_trip = {}
+    for context, most_recent_ping, closest_ping_per_trip in \
+            zip(contexts, most_recent_pings, closest_ping_per_trip_per_context):
+        main_trip_id = context.trip_id
+        # For KD-Tree purposes
+        most_recent_ping_x_y = (most_recent_ping.x, most_recent_ping.y)
+        recent_trip_ids = set([trip_id for trip_id in past_trips.index if trip_id != main_trip_id][:20]) # Keep it within 20 trip_ids
+
+        # Only the past trips with the same stops as main_trip_id, most recent first.
+        # Completed trips were validated once when they were added to the candidate
+        # timelines of the route, so the invalid ones are dropped without checking them.
+        main_trip_tripstops = context.tripstops
+        trip_ids = [trip_id for trip_id in stop_sequence_index.get_trip_ids(main_trip_tripstops.stopId.tolist())
+                    if trip_id in recent_trip_ids and
+                    (not candidate_timelines.is_validated(trip_id) or candidate_timelines.get_timeline(trip_id))]
+
+        # Same-day trips loaded for this trip, whose queries count as this trip's
+        loaded_trip_ids = []
+
+        # Get the durations from the closest ping of trip_id to most_recent_ping to its
+        # nearest ping to each tripstop, or None if it cannot be a candidate
+        def get_durations(trip_id):
+            # Find the trip ping that is closest to most_recent_ping (<20m),
+            # and the timings of the nearest pings to each tripstop
+            if candidate_timelines.is_validated(trip_id):
+                if trip_id not in closest_ping_per_trip:
+                    return None
+                closest_ping_id, closest_ping_time = closest_ping_per_trip[trip_id]
+                timeline_key = trip_id
+                if timeline_key not in timelines:
+                    timelines[timeline_key] = np.array([to_microseconds_since_epoch(ping_time) for ping_time in
+                                                        candidate_timelines.get_timeline(trip_id)], dtype=np.int64)
+            else:
+                # Trips of the same day are not indexed yet, as they may still be running
+                if trip_id not in same_day_trips:
+                    trip_context = TripContext(trip_id, date_time)
+                    same_day_trips[trip_id] = (trip_context,
+                                               get_kd_tree(trip_id, date_time=date_time, context=trip_context))
+                    loaded_trip_ids.append(trip_id)
+                trip_context, kd_tree = same_day_trips[trip_id]
+                cleaned_trip_pings = trip_context.cleaned_pings
+                if not kd_tree:
+                    return None
+                nearest_ping_indices = kd_tree.query_ball_point(most_recent_ping_x_y,
+                                                                r=threshold_distance)
+                time_differences = [abs(cleaned_trip_pings[i].time - most_recent_ping.time).total_seconds()
+                                    for i in nearest_ping_indices]
+                # Only time difference is used as metric since all the distances are below 20m anyway.
+                indices_ordered = \
+                    [index for time_difference, index in
+                     sorted(list(zip(time_differences, nearest_ping_indices)))]
+                if len(indices_ordered) == 0:
+                    return None
+                closest_ping_time = cleaned_trip_pings[indices_ordered[0]].time
+
+                timeline_key = (trip_id, len(main_trip_tripstops))
+                if timeline_key not in timelines:
+                    timeline = get_trip_timeline(trip_id, date_time, len(main_trip_tripstops), context=trip_context)
+                    timelines[timeline_key] = None if timeline is None else \
+                        np.array([to_microseconds_since_epoch(ping_time) for ping_time in timeline], dtype=np.int64)
+                if timelines[timeline_key] is None:
+                    return None
+
+            # For the trip ping, take difference in timing from trip ping to each future tripstops
+            return (timelines[timeline_key] - to_microseconds_since_epoch(closest_ping_time)) / 1e6
+
+        # Same-day trips are loaded from the database and disk, so they are evaluated
+        # concurrently. Completed trips only need lookups, so they are evaluated in turn.
+        # Each candidate trip is evaluated by one thread only.
+        needs_loading = any(not candidate_timelines.is_validated(trip_id) and trip_id not in same_day_trips
+                            for trip_id in trip_ids)
+        durations = first_n_in_order(get_durations, trip_ids, max_candidates,
+                                     max_threads=MAX_CANDIDATE_THREADS if needs_loading else 1)
+        context.query_count += sum(same_day_trips[trip_id][0].query_count for trip_id in loaded_trip_ids)
+
+        predicted_arrival_times_per_trip[main_trip_id] = \
+            get_predicted_arrival_times(durations, most_recent_ping, main_trip_tripstops)
+    return predicted_arrival_times_per_trip
+
+# Get the predicted arrival times at the tripstops from the durations
+# (a list of arrays of seconds, per tripstop) of each candidate trip
+def get_predicted_arrival_times(durations, most_recent_ping, main_trip_tripstops):
+    if len(durations) == 0:
+        return []
 
     # After getting a few values from prev step, can take mean + S.D.
-    mean_sd_of_duration_per_trip = []
-    list_of_durations_per_trip = transpose(list_of_trip_tripstop_durations)
-    for list_of_durations in list_of_durations_per_trip:
-        # If >= 3 datapoints, we remove the top and bottom timing, then take mean + S.D
-        sorted_list_of_durations = sorted(list_of_durations)
-        if len(sorted_list_of_durations) >= 3:
-            sorted_list_of_durations = sorted_list_of_durations[1:-1]
-        mean_sd_of_duration_per_trip.append((np.mean(sorted_list_of_durations), 
-                                             np.std(sorted_list_of_durations)))
-    
-    duration_per_trip = [mean_duration 
-                         for mean_duration, sd_duration in mean_sd_of_duration_per_trip]
+    # If >= 3 datapoints, we remove the top and bottom timing, then take mean + S.D
+    sorted_durations = np.sort(np.array(durations), axis=0)
+    if len(sorted_durations) >= 3:
+        sorted_durations = sorted_durations[1:-1]
+    mean_duration_per_tripstop = sorted_durations.mean(axis=0)
+    sd_duration_per_tripstop = sorted_durations.std(axis=0)
+
     predicted_arrival_times = \
-        [most_recent_pings.iloc[0].time.to_pydatetime() + timedelta(seconds=duration)
-         for duration in duration_per_trip]
+        [most_recent_ping.time.to_pydatetime() + timedelta(seconds=duration)
+         for duration in mean_duration_per_tripstop]
 
     # Handle edge case: When the bus is parking near the first stop.
     if len(predicted_arrival_times) > 0:
@@ -147,29 +249,30 @@ def predict_arrival_times_for_normal_trips(main_trip_id, date_time):
 
     return predicted_arrival_times
 
-def predict_arrival_times_for_circular_trips(main_trip_id, date_time):
+def predict_arrival_times_for_circular_trips(context):
     threshold_distance = 20
+    main_trip_id, date_time = context.trip_id, context.date_time
 
-    most_recent_pings = get_most_recent_pings(main_trip_id, date_time)
+    most_recent_pings = context.most_recent_pings
     if len(most_recent_pings) == 1:
         return
     most_recent_ping = most_recent_pings.iloc[0]
-    most_recent_ping_lat_lng = (most_recent_ping.lat,
-                                most_recent_ping.lng)
     # For KD-Tree purposes
-    most_recent_ping_x_y = p(most_recent_ping_lat_lng[1],
-                             most_recent_ping_lat_lng[0])
+    most_recent_ping_x_y = (most_recent_ping.x, most_recent_ping.y)
 
     # Get bearing from 2nd most recent ping to most recent ping
     main_trip_current_bearing = get_bearings([most_recent_pings.iloc[1], most_recent_pings.iloc[0]])[0]
 
     # Get alternative past trip_ids for the same route as main_trip_id
-    route_id = get_trips(trip_id=main_trip_id).iloc[0].routeId
-    trip_ids = get_past_trips_of_route(route_id, before_date=date_time).index
-    trip_ids = [trip_id for trip_id in trip_ids if trip_id != main_trip_id][:20] # Keep it within 20 trip_ids
+    route_id = context.route_id
+    past_trips = get_past_trips_of_route(route_id, before_date=date_time)
+    recent_trip_ids = set([trip_id for trip_id in past_trips.index if trip_id != main_trip_id][:20]) # Keep it within 20 trip_ids
 
-    main_trip_tripstops = get_tripstops(trip_id=main_trip_id)
-    trip_cycle_main_trip_stops = get_trip_cycle(main_trip_tripstops.stopId.tolist())
+    # Only the past trips with the same trip cycle as main_trip_id, most recent first
+    main_trip_tripstops = context.tripstops
+    stop_sequence_index = get_stop_sequence_index(route_id, past_trips)
+    trip_ids = [trip_id for trip_id in stop_sequence_index.get_trip_ids_of_cycle(main_trip_tripstops.stopId.tolist())
+                if trip_id in recent_trip_ids]
 
     list_of_trip_tripstop_durations = []
     for trip_id in trip_ids:
@@ -177,19 +280,15 @@ def predict_arrival_times_for_circular_trips(main_trip_id, date_time):
         if len(list_of_trip_tripstop_durations) >= 1:
             break
 
-        # Check whether the trip cycle for past trip and current trip is the same
-        trip_tripstops = get_tripstops(trip_id=trip_id)
-        trip_cycle_trip_tripstops = get_trip_cycle(trip_tripstops.stopId.tolist())
-        if trip_cycle_trip_tripstops != trip_cycle_main_trip_stops:
-            continue
+        trip_context = TripContext(trip_id, date_time)
 
         # Find the trip ping that is closest to most_recent_ping (<20m) and time
-        cleaned_trip_pings = get_cleaned_trip_pings(get_pings(trip_id=trip_id)) # Past trip, just use full trip pings
+        cleaned_trip_pings = trip_context.cleaned_pings
         if not cleaned_trip_pings:
             continue
 
         # Get past trip's KD-Tree
-        kd_tree = get_kd_tree(trip_id, date_time=date_time)
+        kd_tree = get_kd_tree(trip_id, date_time=date_time, context=trip_context)
         if not kd_tree:
             continue
 
@@ -214,10 +313,11 @@ def predict_arrival_times_for_circular_trips(main_trip_id, date_time):
 
         # (In trip predictor) To find best ping using most recent ping (MRP),
         # take the one that minimises duration to MRP, while still positive
-        sorted_stop_to_nearest_pings = list_of_nearest_pings_to_stops(trip_id, date_time=date_time)
+        sorted_stop_to_nearest_pings = \
+            list_of_nearest_pings_to_stops(trip_id, date_time=date_time, context=trip_context)
         duration_per_stop = []
-        for stop_id, ping_ids in sorted_stop_to_nearest_pings:
-            nearest_pings_timing_at_stop = [get_pings(ping_id=ping_id).iloc[0].time for ping_id in ping_ids]
+        for stop_id, nearest_pings in sorted_stop_to_nearest_pings:
+            nearest_pings_timing_at_stop = [ping_time for ping_id, ping_time, ping_lat, ping_lng in nearest_pings]
             durations_to_stop = [(arrival_time - closest_ping.time).total_seconds()
                                  for arrival_time in nearest_pings_timing_at_stop]
             positive_durations_to_stop = [duration for duration in durations_to_stop if duration > 0]
@@ -0,0 +1,73 @@
+import numpy as np
+import time
+from datetime import datetime, timedelta
+from db_logic import get_trip_windows
+
+# A trip is operating from OPERATING_MARGIN before its first tripstop
+# until OPERATING_MARGIN after its last tripstop.
+OPERATING_MARGIN = timedelta(minutes=15)
+# Seconds between loads of the windows of trips added since the last load
+REFRESH_SECONDS = 60
+
+to_datetime64 = lambda date_times: np.array(date_times, dtype='datetime64[us]')
+
+# The operating windows of the trips of a day, sorted by their start, so that the
+# trips operating at a time are found by binary search instead of a query over
+# all tripstops. The windows are loaded once per day, and the windows of trips
+# added during the day (with larger trip ids) are loaded every REFRESH_SECONDS.
+class TripWindowIndex:
+    def __init__(self, get_trip_windows_function=get_trip_windows, refresh_seconds=REFRESH_SECONDS):
+        self.get_trip_windows_function = get_trip_windows_function
+        self.refresh_seconds = refresh_seconds
+        self.date = None
+        self.trip_ids = np.zeros(0, dtype=np.int64)
+        self.starts = to_datetime64([])
+        self.ends = to_datetime64([])
+        self.max_duration = np.timedelta64(0, 'us')
+        self.max_trip_id = 0
+        self.last_refresh_time = 0.0
+
+    # Load the windows of the trips operating on date, replacing the loaded windows
+    def load(self, date):
+        self.date = date
+        self.trip_ids = np.zeros(0, dtype=np.int64)
+        self.starts = self.ends = to_datetime64([])
+        self.max_duration = np.timedelta64(0, 'us')
+        self.max_trip_id = 0
+        self.refresh()
+
+    # Add the windows of the trips added since the windows were loaded or refreshed
+    def refresh(self):
+        day_start = datetime.combine(self.date, datetime.min.time())
+        records = self.get_trip_windows_function(day_start - OPERATING_MARGIN,
+                                                 day_start + timedelta(days=1) + OPERATING_MARGIN,
+                                                 after_trip_id=self.max_trip_id)
+        self.last_refresh_time = time.time()
+        if len(records) == 0:
+            return
+        # Times are returned in the session time zone (Singapore), like the local times they are compared to
+        trip_ids = np.concatenate([self.trip_ids, np.array([record[0] for record in records], dtype=np.int64)])
+        starts = np.concatenate([self.starts,
+                                 to_datetime64([record[1].replace(tzinfo=None) - OPERATING_MARGIN for record in records])])
+        ends = np.concatenate([self.ends,
+                               to_datetime64([record[2].replace(tzinfo=None) + OPERATING_MARGIN for record in records])])
+        order = np.argsort(starts, kind='mergesort')
+        self.trip_ids, self.starts, self.ends = trip_ids[order], starts[order], ends[order]
+        self.max_duration = (self.ends - self.starts).max()
+        self.max_trip_id = int(self.trip_ids.max())
+
+    # Get the ids of the trips operating at date_time (a local time), loading the
+    # windows of its day if they are not loaded, or refreshing them if they are old
+    def get_operating_trip_ids(self, date_time):
+        if self.date != date_time.date():
+            self.load(date_time.date())
+        elif time.time() - self.last_refresh_time >= self.refresh_seconds:
+            self.refresh()
+        date_time = np.datetime64(date_time, 'us')
+        # Only the windows starting at most max_duration before date_time can contain it
+        start_index = np.searchsorted(self.starts, date_time - self.max_duration, side='left')
+        end_index = np.searchsorted(self.starts, date_time, side='right')
+        is_operating = self.ends[start_index:end_index] >= date_time
+        return sorted(int(trip_id) for trip_id in self.trip_ids[start_index:end_index][is_operating])
+
+trip_window_index = TripWindowIndex()
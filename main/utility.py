@@ -1,4 +1,5 @@
 import math
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 # Transpose a 2D-list
@@ -19,6 +20,34 @@ split_list = lambda list_index: [list_index[0][:list_index[1]], list_index[0][li
 # Takes a list and a value; Returns the first index of the list that is greater than the value. 
 find_first_index_greater_than = lambda list_value: next((index for index, value in enumerate(list_value[0]) if value > list_value[1]), None)
 
+# Get the first n results of function(item) that are not None, in the order of items.
+# Up to max_threads items are evaluated at once (for I/O-bound functions); the items
+# after the first n results are cancelled if they have not started yet, and the
+# results of those that already started are ignored, so the output is the same
+# as evaluating the items one by one.
+def first_n_in_order(function, items, n, max_threads=1):
+    results = []
+    if max_threads <= 1:
+        for item in items:
+            if len(results) >= n:
+                break
+            result = function(item)
+            if result is not None:
+                results.append(result)
+        return results
+
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        futures = [executor.submit(function, item) for item in items]
+        for i, future in enumerate(futures):
+            if len(results) >= n:
+                for pending_future in futures[i:]:
+                    pending_future.cancel()
+                break
+            result = future.result()
+            if result is not None:
+                results.append(result)
+    return results
+
 # Compute distance given two coordinates in (x, y) form
 def xy_distance(xy1, xy2):
     diff_x = xy1[0] - xy2[0]
@@ -7,7 +7,7 @@ from constants import TIME_FORMAT
 from datetime import datetime, timedelta
 from db_logic import get_pings, get_tripstops
 from test import get_actual_arrival_timing, get_predicted_arrival_timing
-from trip_helper import get_most_recent_pings
+from trip_context import TripContext
 from utility import flatten
 
 get_lat_lng_pairs = lambda df: list(zip(df['lat'], df['lng']))
@@ -88,7 +88,7 @@ def see_trip(trip_pings, trip_tripstops, date_time=None):
 def add_marker_per_minute(folium_map, trip_id, stop_id, date_time, next_number_of_minutes):
     for i in range(next_number_of_minutes + 1):
         current_datetime = date_time + timedelta(minutes=i)
-        recent_pings = get_most_recent_pings(trip_id, current_datetime)
+        recent_pings = TripContext(trip_id, current_datetime).most_recent_pings
         if len(recent_pings) == 0:
             continue
         point = (recent_pings.iloc[0].lat, recent_pings.iloc[0].lng)
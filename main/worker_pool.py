@@ -0,0 +1,124 @@
+import multiprocessing
+import multiprocessing.connection
+import os
+import time
+import traceback
+
+WORKER_POOL_SIZE = int(os.environ.get('WORKER_POOL_SIZE', 5))
+# Seconds to wait for results before checking that the workers are still alive
+WORKER_POLL_SECONDS = 1
+
+# Run the tasks sent to one worker until it gets None.
+# Each result is sent back as (worker_index, task_id, result, error, busy_seconds).
+def work(worker_index, tasks, results):
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, function, args = task
+        start_time = time.time()
+        try:
+            result, error = function(*args), None
+        except Exception as e:
+            traceback.print_exc()
+            result, error = None, '{}: {}'.format(type(e).__name__, e)
+        results.send((worker_index, task_id, result, error, time.time() - start_time))
+
+# Worker processes that live across cycles, so that their caches (artifacts,
+# incremental cleaners, route indices) and database connections stay warm.
+# Each worker has its own task queue, and tasks with the same key (e.g. a route id)
+# always go to the same worker. Workers that die are restarted.
+# Each worker also has its own pipe for results, since a worker that is killed while
+# writing to a shared queue would leave its lock held and block the other workers.
+class WorkerPool:
+    def __init__(self, size=WORKER_POOL_SIZE):
+        self.size = size
+        self.processes = [None] * size
+        self.task_queues = [None] * size
+        self.result_connections = [None] * size
+        self.stats = [{'tasks': 0, 'failed_tasks': 0, 'busy_seconds': 0.0, 'restarts': 0}
+                      for i in range(size)]
+        self.last_map_seconds = 0.0
+        for worker_index in range(size):
+            self.start_worker(worker_index)
+
+    def start_worker(self, worker_index):
+        if self.result_connections[worker_index] is not None:
+            self.result_connections[worker_index].close()
+        self.task_queues[worker_index] = multiprocessing.Queue()
+        self.result_connections[worker_index], results = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=work,
+                                          args=(worker_index, self.task_queues[worker_index], results),
+                                          daemon=True)
+        process.start()
+        results.close()
+        self.processes[worker_index] = process
+
+    get_worker_index = lambda self, key: hash(key) % self.size
+
+    # Run function(*args) for each args of args_list, on the worker of its key.
+    # Returns the results in the order of args_list (None for tasks that failed).
+    def map(self, function, args_list, keys):
+        start_time = time.time()
+        tasks = {}
+        self.restart_dead_workers(tasks)
+        for task_id, (args, key) in enumerate(zip(args_list, keys)):
+            tasks[task_id] = (self.get_worker_index(key), function, args)
+            self.task_queues[tasks[task_id][0]].put((task_id, function, args))
+        for stats in self.stats:
+            stats['map_busy_seconds'] = 0.0
+
+        results = [None] * len(args_list)
+        while tasks:
+            connections = multiprocessing.connection.wait(self.result_connections, timeout=WORKER_POLL_SECONDS)
+            for connection in connections:
+                try:
+                    worker_index, task_id, result, error, busy_seconds = connection.recv()
+                except EOFError: # The worker died; wait for it to exit, so that it is restarted
+                    self.processes[self.result_connections.index(connection)].join(WORKER_POLL_SECONDS)
+                    continue
+                if task_id not in tasks:
+                    continue
+                del tasks[task_id]
+                results[task_id] = result
+                stats = self.stats[worker_index]
+                stats['tasks'] += 1
+                stats['failed_tasks'] += error is not None
+                stats['busy_seconds'] += busy_seconds
+                stats['map_busy_seconds'] += busy_seconds
+            self.restart_dead_workers(tasks)
+        self.last_map_seconds = time.time() - start_time
+        return results
+
+    # Restart the workers that died, and send them their unfinished tasks again.
+    # A worker runs its tasks in order, so it died on the first unfinished one,
+    # which is not sent again (in case it is what made the worker die).
+    def restart_dead_workers(self, tasks):
+        for worker_index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            print('Worker {} exited with code {}, restarting it'.format(worker_index, process.exitcode))
+            self.stats[worker_index]['restarts'] += 1
+            self.start_worker(worker_index)
+            unfinished_task_ids = sorted(task_id for task_id, task in tasks.items() if task[0] == worker_index)
+            for i, task_id in enumerate(unfinished_task_ids):
+                if i == 0:
+                    del tasks[task_id]
+                    self.stats[worker_index]['failed_tasks'] += 1
+                else:
+                    self.task_queues[worker_index].put((task_id,) + tasks[task_id][1:])
+
+    # Utilisation of each worker: the share of the last map it spent running tasks
+    def get_stats(self):
+        return [dict(stats,
+                     utilisation=stats.get('map_busy_seconds', 0.0) / self.last_map_seconds
+                                 if self.last_map_seconds else 0.0)
+                for stats in self.stats]
+
+    def close(self):
+        for task_queue in self.task_queues:
+            task_queue.put(None)
+        for process in self.processes:
+            process.join()
+        for connection in self.result_connections:
+            connection.close()